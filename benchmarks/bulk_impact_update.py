@@ -0,0 +1,85 @@
+# Per-row UPDATEs vs the bulk impact write paths, against an SQLite stand-in for analysis_posts_sentiment.
+# SQLite has no UPDATE ... JOIN, so the staging table path uses the equivalent UPDATE ... FROM (SQLite >= 3.33).
+# Usage: python -m benchmarks.bulk_impact_update [-n 20000] [-cs 1000] [-f /tmp/impact.db]
+import argparse
+import os
+import random
+import sqlite3
+import time
+
+from inference.db_utils import chunks
+
+
+def create_db(path, n_posts):
+    if path != ':memory:' and os.path.exists(path):
+        os.remove(path)
+
+    conn = sqlite3.connect(path)
+    conn.execute(
+        'CREATE TABLE analysis_posts_sentiment (post_type VARCHAR(30) NOT NULL, post_id BIGINT NOT NULL, '
+        'impact DECIMAL(10,2), PRIMARY KEY (post_type, post_id))'
+    )
+    conn.executemany(
+        'INSERT INTO analysis_posts_sentiment (post_type, post_id, impact) VALUES (?, ?, 1)',
+        [(random.choice(['stocktwit', 'twitter-user', 'twitter-topic']), i) for i in range(n_posts)]
+    )
+    conn.commit()
+    return conn
+
+
+def update_per_row(conn, rows, chunk_size):
+    for post_type, post_id, impact in rows:
+        conn.execute(f"UPDATE analysis_posts_sentiment SET impact={float(impact)} WHERE post_id={post_id} AND post_type='{post_type}'")
+
+    conn.commit()
+
+
+def update_executemany(conn, rows, chunk_size):
+    for chunk in chunks(rows, chunk_size):
+        conn.executemany(
+            'UPDATE analysis_posts_sentiment SET impact=? WHERE post_type=? AND post_id=?',
+            [(impact, post_type, post_id) for (post_type, post_id, impact) in chunk]
+        )
+
+    conn.commit()
+
+
+def update_join(conn, rows, chunk_size):
+    conn.execute('DROP TABLE IF EXISTS temp.tmp_posts_impact')
+    conn.execute(
+        'CREATE TEMPORARY TABLE tmp_posts_impact (post_type VARCHAR(30) NOT NULL, post_id BIGINT NOT NULL, '
+        'impact DECIMAL(10,2), PRIMARY KEY (post_type, post_id))'
+    )
+
+    for chunk in chunks(rows, chunk_size):
+        conn.executemany('INSERT INTO tmp_posts_impact (post_type, post_id, impact) VALUES (?, ?, ?)', chunk)
+
+    conn.execute(
+        'UPDATE analysis_posts_sentiment SET impact = t.impact FROM tmp_posts_impact t '
+        'WHERE analysis_posts_sentiment.post_type = t.post_type AND analysis_posts_sentiment.post_id = t.post_id'
+    )
+    conn.execute('DROP TABLE temp.tmp_posts_impact')
+    conn.commit()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--n_posts', help='Posts in the window, all of them updated', type=int, default=20000)
+    parser.add_argument('-cs', '--chunk_size', help='Rows per bulk statement', type=int, default=1000)
+    parser.add_argument('-f', '--db_file', help='SQLite file. Use a file to include the write costs.', type=str, default=':memory:')
+    args = parser.parse_args()
+
+    print('mode\tseconds\trows/s')
+
+    for name, update in [('per_row', update_per_row), ('executemany', update_executemany), ('join', update_join)]:
+        conn = create_db(args.db_file, args.n_posts)
+        post_keys = conn.execute('SELECT post_type, post_id FROM analysis_posts_sentiment').fetchall()
+        rows = [(post_type, post_id, random.randint(1, 1000)) for post_type, post_id in post_keys]
+
+        start = time.perf_counter()
+        update(conn, rows, args.chunk_size)
+        elapsed = time.perf_counter() - start
+
+        assert conn.execute('SELECT SUM(impact) FROM analysis_posts_sentiment').fetchone()[0] == sum(r[2] for r in rows)
+        print(f'{name}\t{elapsed:.3f}\t{len(rows) / elapsed:.0f}')
+        conn.close()
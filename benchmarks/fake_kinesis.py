@@ -0,0 +1,201 @@
+# In-memory stand-in for the boto3 Kinesis client, for the stream benchmarks. Not a full emulation: only the calls and
+# response fields that streams/ uses, plus optional per-call latency, read throttling and put failures.
+import hashlib
+import random
+import threading
+import time
+
+from botocore.exceptions import ClientError
+
+MAX_HASH_KEY = 2 ** 128 - 1
+
+
+def client_error(code, operation_name):
+    return ClientError({'Error': {'Code': code, 'Message': code}}, operation_name)
+
+
+class FakeShard:
+    def __init__(self, shard_id, starting_hash_key, ending_hash_key, parent_shard_id=None, adjacent_parent_shard_id=None):
+        self.shard_id = shard_id
+        self.starting_hash_key = starting_hash_key
+        self.ending_hash_key = ending_hash_key
+        self.parent_shard_id = parent_shard_id
+        self.adjacent_parent_shard_id = adjacent_parent_shard_id
+        self.records = []
+        self.closed = False
+
+    def describe(self):
+        shard = {
+            'ShardId': self.shard_id,
+            'HashKeyRange': {'StartingHashKey': str(self.starting_hash_key), 'EndingHashKey': str(self.ending_hash_key)},
+            'SequenceNumberRange': {'StartingSequenceNumber': self.records[0]['SequenceNumber'] if self.records else '0'},
+        }
+
+        if self.closed:
+            shard['SequenceNumberRange']['EndingSequenceNumber'] = self.records[-1]['SequenceNumber'] if self.records else '0'
+
+        if self.parent_shard_id:
+            shard['ParentShardId'] = self.parent_shard_id
+
+        if self.adjacent_parent_shard_id:
+            shard['AdjacentParentShardId'] = self.adjacent_parent_shard_id
+
+        return shard
+
+
+class FakeKinesisClient:
+    def __init__(self, n_shards=4, latency_ms=0, read_throttle_rate=0.0, put_failure_rate=0.0, seed=0):
+        self.latency_ms = latency_ms
+        self.read_throttle_rate = read_throttle_rate
+        self.put_failure_rate = put_failure_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.sequence_number = 0
+        self.shards = []
+        self.calls = {'get_records': 0, 'put_records': 0, 'put_record': 0}
+
+        for i in range(n_shards):
+            self.shards.append(FakeShard(
+                f'shardId-{i:012d}', MAX_HASH_KEY * i // n_shards + (1 if i else 0), MAX_HASH_KEY * (i + 1) // n_shards
+            ))
+
+    def _wait(self):
+        if self.latency_ms:
+            time.sleep(self.latency_ms / 1000)
+
+    def _shard(self, shard_id):
+        for shard in self.shards:
+            if shard.shard_id == shard_id:
+                return shard
+
+        raise client_error('ResourceNotFoundException', 'GetShardIterator')
+
+    def _append(self, shard, data, partition_key):
+        self.sequence_number += 1
+        record = {
+            'SequenceNumber': f'{self.sequence_number:056d}',
+            'ApproximateArrivalTimestamp': time.time(),
+            'Data': data if isinstance(data, bytes) else str(data).encode('utf-8'),
+            'PartitionKey': partition_key,
+        }
+        shard.records.append(record)
+        return record
+
+    def shard_for_hash_key(self, hash_key):
+        for shard in self.shards:
+            if not shard.closed and shard.starting_hash_key <= hash_key <= shard.ending_hash_key:
+                return shard
+
+        raise ValueError(f'No open shard for hash key {hash_key}')
+
+    def describe_stream(self, StreamName, ExclusiveStartShardId=None):
+        self._wait()
+
+        with self.lock:
+            shards = [shard.describe() for shard in self.shards]
+
+        if ExclusiveStartShardId is not None:
+            shards = [shard for shard in shards if shard['ShardId'] > ExclusiveStartShardId]
+
+        return {'StreamDescription': {'StreamName': StreamName, 'StreamStatus': 'ACTIVE', 'Shards': shards, 'HasMoreShards': False}}
+
+    def get_shard_iterator(self, StreamName, ShardId, ShardIteratorType, StartingSequenceNumber=None, Timestamp=None):
+        self._wait()
+
+        with self.lock:
+            shard = self._shard(ShardId)
+            sequence_numbers = [record['SequenceNumber'] for record in shard.records]
+
+            if ShardIteratorType == 'TRIM_HORIZON':
+                position = 0
+            elif ShardIteratorType == 'LATEST':
+                position = len(shard.records)
+            elif ShardIteratorType == 'AT_SEQUENCE_NUMBER':
+                position = sum(1 for n in sequence_numbers if n < StartingSequenceNumber)
+            elif ShardIteratorType == 'AFTER_SEQUENCE_NUMBER':
+                position = sum(1 for n in sequence_numbers if n <= StartingSequenceNumber)
+            else:
+                position = sum(1 for record in shard.records if record['ApproximateArrivalTimestamp'] < float(Timestamp))
+
+        return {'ShardIterator': f'{ShardId}|{position}'}
+
+    def get_records(self, ShardIterator, Limit=10000):
+        self._wait()
+
+        with self.lock:
+            self.calls['get_records'] += 1
+
+            if self.read_throttle_rate and self.random.random() < self.read_throttle_rate:
+                raise client_error('ProvisionedThroughputExceededException', 'GetRecords')
+
+            shard_id, position = ShardIterator.rsplit('|', 1)
+            shard = self._shard(shard_id)
+            position = int(position)
+            records = shard.records[position:position + Limit]
+            position += len(records)
+            exhausted = position >= len(shard.records)
+
+        return {
+            'Records': records,
+            'NextShardIterator': None if shard.closed and exhausted else f'{shard_id}|{position}',
+            'MillisBehindLatest': 0 if exhausted else 1000,
+        }
+
+    def put_record(self, StreamName, Data, PartitionKey, ExplicitHashKey=None):
+        self._wait()
+
+        with self.lock:
+            self.calls['put_record'] += 1
+            hash_key = int(ExplicitHashKey) if ExplicitHashKey else int(hashlib.md5(PartitionKey.encode('utf-8')).hexdigest(), 16)
+            shard = self.shard_for_hash_key(hash_key)
+            record = self._append(shard, Data, PartitionKey)
+
+        return {'ShardId': shard.shard_id, 'SequenceNumber': record['SequenceNumber']}
+
+    def put_records(self, Records, StreamName):
+        self._wait()
+
+        if len(Records) > 500:
+            raise client_error('ValidationException', 'PutRecords')
+
+        results = []
+        failed = 0
+
+        with self.lock:
+            self.calls['put_records'] += 1
+
+            for entry in Records:
+                if self.put_failure_rate and self.random.random() < self.put_failure_rate:
+                    failed += 1
+                    results.append({'ErrorCode': 'ProvisionedThroughputExceededException', 'ErrorMessage': 'Rate exceeded'})
+                    continue
+
+                hash_key = entry.get('ExplicitHashKey')
+                hash_key = int(hash_key) if hash_key else int(hashlib.md5(entry['PartitionKey'].encode('utf-8')).hexdigest(), 16)
+                shard = self.shard_for_hash_key(hash_key)
+                record = self._append(shard, entry['Data'], entry['PartitionKey'])
+                results.append({'ShardId': shard.shard_id, 'SequenceNumber': record['SequenceNumber']})
+
+        return {'FailedRecordCount': failed, 'Records': results}
+
+    def split_shard(self, shard_id):
+        """Close shard_id and open two children, each with half of its hash key range."""
+        with self.lock:
+            parent = self._shard(shard_id)
+            parent.closed = True
+            middle = (parent.starting_hash_key + parent.ending_hash_key) // 2
+            n = len(self.shards)
+            self.shards.append(FakeShard(f'shardId-{n:012d}', parent.starting_hash_key, middle, shard_id))
+            self.shards.append(FakeShard(f'shardId-{n + 1:012d}', middle + 1, parent.ending_hash_key, shard_id))
+
+    def close_all_shards(self):
+        with self.lock:
+            for shard in self.shards:
+                shard.closed = True
+
+    def stored_records(self):
+        with self.lock:
+            return [record for shard in self.shards for record in shard.records]
+
+    def close(self):
+        pass
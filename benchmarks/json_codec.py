@@ -0,0 +1,68 @@
+# Decode/encode and framing microbenchmark of inference.json_codec over the tests/data samples.
+# Usage: python -m benchmarks.json_codec [-r 200]
+import argparse
+import glob
+import io
+import json
+import os
+import time
+
+from inference import json_codec
+
+DATA_DIR = os.path.join(os.path.dirname(__file__), '..', 'tests', 'data')
+
+
+def timed(function, repeat):
+    start = time.perf_counter()
+
+    for _ in range(repeat):
+        function()
+
+    return time.perf_counter() - start
+
+
+def load_sample_lines():
+    lines = []
+
+    for file_name in sorted(glob.glob(os.path.join(DATA_DIR, '*.json'))):
+        with open(file_name, 'rb') as f:
+            lines.extend(line for line in f if line.strip())
+
+    return lines
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-r', '--repeat', help='Passes over the samples', type=int, default=200)
+    args = parser.parse_args()
+
+    lines = load_sample_lines()
+    records = [json.loads(line) for line in lines]
+    stream = b''.join(line if line.endswith(b'\n') else line + b'\n' for line in lines)
+    n_records = len(lines) * args.repeat
+
+    print(f'{len(lines)} records, {len(stream)} bytes, {args.repeat} passes')
+    print('operation\tbackend\trecords/s')
+
+    available_backends = ['json']
+
+    for backend in ['ujson', 'orjson']:
+        if json_codec.set_backend(backend) == backend:
+            available_backends.append(backend)
+
+    # None: what the codec picks by default, one backend per direction.
+    for backend in available_backends + [None]:
+        backend = json_codec.set_backend(backend)
+        loads_seconds = timed(lambda: [json_codec.loads(line) for line in lines], args.repeat)
+        dumps_seconds = timed(lambda: [json_codec.dumps(record) for record in records], args.repeat)
+        roundtrip_seconds = timed(lambda: [json_codec.dumps(json_codec.loads(line)) for line in lines], args.repeat)
+        print(f'loads\t{backend}\t{n_records / loads_seconds:.0f}')
+        print(f'dumps\t{backend}\t{n_records / dumps_seconds:.0f}')
+        print(f'loads+dumps\t{backend}\t{n_records / roundtrip_seconds:.0f}')
+
+    for framing in ['ndjson', 'json']:
+        try:
+            framing_seconds = timed(lambda: list(json_codec.RecordSplitter(io.BytesIO(stream), framing)), args.repeat)
+            print(f'framing\t{framing}\t{n_records / framing_seconds:.0f}')
+        except ImportError:
+            print(f'framing\t{framing}\tn/a (splitstream not installed)')
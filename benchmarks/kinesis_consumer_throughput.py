@@ -0,0 +1,63 @@
+# Multi-shard read throughput of streams/kinesis_consumer.KinesisConsumer against benchmarks.fake_kinesis, serial
+# (one worker) vs one worker per shard, with a reshard halfway through. Usage: python -m benchmarks.kinesis_consumer_throughput [-n 8]
+import argparse
+import io
+import json
+import time
+
+from benchmarks.fake_kinesis import FakeKinesisClient
+from streams.kinesis_consumer import KinesisConsumer, OutputWriter
+
+
+def fill_stream(client, first_id, n_records, batch_size=500):
+    entries = [
+        {'Data': json.dumps({'msgType': 'twitter-topic', 'data': {'id': i, 'key': f'k{i % 1000}'}}), 'PartitionKey': f'k{i % 1000}'}
+        for i in range(first_id, first_id + n_records)
+    ]
+
+    for i in range(0, len(entries), batch_size):
+        client.put_records(Records=entries[i:i + batch_size], StreamName='bench')
+
+
+def run(n_shards, n_records, max_workers, latency_ms, batch_size):
+    client = FakeKinesisClient(n_shards)
+    fill_stream(client, 0, n_records // 2)
+    client.split_shard('shardId-000000000000')
+    fill_stream(client, n_records // 2, n_records - n_records // 2)
+    client.close_all_shards()
+    client.latency_ms = latency_ms
+
+    output = io.StringIO()
+    writer = OutputWriter(output)
+    consumer = KinesisConsumer(
+        client, 'bench', writer, batch_size, 0, 'TRIM_HORIZON', max_workers=max_workers, shard_refresh_ms=50
+    )
+    start = time.perf_counter()
+    consumer.run()
+    seconds = time.perf_counter() - start
+
+    records = [json.loads(line)['data'] for line in output.getvalue().splitlines()]
+    assert sorted(record['id'] for record in records) == list(range(n_records)), f'Read {len(records)} records out of {n_records}'
+    last_id_by_key = {}
+
+    # Parents are read before their children, so every partition key is still in put order across the reshard.
+    for record in records:
+        assert record['id'] > last_id_by_key.get(record['key'], -1), f'Out of order record for {record["key"]}'
+        last_id_by_key[record['key']] = record['id']
+
+    return n_records / seconds, client.calls['get_records']
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--n_shards', help='Shards in the fake stream', type=int, default=8)
+    parser.add_argument('-nr', '--n_records', help='Records put in the stream', type=int, default=40000)
+    parser.add_argument('-l', '--latency_ms', help='Simulated latency per Kinesis call', type=int, default=20)
+    parser.add_argument('-bs', '--batch_size', help='GetRecords Limit', type=int, default=500)
+    args = parser.parse_args()
+
+    print('workers\tshards\trecords/s\tget_records calls')
+
+    for max_workers in [1, args.n_shards + 2]:
+        records_per_second, calls = run(args.n_shards, args.n_records, max_workers, args.latency_ms, args.batch_size)
+        print(f'{max_workers}\t{args.n_shards}+2\t{records_per_second:.0f}\t{calls}')
@@ -0,0 +1,84 @@
+# Producer throughput against benchmarks.fake_kinesis: the fixed batch_size loop of streams/kinesis_producer.py vs
+# BatchingProducer, with and without aggregation, and under throttling. Usage: python -m benchmarks.kinesis_producer_throughput [-n 20000]
+import argparse
+import json
+import time
+
+from benchmarks.fake_kinesis import FakeKinesisClient
+from inference import json_codec
+from streams import kinesis_producer
+
+
+def make_lines(n_lines):
+    return [
+        json.dumps({'msgType': 'twitter-topic', 'clientReceivedTsMs': 1536000000000 + i, 'data': {'id': i, 'text': 'tesla ' * 40}}) + '\n'
+        for i in range(n_lines)
+    ]
+
+
+def check_stream(client, n_lines):
+    ids = sorted(json_codec.loads(line)['data']['id'] for record in client.stored_records() for line in json_codec.split_lines(record['Data']))
+    assert ids == list(range(n_lines)), f'{len(ids)} lines in the stream out of {n_lines}'
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--n_lines', help='Lines to send', type=int, default=20000)
+    parser.add_argument('-l', '--latency_ms', help='Simulated latency per Kinesis call', type=int, default=20)
+    parser.add_argument('-f', '--put_failure_rate', help='Share of entries throttled in the throttling run', type=float, default=0.2)
+    args = parser.parse_args()
+
+    lines = make_lines(args.n_lines)
+    print('mode\tlines/s\tput calls\tkinesis records\tbytes/record')
+
+    client = FakeKinesisClient(4, args.latency_ms)
+    kinesis_producer.stream_name = 'bench'
+    start = time.perf_counter()
+
+    for i in range(0, len(lines), 5):
+        kinesis_producer.put_to_stream(client, [line.rstrip() for line in lines[i:i + 5]])
+
+    seconds = time.perf_counter() - start
+    check_stream(client, args.n_lines)
+    n_records = len(client.stored_records())
+    print(f'batch_size=5\t{args.n_lines / seconds:.0f}\t{client.calls["put_records"]}\t{n_records}\t{sum(len(r["Data"]) for r in client.stored_records()) / n_records:.0f}')
+
+    for aggregate in [False, True]:
+        client = FakeKinesisClient(4, args.latency_ms)
+        producer = kinesis_producer.BatchingProducer(client, 'bench', 500, 200, aggregate).start()
+        start = time.perf_counter()
+
+        for line in lines:
+            producer.submit(line)
+
+        producer.close()
+        seconds = time.perf_counter() - start
+        check_stream(client, args.n_lines)
+        n_records = len(client.stored_records())
+        mode = 'linger+aggregate' if aggregate else 'linger'
+        print(f'{mode}\t{args.n_lines / seconds:.0f}\t{client.calls["put_records"]}\t{n_records}\t{sum(len(r["Data"]) for r in client.stored_records()) / n_records:.0f}')
+
+    # Throttling: only the failed entries are sent again, so every line ends up in the stream exactly once.
+    client = FakeKinesisClient(4, args.latency_ms, put_failure_rate=args.put_failure_rate)
+    producer = kinesis_producer.BatchingProducer(client, 'bench', 500, 200, queue_size=1000).start()
+    start = time.perf_counter()
+
+    for line in lines:
+        producer.submit(line)
+
+    producer.close()
+    seconds = time.perf_counter() - start
+    check_stream(client, args.n_lines)
+    print(f'linger, {args.put_failure_rate:.0%} throttled\t{args.n_lines / seconds:.0f}\t{client.calls["put_records"]}\t{producer.stats}')
+
+    # Trickle: the time a lone line waits before being sent.
+    client = FakeKinesisClient(4)
+    producer = kinesis_producer.BatchingProducer(client, 'bench', 500, 200).start()
+    start = time.perf_counter()
+    producer.submit(lines[0])
+
+    while not client.stored_records():
+        time.sleep(0.001)
+
+    print(f'single line sent after {(time.perf_counter() - start) * 1000:.0f} ms with linger_ms=200')
+    producer.close()
@@ -0,0 +1,63 @@
+# Startup time of predict_cli.load_models, rebuilding the classifiers vs loading the modules saved with --saved_model_dir,
+# and the bull score delta between the two on the tests/data samples.
+# Usage: python -m benchmarks.model_load -sif ... -stcf ... -tif ... -ttcf ... -smd /tmp/saved_models
+import argparse
+import time
+import logging
+
+import numpy as np
+
+import predict_cli
+from benchmarks.predict_throughput import load_sample_msgs
+from inference import sentiment_inference
+
+logging.basicConfig(level=logging.WARNING, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+
+def bull_scores(models, msgs, inference_batch_size):
+    """Bull score per message. Grouped by classifier like predict_cli.predict_msgs."""
+    scores = np.zeros(len(msgs))
+
+    for model_key in set(msg['msgType'] for msg in msgs):
+        model = models[model_key]
+        indexes = [i for i, msg in enumerate(msgs) if msg['msgType'] == model_key]
+        texts = [msgs[i]['data']['text'] for i in indexes]
+        scores[indexes] = sentiment_inference.predict_texts_sentiment(
+            model.stoi, model.classification_model, texts, sentiment_inference.get_tokenizer_service(), inference_batch_size
+        )[:, 1]
+
+    return scores
+
+
+def load(args, saved_model_dir):
+    start = time.perf_counter()
+    models = predict_cli.load_models(
+        args.stocktwits_itos_file_path, args.stocktwits_trained_classifier_file_path,
+        args.twitter_itos_file_path, args.twitter_trained_classifier_file_path, saved_model_dir
+    )
+    return models, time.perf_counter() - start
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-sif', '--stocktwits_itos_file_path', type=str, required=True)
+    parser.add_argument('-stcf', '--stocktwits_trained_classifier_file_path', type=str, required=True)
+    parser.add_argument('-tif', '--twitter_itos_file_path', type=str, required=True)
+    parser.add_argument('-ttcf', '--twitter_trained_classifier_file_path', type=str, required=True)
+    parser.add_argument('-smd', '--saved_model_dir', type=str, required=True)
+    parser.add_argument('-r', '--repeat', help='Times the samples are replayed', type=int, default=1)
+    parser.add_argument('-ibs', '--inference_batch_size', type=int, default=32)
+    args = parser.parse_args()
+
+    msgs = load_sample_msgs(args.repeat)
+    built_models, build_s = load(args, None)
+    # The first load with the directory builds and saves the modules, the second one reads them back.
+    load(args, args.saved_model_dir)
+    saved_models, saved_s = load(args, args.saved_model_dir)
+    deltas = np.abs(bull_scores(saved_models, msgs, args.inference_batch_size) - bull_scores(built_models, msgs, args.inference_batch_size))
+
+    print(f'{len(msgs)} records')
+    print('load\tseconds\tmax_abs_delta')
+    print(f'rebuilt\t{build_s:.2f}\t0')
+    print(f'saved\t{saved_s:.2f}\t{deltas.max():.6f}')
@@ -0,0 +1,71 @@
+# Records per shard for each partition key strategy of streams/kinesis_producer.py, on benchmarks.fake_kinesis with
+# uneven shard ranges (4 shards, one of them split). Usage: python -m benchmarks.partition_key_distribution [-n 20000]
+import argparse
+import glob
+import os
+import subprocess
+import sys
+import time
+
+from benchmarks.fake_kinesis import FakeKinesisClient
+from inference import json_codec
+from streams import kinesis_producer
+
+DATA_DIR = os.path.join(os.path.dirname(__file__), '..', 'tests', 'data')
+
+
+def make_lines(n_lines, burst_size):
+    samples = []
+
+    for file_name in ['sample_twitter_posts_20180910.json', 'sample_stocktwits_posts_20180810.json']:
+        with open(os.path.join(DATA_DIR, file_name), 'rb') as f:
+            samples.extend(json_codec.loads(line) for line in f if line.strip())
+
+    lines = []
+
+    for i in range(n_lines):
+        record = samples[i % len(samples)]
+        # Posts come in bursts that share clientReceivedTsMs, which the legacy key slice covers.
+        record['clientReceivedTsMs'] = 1536595499712 + i // burst_size
+        record['data']['id'] = 1039000000000000000 + i
+        lines.append(json_codec.dumps(record))
+
+    return lines
+
+
+def legacy_key_is_stable(line):
+    code = f'import sys; sys.path.insert(0, {os.getcwd()!r}); from streams.kinesis_producer import partition_key; print(partition_key({line!r}))'
+    keys = set(
+        subprocess.run([sys.executable, '-c', code], env={**os.environ, 'PYTHONHASHSEED': seed}, capture_output=True, text=True).stdout
+        for seed in ['1', '2']
+    )
+    return len(keys) == 1
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--n_lines', help='Lines to send', type=int, default=20000)
+    parser.add_argument('-b', '--burst_size', help='Posts per clientReceivedTsMs', type=int, default=20)
+    args = parser.parse_args()
+
+    lines = make_lines(args.n_lines, args.burst_size)
+    print(f'legacy keys stable across processes: {legacy_key_is_stable(lines[0])}')
+    print('strategy\tmax/mean\tlines/s\trecords per shard')
+
+    for strategy in kinesis_producer.PARTITION_KEY_STRATEGIES:
+        client = FakeKinesisClient(4)
+        client.split_shard('shardId-000000000000')
+        shard_map = kinesis_producer.ShardMap(client, 'bench') if strategy in ['round_robin', 'explicit'] else None
+        producer = kinesis_producer.BatchingProducer(
+            client, 'bench', 500, 200, partitioner=kinesis_producer.Partitioner(strategy, shard_map)
+        ).start()
+        start = time.perf_counter()
+
+        for line in lines:
+            producer.submit(line)
+
+        producer.close()
+        seconds = time.perf_counter() - start
+        balance = kinesis_producer.shard_balance(producer.stats['records_per_shard'])
+        per_shard = ' '.join(str(n) for n in balance['records_per_shard'].values())
+        print(f'{strategy}\t{balance["max_over_mean"]}\t{args.n_lines / seconds:.0f}\t{per_shard}')
@@ -0,0 +1,87 @@
+# Throughput of the per-record vs the batched prediction paths on the tests/data samples, and the parity of their scores.
+# Usage: python -m benchmarks.predict_throughput -sif ... -stcf ... -tif ... -ttcf ...
+import argparse
+import copy
+import json
+import os
+import time
+import logging
+
+import predict_cli
+from inference import sentiment_inference
+
+logging.basicConfig(level=logging.WARNING, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+DATA_DIR = os.path.join(os.path.dirname(__file__), '..', 'tests', 'data')
+SAMPLE_FILES = [
+    'sample_stocktwits_sentiment_request_20180810.json',
+    'sample_twitter_posts_sentiment_request_20180910.json',
+    'sample_mixed_social_posts_sentiment_request_20180910.json',
+]
+
+
+def load_sample_msgs(repeat):
+    msgs = []
+
+    for file_name in SAMPLE_FILES:
+        with open(os.path.join(DATA_DIR, file_name)) as f:
+            msgs.extend(json.loads(line) for line in f if line.strip())
+
+    return msgs * repeat
+
+
+def run(models, msgs, batch_size, inference_batch_size, per_record):
+    vader_analyzer = sentiment_inference.load_vader_analyzer()
+    msgs = copy.deepcopy(msgs)
+    start = time.perf_counter()
+
+    for i in range(0, len(msgs), batch_size):
+        batch = msgs[i:i + batch_size]
+
+        if per_record:
+            for record in batch:
+                predict_cli.predict_msg(models, record, vader_analyzer, None)
+        else:
+            predict_cli.predict_msgs(models, batch, vader_analyzer, None, inference_batch_size)
+
+    records_per_second = len(msgs) / (time.perf_counter() - start)
+    bull_scores = [msg['predictions']['values']['bull_sentiment'] for msg in msgs]
+    return records_per_second, bull_scores
+
+
+def parity(per_record_scores, batched_scores):
+    """(max abs bull score delta, % of records with the same bull/bear label)"""
+    deltas = [abs(a - b) for a, b in zip(per_record_scores, batched_scores)]
+    agreement = sum((a > 0.5) == (b > 0.5) for a, b in zip(per_record_scores, batched_scores)) * 100 / len(deltas)
+    return max(deltas), agreement
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-sif', '--stocktwits_itos_file_path', type=str, required=True)
+    parser.add_argument('-stcf', '--stocktwits_trained_classifier_file_path', type=str, required=True)
+    parser.add_argument('-tif', '--twitter_itos_file_path', type=str, required=True)
+    parser.add_argument('-ttcf', '--twitter_trained_classifier_file_path', type=str, required=True)
+    parser.add_argument('-r', '--repeat', help='Times the samples are replayed', type=int, default=10)
+    parser.add_argument('-bs', '--batch_sizes', help='Comma separated read batch sizes', type=str, default='5,50,200')
+    parser.add_argument('-ibs', '--inference_batch_size', type=int, default=32)
+    args = parser.parse_args()
+
+    models = predict_cli.load_models(
+        args.stocktwits_itos_file_path, args.stocktwits_trained_classifier_file_path,
+        args.twitter_itos_file_path, args.twitter_trained_classifier_file_path
+    )
+    msgs = load_sample_msgs(args.repeat)
+
+    print(f'{len(msgs)} records')
+    print('batch_size\tper_record_rps\tbatched_rps\tspeedup\tmax_abs_delta\tlabel_agreement')
+
+    for batch_size in map(int, args.batch_sizes.split(',')):
+        per_record_rps, per_record_scores = run(models, msgs, batch_size, args.inference_batch_size, True)
+        batched_rps, batched_scores = run(models, msgs, batch_size, args.inference_batch_size, False)
+        max_delta, agreement = parity(per_record_scores, batched_scores)
+        print(
+            f'{batch_size}\t{per_record_rps:.1f}\t{batched_rps:.1f}\t{batched_rps / per_record_rps:.2f}x\t'
+            f'{max_delta:.6f}\t{agreement:.2f}%'
+        )
@@ -0,0 +1,76 @@
+# Scaling of predict_cli --workers on the tests/data samples: records/s in process (0) and with 1 to N inference workers.
+# Usage: python -m benchmarks.predict_workers -sif ... -stcf ... -tif ... -ttcf ... [-w 0,1,2,4,8,16]
+import argparse
+import copy
+import functools
+import time
+import logging
+
+import predict_cli
+from benchmarks.predict_throughput import load_sample_msgs
+from inference import sentiment_inference
+from inference.inference_pool import InferencePool, share_models
+
+logging.basicConfig(level=logging.WARNING, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+
+def run(models, msgs, batch_size, inference_batch_size, workers, ordered):
+    msgs = copy.deepcopy(msgs)
+    batches = [msgs[i:i + batch_size] for i in range(0, len(msgs), batch_size)]
+
+    if workers == 0:
+        vader_analyzer = sentiment_inference.load_vader_analyzer()
+        start = time.perf_counter()
+
+        for batch in batches:
+            predict_cli.predict_msgs(models, batch, vader_analyzer, None, inference_batch_size)
+
+        return len(msgs) / (time.perf_counter() - start)
+
+    pool = InferencePool(
+        functools.partial(predict_cli.predict_msgs_in_worker, models, None, inference_batch_size), workers, ordered,
+        initializer=functools.partial(predict_cli.init_predict_worker, 0, None)
+    )
+    # Warm up: the first batch of each worker pays for the vader lexicon and the lazy torch init.
+    list(pool.map_batches(batches[:workers]))
+    start = time.perf_counter()
+    n_records = sum(len(records) for records in pool.map_batches(batches))
+    records_per_second = n_records / (time.perf_counter() - start)
+    pool.close()
+    return records_per_second
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-sif', '--stocktwits_itos_file_path', type=str, required=True)
+    parser.add_argument('-stcf', '--stocktwits_trained_classifier_file_path', type=str, required=True)
+    parser.add_argument('-tif', '--twitter_itos_file_path', type=str, required=True)
+    parser.add_argument('-ttcf', '--twitter_trained_classifier_file_path', type=str, required=True)
+    parser.add_argument('-r', '--repeat', help='Times the samples are replayed', type=int, default=10)
+    parser.add_argument('-w', '--workers', help='Comma separated worker counts. 0 is in process.', type=str, default='0,1,2,4,8,16')
+    parser.add_argument('-bs', '--batch_size', help='Records per dispatched batch', type=int, default=50)
+    parser.add_argument('-ibs', '--inference_batch_size', type=int, default=32)
+    parser.add_argument('-uo', '--unordered', action='store_true', required=False)
+    args = parser.parse_args()
+
+    sentiment_inference.get_tokenizer_service(0)
+    models = predict_cli.load_models(
+        args.stocktwits_itos_file_path, args.stocktwits_trained_classifier_file_path,
+        args.twitter_itos_file_path, args.twitter_trained_classifier_file_path
+    )
+    share_models(models)
+    msgs = load_sample_msgs(args.repeat)
+
+    print(f'{len(msgs)} records, batches of {args.batch_size}')
+    print('workers\trecords/s\tspeedup vs 1')
+    baseline = None
+
+    for workers in map(int, args.workers.split(',')):
+        records_per_second = run(models, msgs, args.batch_size, args.inference_batch_size, workers, not args.unordered)
+
+        if workers == 1:
+            baseline = records_per_second
+
+        speedup = f'{records_per_second / baseline:.2f}x' if baseline else '-'
+        print(f'{workers}\t{records_per_second:.1f}\t{speedup}')
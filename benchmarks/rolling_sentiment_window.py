@@ -0,0 +1,85 @@
+# Checks RollingSentimentAggregator against the AVG(impact*(sentiment_mixed-0.5)) SQL of insert_current_global_sentiment_in_db,
+# on an SQLite stand-in for analysis_posts_sentiment, while time moves forward and impacts change. Also times both.
+# Usage: python -m benchmarks.rolling_sentiment_window [-n 50000] [-s 20]
+import argparse
+import random
+import sqlite3
+import time
+
+from inference.sentiment_window import RollingSentimentAggregator
+
+WINDOWS = [3600, 4 * 3600, 12 * 3600]
+POST_TYPES = ['stocktwit', 'twitter-user', 'twitter-topic']
+
+
+def sql_averages(conn, now_ms):
+    averages = {}
+
+    for w in WINDOWS:
+        for sentiment_type, post_types in [('stocktwits', "('stocktwit')"), ('twitter', "('twitter-topic', 'twitter-user')")]:
+            averages[(sentiment_type, w)] = conn.execute(
+                f'SELECT AVG(impact*(sentiment_mixed-0.5)) FROM analysis_posts_sentiment '
+                f'WHERE created_at_epoch_ms >= ? AND post_type IN {post_types}',
+                (now_ms - w * 1000,)
+            ).fetchone()[0]
+
+    return averages
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--n_posts', help='Posts in the 12 hours window', type=int, default=50000)
+    parser.add_argument('-s', '--steps', help='Time steps of 5 minutes to simulate', type=int, default=20)
+    args = parser.parse_args()
+
+    conn = sqlite3.connect(':memory:')
+    conn.execute(
+        'CREATE TABLE analysis_posts_sentiment (post_type TEXT, post_id INTEGER, impact REAL, sentiment_mixed REAL, '
+        'created_at_epoch_ms INTEGER, PRIMARY KEY (post_type, post_id))'
+    )
+    conn.execute('CREATE INDEX created_at_epoch_ms ON analysis_posts_sentiment (created_at_epoch_ms)')
+
+    now_ms = 1536595499712
+    aggregator = RollingSentimentAggregator(WINDOWS)
+    next_id = 0
+    sql_seconds = aggregator_seconds = 0.0
+    max_delta = 0.0
+
+    def add_posts(n, start_ms, end_ms):
+        global next_id
+        rows = []
+
+        for _ in range(n):
+            next_id += 1
+            row = (random.choice(POST_TYPES), next_id, random.randint(1, 50), round(random.random(), 2), random.randint(start_ms, end_ms))
+            rows.append(row)
+            aggregator.upsert(row[0], row[1], row[4], row[2], row[3], now_ms)
+
+        conn.executemany('INSERT INTO analysis_posts_sentiment VALUES (?, ?, ?, ?, ?)', rows)
+
+    add_posts(args.n_posts, now_ms - 12 * 3600 * 1000, now_ms)
+
+    for step in range(args.steps):
+        now_ms += 5 * 60 * 1000
+        add_posts(args.n_posts // 144, now_ms - 5 * 60 * 1000, now_ms)
+
+        keys = conn.execute('SELECT post_type, post_id FROM analysis_posts_sentiment ORDER BY RANDOM() LIMIT 500').fetchall()
+        updates = [(random.randint(1, 500), post_type, post_id) for post_type, post_id in keys]
+        conn.executemany('UPDATE analysis_posts_sentiment SET impact=? WHERE post_type=? AND post_id=?', updates)
+
+        for impact, post_type, post_id in updates:
+            aggregator.update_impact(post_type, post_id, impact)
+
+        start = time.perf_counter()
+        expected = sql_averages(conn, now_ms)
+        sql_seconds += time.perf_counter() - start
+
+        start = time.perf_counter()
+        actual = aggregator.averages(now_ms)
+        aggregator_seconds += time.perf_counter() - start
+
+        for sentiment_type, w, average in actual:
+            max_delta = max(max_delta, abs(average - expected[(sentiment_type, w)]))
+
+    print(f'steps={args.steps} windows={WINDOWS} max_abs_delta={max_delta:.2e}')
+    print(f'sql_ms_per_step={1000 * sql_seconds / args.steps:.2f} aggregator_ms_per_step={1000 * aggregator_seconds / args.steps:.2f}')
@@ -0,0 +1,119 @@
+# Bytes per record and records/s for each hop of the pipeline: JSON lines over a pipe (stdout) vs inference.transport
+# frames over a Unix socket. Usage: python -m benchmarks.stage_transport [-n 50000]
+import argparse
+import copy
+import os
+import tempfile
+import threading
+import time
+
+from inference import json_codec
+from inference import message_utils
+from inference import transport
+
+DATA_DIR = os.path.join(os.path.dirname(__file__), '..', 'tests', 'data')
+
+
+def load_records(n_records):
+    samples = []
+
+    for file_name in ['sample_twitter_posts_20180910.json', 'sample_stocktwits_posts_20180810.json']:
+        with open(os.path.join(DATA_DIR, file_name), 'rb') as f:
+            samples.extend(json_codec.loads(line) for line in f if line.strip())
+
+    requests = []
+
+    for i in range(n_records):
+        record = copy.deepcopy(samples[i % len(samples)])
+
+        if record['msgType'] == 'stocktwit':
+            record['data']['text'] = record['data'].pop('body')
+
+        record['msgType'] += '-sentiment-request'
+        requests.append(record)
+
+    responses = []
+
+    # Same shape as sentiment_inference.annotate_record, which can't be imported without fastai.
+    for record in requests:
+        response = copy.deepcopy(record)
+        response['msgType'] = response['msgType'].replace('request', 'response')
+        response['predictions'] = {
+            'model': 'models/28664clas_2.h5',
+            'context': [{'stoi': 'twitter_posts_lm/tmp/itos.pkl', 'inputDataset': None}],
+            'predictionProcessedTsMs': 1536595500000,
+            'values': {'bear_sentiment': 0.3, 'bull_sentiment': 0.7, 'vader_sentiment': 0.6, 'bull_vader_sentiment': 0.68},
+        }
+        responses.append(response)
+
+    return requests, responses
+
+
+def chunked(records, send_size):
+    for i in range(0, len(records), send_size):
+        yield records[i:i + send_size]
+
+
+def run_pipe(records, send_size, batch_size):
+    read_fd, write_fd = os.pipe()
+    written = [0]
+
+    def write():
+        with open(write_fd, 'w') as output:
+            for chunk in chunked(records, send_size):
+                lines = ''.join(json_codec.dumps(record) + '\n' for record in chunk)
+                written[0] += len(lines.encode('utf-8'))
+                output.write(lines)
+                output.flush()
+
+    start = time.perf_counter()
+    threading.Thread(target=write, daemon=True).start()
+    received = 0
+
+    with open(read_fd, 'r') as input_handle:
+        for msgs in message_utils.read_batches(batch_size, input_handle, 0, 5, 'ndjson'):
+            received += len(msgs)
+
+    return written[0] / len(records), received / (time.perf_counter() - start)
+
+
+def run_socket(records, send_size, batch_size):
+    socket_path = os.path.join(tempfile.mkdtemp(), 'stage.sock')
+    receiver = transport.RecordReceiver(socket_path)
+    sender = transport.RecordSender(socket_path)
+
+    def write():
+        for chunk in chunked(records, send_size):
+            sender.send(chunk)
+
+    start = time.perf_counter()
+    threading.Thread(target=write, daemon=True).start()
+    received = 0
+
+    for msgs in receiver.batches(batch_size, 5):
+        received += len(msgs)
+
+        if received >= len(records):
+            break
+
+    seconds = time.perf_counter() - start
+    sender.close()
+    receiver.close()
+    return sender.stats['bytes'] / len(records), received / seconds
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--n_records', help='Records per hop', type=int, default=50000)
+    parser.add_argument('-bs', '--batch_size', help='Records per batch read by the downstream stage', type=int, default=50)
+    args = parser.parse_args()
+
+    requests, responses = load_records(args.n_records)
+    # The filter stage writes a whole batch at once, predict_cli one record at a time.
+    hops = [('filter -> predict', requests, args.batch_size), ('predict -> ingest', responses, 1)]
+    print('hop\ttransport\tbytes/record\trecords/s')
+
+    for hop, records, send_size in hops:
+        for name, run in [('stdout json', run_pipe), ('unix socket', run_socket)]:
+            bytes_per_record, records_per_second = run(records, send_size, args.batch_size)
+            print(f'{hop}\t{name}\t{bytes_per_record:.0f}\t{records_per_second:.0f}')
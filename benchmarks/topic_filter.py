@@ -0,0 +1,76 @@
+# Per-record any(topic in text) loop vs inference.topic_filter.TopicMatcher over synthetic tweets.
+# Usage: python -m benchmarks.topic_filter [-n 20000] [-bs 500] [-t 6 200 1000]
+import argparse
+import random
+import time
+
+from inference import topic_filter
+
+WORDS = ['the', 'stock', 'is', 'going', 'to', 'moon', 'short', 'sellers', 'earnings', 'call', 'today', 'delivery', 'numbers',
+         'factory', 'production', 'ramp', 'battery', 'cars', 'price', 'target', 'buy', 'sell', 'hold', 'new', 'record']
+
+
+def make_topics(n_topics):
+    topics = list(topic_filter.DEFAULT_TOPICS)
+    rng = random.Random(1)
+
+    while len(topics) < n_topics:
+        topics.append('$' + ''.join(rng.choice('abcdefghijklmnopqrstuvwxyz') for _ in range(rng.randint(2, 5))))
+
+    return topics[:n_topics] if n_topics >= len(topic_filter.DEFAULT_TOPICS) else topics
+
+
+def make_texts(n_texts, topics):
+    rng = random.Random(2)
+    texts = []
+
+    for _ in range(n_texts):
+        words = [rng.choice(WORDS) for _ in range(rng.randint(8, 30))]
+
+        if rng.random() < 0.3:
+            words.insert(rng.randint(0, len(words)), rng.choice(topics).upper())
+
+        if rng.random() < 0.2:
+            words.insert(0, 'RT')
+
+        texts.append(' '.join(words))
+
+    return texts
+
+
+def naive_match(texts, topics):
+    matched = []
+
+    for text in texts:
+        text = str(text).lower()
+        matched.append(any(topic in text for topic in topics) and text[0:3] != 'rt ')
+
+    return matched
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--n_texts', help='Tweets per run', type=int, default=20000)
+    parser.add_argument('-bs', '--batch_size', help='Tweets per matcher call', type=int, default=500)
+    parser.add_argument('-t', '--topic_counts', help='Topic list sizes to try', type=int, nargs='+', default=[6, 200, 1000])
+    args = parser.parse_args()
+
+    print('topics\tmethod\ttexts/s\tmatched')
+
+    for n_topics in args.topic_counts:
+        topics = make_topics(n_topics)
+        texts = make_texts(args.n_texts, topics)
+        batches = [texts[i:i + args.batch_size] for i in range(0, len(texts), args.batch_size)]
+
+        start = time.perf_counter()
+        naive = [m for batch in batches for m in naive_match(batch, topics)]
+        naive_seconds = time.perf_counter() - start
+
+        matcher = topic_filter.TopicMatcher(topics)
+        start = time.perf_counter()
+        vectorised = [m for batch in batches for m in matcher.match(batch)]
+        matcher_seconds = time.perf_counter() - start
+
+        assert naive == vectorised, 'TopicMatcher disagrees with the per-record loop'
+        print(f'{len(topics)}\tper-record\t{len(texts) / naive_seconds:.0f}\t{sum(naive)}')
+        print(f'{len(topics)}\tmatcher\t{len(texts) / matcher_seconds:.0f}\t{sum(vectorised)}')
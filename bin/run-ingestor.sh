@@ -30,7 +30,11 @@ nohup sh -c "/usr/bin/java -cp /home/paperspace/anaconda3/lib/python3.6/site-pac
 sleep 60
 
 cd ${DIR}/..
-nohup sh -c "python3.6 filter_posts_for_predict_cli.py -idf $KCL_OUTPUT_FILE -ssh  2> ${DATA_DIR}/${STDERR_FILTER_INGESTOR_FILE} | python3.6 predict_cli.py -sif $STOCKTWITS_SENTIMENT_ITOS_MODEL_PATH -stcf $STOCKTWITS_SENTIMENT_MODEL_PATH -tif $TWITTER_SENTIMENT_ITOS_MODEL_PATH -ttcf $TWITTER_SENTIMENT_MODEL_PATH 2> ${DATA_DIR}/${STDERR_SENTIMENT_INFERENCE_FILE} | python3.6 db_ingestor_cli.py -ssh 2> ${DATA_DIR}/${STDERR_DB_INGESTOR_FILE}" &
+nohup sh -c "python3.6 filter_posts_for_predict_cli.py -idf $KCL_OUTPUT_FILE -fm ndjson -ssh  2> ${DATA_DIR}/${STDERR_FILTER_INGESTOR_FILE} | python3.6 predict_cli.py -sif $STOCKTWITS_SENTIMENT_ITOS_MODEL_PATH -stcf $STOCKTWITS_SENTIMENT_MODEL_PATH -tif $TWITTER_SENTIMENT_ITOS_MODEL_PATH -ttcf $TWITTER_SENTIMENT_MODEL_PATH -fm ndjson 2> ${DATA_DIR}/${STDERR_SENTIMENT_INFERENCE_FILE} | python3.6 db_ingestor_cli.py -fm ndjson -ssh 2> ${DATA_DIR}/${STDERR_DB_INGESTOR_FILE}" &
+# Same pipeline with the stages connected by Unix sockets (inference/transport.py) instead of stdout pipes:
+# nohup sh -c "python3.6 db_ingestor_cli.py -is ${DATA_DIR}/predict_to_ingest.sock -ssh 2> ${DATA_DIR}/${STDERR_DB_INGESTOR_FILE}" &
+# nohup sh -c "python3.6 predict_cli.py -sif $STOCKTWITS_SENTIMENT_ITOS_MODEL_PATH -stcf $STOCKTWITS_SENTIMENT_MODEL_PATH -tif $TWITTER_SENTIMENT_ITOS_MODEL_PATH -ttcf $TWITTER_SENTIMENT_MODEL_PATH -is ${DATA_DIR}/filter_to_predict.sock -os ${DATA_DIR}/predict_to_ingest.sock 2> ${DATA_DIR}/${STDERR_SENTIMENT_INFERENCE_FILE}" &
+# nohup sh -c "python3.6 filter_posts_for_predict_cli.py -idf $KCL_OUTPUT_FILE -fm ndjson -ssh -os ${DATA_DIR}/filter_to_predict.sock 2> ${DATA_DIR}/${STDERR_FILTER_INGESTOR_FILE}" &
 
-# nohup sh -c "python3.6 global_sentiment_update_cli.py -ssh " 2> ${DATA_DIR}/${STDERR_GLOBAL_SENTIMENT_UPDATE_FILE} &
+nohup sh -c "python3.6 global_sentiment_update_cli.py -ssh 2> ${DATA_DIR}/${STDERR_GLOBAL_SENTIMENT_UPDATE_FILE}" &
 cd $DIR
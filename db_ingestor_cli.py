@@ -1,15 +1,12 @@
 import argparse
 import gc
-from datetime import datetime
 from inference import message_utils
 from inference import db_utils
-from lru import LRU
+from inference import db_schema
+from inference import transport
 import os
-from sqlalchemy.ext.automap import automap_base
-from sqlalchemy.orm import Session
 import sys
 import time
-from typing import Dict, Iterable, List, Tuple
 sys.excepthook = sys.__excepthook__ # See https://groups.io/g/insync/topic/13778827?p=,,,20,0,0,0::recentpostdate%2Fsticky,,,20,2,0,13778827
 
 import traceback
@@ -18,168 +15,8 @@ logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(level
 logger = logging.getLogger(__name__)
 
 
-def get_relevant_posts(use_ssh, db_host, db_user, db_password, db_port, database_name, ssh_username, ssh_password):
-    relevant_posts_sql = f'''
-
-    SELECT post_type, message_id, MAX(interaction_total) as interaction_total, MAX(likes_total) as likes_total FROM
-    (
-    SELECT 'stocktwit' as post_type, message_id, conversation_replies as interaction_total, likes_total FROM data_stocktwits_posts_rt
-    WHERE message_id IN (SELECT post_id FROM analysis_posts_sentiment 
-    WHERE created_at_epoch_ms >=(SELECT UNIX_TIMESTAMP(NOW())*1000-(12*3600*1000)) AND post_type = 'stocktwit')
-
-    UNION
-
-    SELECT 'twitter-user' as post_type, tweet_id as message_id, retweet_count as interaction_total, favorite_count as likes_total FROM data_twitter_users_rt
-    WHERE tweet_id IN (SELECT post_id FROM analysis_posts_sentiment 
-    WHERE created_at_epoch_ms >=(SELECT UNIX_TIMESTAMP(NOW())*1000-(12*3600*1000)) AND post_type = 'twitter-user')
-
-    UNION
-
-    SELECT 'twitter-topic' as post_type, tweet_id as message_id, retweet_count as interaction_total, favorite_count as likes_total FROM data_twitter_topics_rt
-    WHERE tweet_id IN (SELECT post_id FROM analysis_posts_sentiment 
-    WHERE created_at_epoch_ms >=(SELECT UNIX_TIMESTAMP(NOW())*1000-(12*3600*1000)) AND post_type = 'twitter-topic')
-    ) impact 
-    GROUP BY post_type, message_id;
-
-  '''
-
-    df_relevant_posts = db_utils.query(use_ssh, relevant_posts_sql, db_host, db_user, db_password, db_port, database_name, ssh_username, ssh_password)
-
-    gc.collect()
-
-    return df_relevant_posts
-
-
-def update_impact_in_db(posts_to_update: List[Tuple[int, float]], use_ssh, db_host, db_user, db_password, db_port, database_name, ssh_username, ssh_password):
-    sql_for_update = [
-        f"UPDATE analysis_posts_sentiment SET impact={float(impact)} WHERE post_id={post_id} AND post_type='{post_type}';\n\n" for (post_id, impact, post_type)
-        in posts_to_update
-    ]
-
-    logger.info(f'Running updates: {len(sql_for_update)}')
-    db_utils.update(use_ssh, sql_for_update, db_host, db_user, db_password, db_port, database_name, ssh_username, ssh_password)
-    logger.info(f'Completed updates: {len(sql_for_update)}')
-
-
-def insert_current_global_sentiment_in_db(use_ssh, db_host, db_user, db_password, db_port, database_name, ssh_username, ssh_password):
-    sql_for_insert_stocktwits = """
-        INSERT INTO analysis_global_sentiment(sentiment_type, sentiment_seconds_back, created_at_epoch_ms, sentiment_absolute)
-        (SELECT 'stocktwits', 12*3600, UNIX_TIMESTAMP(NOW())*1000, AVG(impact*(sentiment_mixed-0.5))
-        FROM analysis_posts_sentiment 
-        WHERE created_at_epoch_ms >=(SELECT UNIX_TIMESTAMP(NOW())*1000-(12*3600*1000)) AND post_type IN ('stocktwit'));       
-    """
-
-    sql_for_insert_twitter = """
-        INSERT INTO analysis_global_sentiment(sentiment_type, sentiment_seconds_back, created_at_epoch_ms, sentiment_absolute)
-        (SELECT 'twitter', 12*3600, UNIX_TIMESTAMP(NOW())*1000, AVG(impact*(sentiment_mixed-0.5))
-        FROM analysis_posts_sentiment
-        WHERE created_at_epoch_ms >=(SELECT UNIX_TIMESTAMP(NOW())*1000-(12*3600*1000)) AND post_type IN ('twitter-topic', 'twitter-user'));
-    """
-
-    sql_for_insert_social_teslamonitor = """
-        INSERT INTO analysis_global_sentiment(sentiment_type, sentiment_seconds_back, created_at_epoch_ms, sentiment_absolute)
-        (
-            SELECT 'social_teslamonitor', sentiment_seconds_back, UNIX_TIMESTAMP(NOW())*1000, 
-            50*AVG(0.5+sentiment_absolute)
-            FROM analysis_global_sentiment
-            WHERE created_at_epoch_ms >=(SELECT UNIX_TIMESTAMP(NOW())*1000-(sentiment_seconds_back*1000))
-            AND sentiment_type IN ('twitter', 'stocktwits')
-            GROUP BY sentiment_seconds_back
-        );
-    """
-
-    # Stocktweets ranges between 0 and 100.
-    # Stockfluence ranges between 0 and 200.
-
-    sql_for_insert_social_external_ensemble = """
-        INSERT INTO analysis_global_sentiment(sentiment_type, sentiment_seconds_back, created_at_epoch_ms, sentiment_absolute)
-        (
-            SELECT 'social_external_ensemble', 12*3600, UNIX_TIMESTAMP(NOW())*1000, 
-            AVG(sentiment_absolute)
-            FROM 
-            (
-            
-                SELECT client_received_ts_ms, sentiment_percent as sentiment_absolute
-                FROM data_stocktwits_sentiment_rt
-                WHERE client_received_ts_ms >=(SELECT UNIX_TIMESTAMP(NOW())*1000-(12*3600*1000))
-                
-                UNION
-                
-                SELECT client_received_ts_ms, 0.5*sentiment_score as sentiment_absolute
-                FROM data_stockfluence_rt_sentiment
-                WHERE client_received_ts_ms >=(SELECT UNIX_TIMESTAMP(NOW())*1000-(12*3600*1000))                
-            
-            ) AS sentiment_ensemble
-            
-        );
-    """
-
-    sql_for_insert_news_external_ensemble = """
-        INSERT INTO analysis_global_sentiment(sentiment_type, sentiment_seconds_back, created_at_epoch_ms, sentiment_absolute)
-        (
-            SELECT 'news_external_ensemble', 12*3600, UNIX_TIMESTAMP(NOW())*1000, 
-            AVG(sentiment_absolute)
-            FROM 
-            (
-
-                SELECT client_received_ts_ms, news_sentiment_score as sentiment_absolute
-                FROM data_benzinga_sentiment_rt
-                WHERE client_received_ts_ms >=(SELECT UNIX_TIMESTAMP(NOW())*1000-(12*3600*1000))
-
-                UNION
-
-                SELECT client_received_ts_ms, current_buzz as sentiment_absolute
-                FROM data_tipranks_news_sentiment_rt
-                WHERE client_received_ts_ms >=(SELECT UNIX_TIMESTAMP(NOW())*1000-(12*3600*1000))                
-
-            ) AS sentiment_ensemble
-
-        );
-    """
-
-    sql_for_insert_global_external_ensemble = """
-        INSERT INTO analysis_global_sentiment(sentiment_type, sentiment_seconds_back, created_at_epoch_ms, sentiment_absolute)
-        (
-            SELECT 'global_external_ensemble', 12*3600, UNIX_TIMESTAMP(NOW())*1000, 
-            AVG(sentiment_absolute)
-            FROM analysis_global_sentiment
-            WHERE created_at_epoch_ms >= (SELECT UNIX_TIMESTAMP(NOW())*1000-(12*3600*1000))
-            AND sentiment_type in ('news_external_ensemble', 'social_external_ensemble')
-        );
-    """
-
-    sql_for_insert = [
-        sql_for_insert_stocktwits, sql_for_insert_twitter, sql_for_insert_social_teslamonitor,
-        sql_for_insert_social_external_ensemble, sql_for_insert_news_external_ensemble,
-        sql_for_insert_global_external_ensemble
-    ]
-
-    logger.info(f'Running inserts: {sql_for_insert}')
-
-    db_utils.update(
-        use_ssh, sql_for_insert,
-        db_host, db_user, db_password, db_port, database_name, ssh_username, ssh_password
-    )
-
-    logger.info(f'Completed inserts: {sql_for_insert}')
-
-
-def compute_impact(post):
-    msg_type = post['post_type']
-
-    if msg_type in ['twitter-topic', 'twitter-user']:
-        return 1 + post.get('likes_total', 0) + post.get('interaction_total', 0) * 3
-    else:
-        return 1 + post.get('likes_total', 0) + post.get('interaction_total', 0)
-
-
-def get_utc_now():
-    delta_ts = datetime.utcnow() - datetime(1970, 1, 1)
-    utc_now = int((delta_ts.days * 24 * 60 * 60 + delta_ts.seconds) * 1000 + delta_ts.microseconds / 1000.0)
-    return utc_now
-
-
 if __name__ == '__main__':
+    started_at = time.time()
     parser = argparse.ArgumentParser()
     parser.add_argument('-bs', '--batch_size', help='Number of records per read, between commits.', type=int, default=5)
     parser.add_argument('-db', '--database_name', help='Database where to store the data', type=str, default='automlpredictor_db_dashboard')
@@ -189,8 +26,27 @@ if __name__ == '__main__':
     )
     parser.add_argument('-s', '--sleep_ms', help='Sleep in millisecs', type=int, default=50)
     parser.add_argument(
-        '-ir', '--impact_recalculation_ms',
-        help='How many millisecs since the last impact recalculation before triggering a new one', type=int, default=30000
+        '-mw', '--max_wait_ms', help='Emit a partial batch this many millisecs after its first record, instead of polling and sleeping',
+        type=int, required=False
+    )
+    parser.add_argument(
+        '-fm', '--framing', help='Input framing. json: any JSON layout (splitstream). ndjson: one record per line, faster.',
+        type=str, default='json', choices=['json', 'ndjson']
+    )
+    parser.add_argument(
+        '-wm', '--write_mode', help='merge: session.merge per row. bulk: one multi-row INSERT ... ON DUPLICATE KEY UPDATE per batch.',
+        type=str, default='merge', choices=['merge', 'bulk']
+    )
+    parser.add_argument(
+        '-sm', '--schema_mode', help='reflect: reflect the whole db. declared: use inference/db_schema.py. cached: reflected metadata cache file.',
+        type=str, default='reflect', choices=['reflect', 'declared', 'cached']
+    )
+    parser.add_argument(
+        '-scf', '--schema_cache_file', help='Metadata cache for schema_mode=cached', type=str, default='automlpredictor_db_schema.pkl'
+    )
+    parser.add_argument(
+        '-is', '--input_socket', help='Listen on this Unix socket for predict_cli, instead of reading stdin or --input_data_file_path',
+        type=str, required=False
     )
     parser.add_argument('-ssh', '--ssh', help='Use ssh', action='store_true', required=False)
 
@@ -198,8 +54,10 @@ if __name__ == '__main__':
     batch_size = int(args.batch_size)
     database_name = str(args.database_name)
     sleep_ms = int(args.sleep_ms)
+    max_wait_ms = args.max_wait_ms
+    framing = str(args.framing)
     input_data_file_path = args.input_data_file_path
-    impact_recalculation_ms = args.impact_recalculation_ms
+    write_mode = str(args.write_mode)
     ssh = args.ssh  # True
     # db = 'automlpredictor_db_dashboard'
     db_host = os.getenv('AUTOMLPREDICTOR_DB_SERVER_IP', '127.0.0.1')
@@ -209,64 +67,54 @@ if __name__ == '__main__':
     ssh_username = os.getenv('AUTOMLPREDICTOR_DB_SSH_USER')
     ssh_password = os.getenv('AUTOMLPREDICTOR_DB_SSH_PASSWORD')
 
-    processed_posts = LRU(50000)
+    record_receiver = transport.RecordReceiver(args.input_socket) if args.input_socket else None
 
     if input_data_file_path:
         input_handle = open(input_data_file_path, 'r')
     else:
         input_handle = sys.stdin
 
-    Base = automap_base()
     engine, ssh_server = db_utils.reconnect_db(ssh, db_host, database_name, db_user, db_password, db_port, ssh_username, ssh_password, 'utf8mb4')
-    Base.prepare(engine, reflect=True)
-    last_impact_recalculation_epoch_ms = get_utc_now()
+    Base = db_schema.prepare_base(engine, str(args.schema_mode), str(args.schema_cache_file))
+    logger.info(f'Schema ready ({args.schema_mode}) {int((time.time() - started_at) * 1000)} ms after startup')
+    first_batch_committed = False
+
+    if record_receiver:
+        batches = record_receiver.batches(batch_size, max_wait_ms)
+    else:
+        batches = message_utils.read_batches(batch_size, input_handle, sleep_ms, max_wait_ms, framing)
 
-    for input_msgs in message_utils.read_json_input(batch_size, input_handle, sleep_ms):
+    for input_msgs in batches:
         # try:
         logger.info(f'Ingesting {len(input_msgs)} messages')
 
         try:
-            session = Session(engine)
-            db_utils.operate_msgs_into_db(Base, session, input_msgs, session.merge)
-            session.close()
+            db_utils.ingest_msgs(Base, engine, input_msgs, write_mode)
+            p50_latency_ms, max_latency_ms = message_utils.end_to_end_latency_ms(input_msgs)
+            logger.info(f'End to end latency since clientReceivedTsMs: p50={p50_latency_ms} ms, max={max_latency_ms} ms')
 
-            df_relevant_posts = get_relevant_posts(ssh, db_host, db_user, db_password, db_port, database_name, ssh_username, ssh_password)
-            # print(df_relevant_posts)
-            relevant_posts = df_relevant_posts.to_dict('records')
-            logger.info(f'Relevant posts: {len(relevant_posts)}')
-            posts_to_update = []
-
-            for relevant_post in relevant_posts:
-                # message_id, conversation_replies, likes_total
-                current_id = relevant_post['message_id']
-                values = {}
-                current_post_prev_version = processed_posts.get(current_id, None)
-
-                if relevant_post != current_post_prev_version:
-                    processed_posts[current_id] = relevant_post
-                    posts_to_update.append((current_id, compute_impact(relevant_post), relevant_post['post_type']))
+            if not first_batch_committed:
+                first_batch_committed = True
+                logger.info(f'Cold start: first batch committed {int((time.time() - started_at) * 1000)} ms after startup')
+        except:
+            logger.error(f'An error occurred while ingesting {len(input_msgs)} messages: {traceback.format_exc()}')
 
-            # Even if the post doesn't change, we may want to recalculate the impact every several seconds
-            delta_since_last_recalculation_ms = get_utc_now() - last_impact_recalculation_epoch_ms
-            logger.info(f'Posts to update: {len(posts_to_update)}. Milisecs since last recalculation: {delta_since_last_recalculation_ms}')
+        logger.info(f'DB pool stats: {db_utils.pool_stats()}')
 
-            if len(posts_to_update) > 0 or delta_since_last_recalculation_ms > impact_recalculation_ms:
-                logger.info(f'Recalculating impact/sentiment')
-                update_impact_in_db(posts_to_update, ssh, db_host, db_user, db_password, db_port, database_name, ssh_username, ssh_password)
-                insert_current_global_sentiment_in_db(ssh, db_host, db_user, db_password, db_port, database_name, ssh_username, ssh_password)
-                last_impact_recalculation_epoch_ms = get_utc_now()
-
-        except:
-            logger.error(f'An error occurred while managing session {session}: {traceback.format_exc()}')
+        if record_receiver:
+            logger.info(f'Transport stats: {record_receiver.stats}')
 
         del input_msgs
-        del session
         gc.collect()
-        logger.info(f'Main loop: Going to sleep for {sleep_ms} milliseconds.')
-        time.sleep(sleep_ms / 1000)
 
-    if ssh:
-        ssh_server.stop()
+        if max_wait_ms is None:
+            logger.info(f'Main loop: Going to sleep for {sleep_ms} milliseconds.')
+            time.sleep(sleep_ms / 1000)
+
+    db_utils.close_pools()
+
+    if record_receiver:
+        record_receiver.close()
 
     if input_handle is not sys.stdin:
         input_handle.close()
@@ -1,9 +1,12 @@
 import argparse
 from inference import message_utils
 from inference import db_utils
+from inference import json_codec
+from inference import topic_filter
+from inference import transport
+from inference.dedup_index import DedupIndex
 
 import gc
-import json
 import sys
 import os
 import time
@@ -15,6 +18,14 @@ import logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+# Dedup keys use msgType[:7], so the same tweet is only predicted once whether it came as twitter-topic or twitter-user.
+# These are the post_type values stored for each of them in analysis_posts_sentiment.
+POST_TYPES_BY_KEY_TYPE = {
+    'stocktw': ['stocktwit'],
+    'twitter': ['twitter-topic', 'twitter-user'],
+}
+
+
 def transform_record_for_prediction(record):
 
     if record['msgType'] == 'stocktwit':
@@ -25,48 +36,89 @@ def transform_record_for_prediction(record):
     return record
 
 
-def filter_input(input_data_file_path, batch_size, sleep_ms, processed_posts):
+def filter_input(input_data_file_path, batch_size, sleep_ms, processed_posts, max_wait_ms=None, framing='json', topic_matcher=None):
     if input_data_file_path:
         input_handle = open(input_data_file_path, 'r')
     else:
         input_handle = sys.stdin
 
-    for input_msgs in message_utils.read_json_input(batch_size, input_handle, sleep_ms):
-        posts_to_inspect = {}
-        # print(input_msgs)
-        for record in input_msgs:
-            try:
-                msg_type = record['msgType']
+    if topic_matcher is None:
+        topic_matcher = topic_filter.TopicMatcher()
 
-                if msg_type in ['stocktwit', 'twitter-topic', 'twitter-user']:  # We'll keep  out for the time being.
-                    # logger.info(f'Detected {record["msgType"]} msg')
-                    if msg_type in ['twitter-topic', 'twitter-user']:
-                        text = str(record['data']['text']).lower()
+    for input_msgs in message_utils.read_batches(batch_size, input_handle, sleep_ms, max_wait_ms, framing):
+        posts_to_inspect = filter_msgs(input_msgs, processed_posts, topic_matcher)
 
-                        # We only target certain topics for the time being.
-                        if not any(topic in text for topic in ['elon musk', 'tesla', 'tsla', 'tslaq', 'elonmusk', 'model 3']):
-                            continue
+        if len(posts_to_inspect) > 0:
+            logger.info(f'Consuming {len(posts_to_inspect)} records for review, filtering and transformation')
+            logger.info(f'Topic filter stats: {topic_matcher.stats()}')
+            yield posts_to_inspect
 
-                        if text[0:3] == 'rt ':
-                            continue
 
-                    # TODO: Generalise to extract fields for other message types
-                    key = (record['msgType'][:7], record['data']['id'])
+def filter_msgs(input_msgs, processed_posts, topic_matcher):
+    """{(key type, post id): record} for the posts of one batch that are on topic and not in processed_posts."""
+    posts_to_inspect = {}
+    candidates = []
+    twitter_texts = []
+    # print(input_msgs)
+    for record in input_msgs:
+        try:
+            msg_type = record['msgType']
 
-                    if key not in processed_posts:
-                        processed_posts.add(key)
-                        posts_to_inspect[key] = record
-            except:
-                logger.error(f'Exception when processing record {record}: {traceback.format_exc()}')
+            if msg_type in ['stocktwit', 'twitter-topic', 'twitter-user']:  # We'll keep  out for the time being.
+                # logger.info(f'Detected {record["msgType"]} msg')
+                if msg_type in ['twitter-topic', 'twitter-user']:
+                    twitter_texts.append(record['data']['text'])
+                    candidates.append((record, len(twitter_texts) - 1))
+                else:
+                    candidates.append((record, None))
+        except:
+            logger.error(f'Exception when processing record {record}: {traceback.format_exc()}')
 
-        if len(posts_to_inspect) > 0:
-            logger.info(f'Consuming {len(posts_to_inspect)} records for review, filtering and transformation')
-            yield posts_to_inspect
+    # We only target certain topics for the time being, and no retweets. Matched for the whole batch in one go.
+    twitter_matches = topic_matcher.match(twitter_texts)
+
+    for record, text_index in candidates:
+        try:
+            if text_index is not None and not twitter_matches[text_index]:
+                continue
+
+            # TODO: Generalise to extract fields for other message types
+            key = (record['msgType'][:7], record['data']['id'])
+
+            if key not in processed_posts:
+                processed_posts.add(key)
+                posts_to_inspect[key] = record
+        except:
+            logger.error(f'Exception when processing record {record}: {traceback.format_exc()}')
+
+    return posts_to_inspect
+
+
+def drop_processed_posts(
+    batch, use_ssh, db_host, db_user, db_password, db_port, db, ssh_username, ssh_password, lookup_chunk_size=500
+):
+    """Remove from batch, in place, the posts already stored in analysis_posts_sentiment (several hundred per batch tops)."""
+    ids_by_key_type = {}
+
+    for key_type, post_id in batch.keys():
+        ids_by_key_type.setdefault(key_type, []).append(post_id)
+
+    for key_type, post_ids in ids_by_key_type.items():
+        try:
+            old_ids = db_utils.existing_post_ids(
+                use_ssh, POST_TYPES_BY_KEY_TYPE.get(key_type, [key_type]), post_ids,
+                db_host, db_user, db_password, db_port, db, ssh_username, ssh_password, chunk_size=lookup_chunk_size
+            )
+
+            for post_id in old_ids:
+                batch.pop((key_type, post_id), None)
+        except:
+            logger.error(f'Exception when looking up {len(post_ids)} {key_type} posts: {traceback.format_exc()}')
+
+    return batch
 
 
 if __name__ == '__main__':
-    # At some stage, we may need to use some LRU/or distributed data structure, but not yet.
-    processed_posts = set({})
     ssh_username = os.getenv('AUTOMLPREDICTOR_DB_SSH_USER')
     ssh_password = os.getenv('AUTOMLPREDICTOR_DB_SSH_PASSWORD')
 
@@ -84,6 +136,33 @@ if __name__ == '__main__':
         type=str, required=False
     )
     parser.add_argument('-s', '--sleep_ms', help='Sleep in millisecs', type=int, default=1000)
+    parser.add_argument(
+        '-mw', '--max_wait_ms', help='Emit a partial batch this many millisecs after its first record, instead of polling and sleeping',
+        type=int, required=False
+    )
+    parser.add_argument(
+        '-fm', '--framing', help='Input framing. json: any JSON layout (splitstream). ndjson: one record per line, faster.',
+        type=str, default='json', choices=['json', 'ndjson']
+    )
+    parser.add_argument(
+        '-t', '--topics', help=f'Comma separated topics to keep tweets for. Defaults to {",".join(topic_filter.DEFAULT_TOPICS)}',
+        type=str, required=False
+    )
+    parser.add_argument('-tf', '--topics_file_path', help='File with one topic per line, added to --topics', type=str, required=False)
+    parser.add_argument('-dc', '--dedup_capacity', help='Post keys per dedup index partition', type=int, default=1000000)
+    parser.add_argument('-dfp', '--dedup_fp_rate', help='Target false positive rate per dedup index partition', type=float, default=1e-6)
+    parser.add_argument('-dp', '--dedup_partitions', help='Dedup index partitions. Memory is fixed at partitions x partition size', type=int, default=4)
+    parser.add_argument('-dps', '--dedup_partition_seconds', help='Seconds before a new dedup index partition is started', type=int, default=6 * 3600)
+    parser.add_argument(
+        '-dsf', '--dedup_snapshot_file_path', help='Dedup index snapshot, loaded at startup and saved periodically. No persistence if not specified',
+        type=str, required=False
+    )
+    parser.add_argument('-dsi', '--dedup_snapshot_interval_seconds', help='Seconds between dedup index snapshots', type=int, default=300)
+    parser.add_argument('-lcs', '--lookup_chunk_size', help='Post ids per already processed lookup query', type=int, default=500)
+    parser.add_argument(
+        '-os', '--output_socket', help='Send the records to predict_cli on this Unix socket, instead of printing them to stdout',
+        type=str, required=False
+    )
     parser.add_argument('-ssh', '--ssh', help='Use ssh', action='store_true', required=False)
 
     args = parser.parse_args()
@@ -91,36 +170,56 @@ if __name__ == '__main__':
     batch_size = int(args.batch_size)
     db = str(args.database_name)
     sleep_ms = int(args.sleep_ms)
+    max_wait_ms = args.max_wait_ms
+    framing = str(args.framing)
     use_ssh = args.ssh  # True
+    lookup_chunk_size = int(args.lookup_chunk_size)
+    topic_matcher = topic_filter.TopicMatcher(topic_filter.load_topics(args.topics, args.topics_file_path))
+    logger.info(f'Filtering tweets on {len(topic_matcher.topics)} topics')
+    # Bounded replacement for the set of processed (post_type, post_id) keys. The db check below still catches the rest.
+    processed_posts = DedupIndex(
+        int(args.dedup_capacity), float(args.dedup_fp_rate), int(args.dedup_partitions), int(args.dedup_partition_seconds),
+        args.dedup_snapshot_file_path, int(args.dedup_snapshot_interval_seconds)
+    )
+    logger.info(f'Dedup index ready: {processed_posts.stats()}')
+    record_sender = transport.RecordSender(args.output_socket) if args.output_socket else None
 
     while True:
 
-        for batch in filter_input(input_data_file_path, batch_size, sleep_ms, processed_posts):
+        for batch in filter_input(input_data_file_path, batch_size, sleep_ms, processed_posts, max_wait_ms, framing, topic_matcher):
 
             if batch and len(batch)>0:
-                # Now we'll check in the db if we already processed them (several hundred per batch tops).
-                ids = ', '.join(list(map(lambda x: f"('{x[0]}', {x[1]})", batch.keys())))
-                old_ids_sql = f'SELECT post_type, post_id FROM analysis_posts_sentiment WHERE (post_type, post_id) IN ({ids})'
-
-                try:
-                    df_old_ids = db_utils.query(use_ssh, old_ids_sql, db_host, db_user, db_password, db_port, db, ssh_username, ssh_password)
-
-                    for _, row in df_old_ids.iterrows():
-                        batch.pop((row['post_type'], row['post_id']))
-                except:
-                    logger.error(f'Exception associated to query {old_ids_sql}: {traceback.format_exc()}')
+                # Now we'll check in the db if we already processed them.
+                drop_processed_posts(
+                    batch, use_ssh, db_host, db_user, db_password, db_port, db, ssh_username, ssh_password, lookup_chunk_size
+                )
 
                 logger.info(f'Emitting {len(batch)} records for inference')
+                logger.info(f'Dedup index stats: {processed_posts.stats()}')
+                logger.info(f'DB pool stats: {db_utils.pool_stats()}')
 
-                for key, record in batch.items():
-                    print(json.dumps(transform_record_for_prediction(record)))
+                if record_sender:
+                    record_sender.send([transform_record_for_prediction(record) for record in batch.values()])
+                    logger.info(f'Transport stats: {record_sender.stats}')
+                else:
+                    for key, record in batch.items():
+                        print(json_codec.dumps(transform_record_for_prediction(record)))
 
+                    sys.stdout.flush()
                 del batch
 
+            processed_posts.maybe_snapshot()
             gc.collect()
-            logger.info(f'Main loop: Going to sleep for {sleep_ms} milliseconds.')
-            time.sleep(sleep_ms / 1000)
-
 
+            if max_wait_ms is None:
+                logger.info(f'Main loop: Going to sleep for {sleep_ms} milliseconds.')
+                time.sleep(sleep_ms / 1000)
 
+        # The timed reader follows regular files forever, so it only ends at the end of a pipe or stdin: reading again
+        # would spin, starting a reader thread per pass.
+        if max_wait_ms is not None:
+            logger.info('End of input')
+            break
 
+    if args.dedup_snapshot_file_path:
+        processed_posts.save_snapshot()
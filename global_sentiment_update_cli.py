@@ -0,0 +1,100 @@
+import argparse
+from inference import db_utils
+from inference.global_sentiment import ImpactRecalculator, RecomputeScheduler
+import os
+import sys
+import time
+sys.excepthook = sys.__excepthook__ # See https://groups.io/g/insync/topic/13778827?p=,,,20,0,0,0::recentpostdate%2Fsticky,,,20,2,0,13778827
+
+import traceback
+import logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+
+def get_last_received_epoch_ms(use_ssh, db_host, db_user, db_password, db_port, database_name, ssh_username, ssh_password):
+    # Cheap (indexed) probe for newly ingested posts.
+    df = db_utils.query(
+        use_ssh, 'SELECT MAX(client_received_epoch_ms) AS last_received_epoch_ms FROM analysis_posts_sentiment',
+        db_host, db_user, db_password, db_port, database_name, ssh_username, ssh_password
+    )
+
+    return df['last_received_epoch_ms'][0]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-db', '--database_name', help='Database where to store the data', type=str, default='automlpredictor_db_dashboard')
+    parser.add_argument('-p', '--poll_ms', help='Millisecs between checks for newly ingested posts', type=int, default=1000)
+    parser.add_argument('-mi', '--min_interval_ms', help='Min millisecs between recompute cycles. Requests in between are coalesced.', type=int, default=5000)
+    parser.add_argument(
+        '-ir', '--impact_recalculation_ms',
+        help='How many millisecs since the last impact recalculation before triggering a new one, even without new posts', type=int, default=30000
+    )
+    parser.add_argument(
+        '-inc', '--incremental_impact', help='Only fetch the posts changed since the last per post type watermark', action='store_true', required=False
+    )
+    parser.add_argument(
+        '-wc', '--watermark_column', help='Column of the *_rt tables used as watermark in incremental mode', type=str, default='client_received_ts_ms'
+    )
+    parser.add_argument('-wo', '--watermark_overlap_ms', help='How far behind the max seen value the watermarks are kept', type=int, default=5000)
+    parser.add_argument(
+        '-fr', '--full_resync_ms',
+        help='Millisecs between full rescans of the 12 hours window (incremental mode)', type=int, default=600000
+    )
+    parser.add_argument(
+        '-ra', '--rolling_aggregator', help='Compute the stocktwits/twitter global sentiment with the in-process sliding window aggregator',
+        action='store_true', required=False
+    )
+    parser.add_argument(
+        '-arb', '--aggregator_rebuild_ms', help='Millisecs between rebuilds of the rolling aggregator from the db', type=int, default=600000
+    )
+    parser.add_argument(
+        '-sw', '--sentiment_windows', help='Comma separated sliding windows, in seconds, for the rolling aggregator', type=str, default='43200'
+    )
+    parser.add_argument(
+        '-vgs', '--verify_global_sentiment', help='Log the rolling aggregator averages next to the ones computed by MySQL', action='store_true',
+        required=False
+    )
+    parser.add_argument('-ics', '--impact_chunk_size', help='Rows per bulk impact statement', type=int, default=1000)
+    parser.add_argument(
+        '-iwm', '--impact_write_mode', help='join: staging table + UPDATE JOIN. executemany: parameterised UPDATE per row.',
+        type=str, default='join', choices=['join', 'executemany']
+    )
+    parser.add_argument('-ssh', '--ssh', help='Use ssh', action='store_true', required=False)
+
+    args = parser.parse_args()
+    database_name = str(args.database_name)
+    poll_ms = int(args.poll_ms)
+    ssh = args.ssh  # True
+    db_host = os.getenv('AUTOMLPREDICTOR_DB_SERVER_IP', '127.0.0.1')
+    db_user = os.getenv('AUTOMLPREDICTOR_DB_SQL_USER', 'root')
+    db_password = os.getenv('AUTOMLPREDICTOR_DB_SQL_PASSWORD')
+    db_port = 3306
+    ssh_username = os.getenv('AUTOMLPREDICTOR_DB_SSH_USER')
+    ssh_password = os.getenv('AUTOMLPREDICTOR_DB_SSH_PASSWORD')
+    db_args = (ssh, db_host, db_user, db_password, db_port, database_name, ssh_username, ssh_password)
+
+    recalculator = ImpactRecalculator(
+        db_args, args.incremental_impact, str(args.watermark_column), int(args.watermark_overlap_ms), int(args.full_resync_ms),
+        args.rolling_aggregator, [int(w) for w in str(args.sentiment_windows).split(',')], args.verify_global_sentiment,
+        int(args.impact_chunk_size), str(args.impact_write_mode), aggregator_rebuild_ms=int(args.aggregator_rebuild_ms)
+    )
+    scheduler = RecomputeScheduler(recalculator.run_cycle, int(args.min_interval_ms), int(args.impact_recalculation_ms)).start()
+    last_received_epoch_ms = None
+
+    try:
+        while True:
+            try:
+                current_received_epoch_ms = get_last_received_epoch_ms(*db_args)
+
+                if current_received_epoch_ms != last_received_epoch_ms:
+                    last_received_epoch_ms = current_received_epoch_ms
+                    scheduler.request()
+            except:
+                logger.error(f'Exception when polling for new posts: {traceback.format_exc()}')
+
+            time.sleep(poll_ms / 1000)
+    finally:
+        scheduler.stop()
+        db_utils.close_pools()
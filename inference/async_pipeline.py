@@ -0,0 +1,156 @@
+import asyncio
+import collections
+import threading
+import time
+import traceback
+import logging
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+def percentile(values, fraction):
+    if not values:
+        return None
+
+    ordered = sorted(values)
+    return ordered[min(int(len(ordered) * fraction), len(ordered) - 1)]
+
+
+class Stage:
+    """One step of an AsyncPipeline: concurrency workers taking batches from a bounded queue and running work(batch) in
+    executor, so that a slow step only fills its own queue instead of stalling the event loop.
+
+    work returns the batch for the next stage. None or an empty batch isn't passed on.
+    """
+
+    def __init__(self, name, work, executor, concurrency=1, queue_size=10):
+        self.name = name
+        self.work = work
+        self.executor = executor
+        self.concurrency = concurrency
+        self.queue_size = queue_size
+        self.queue = None
+        self.next_stage = None
+        self.wait_ms = collections.deque(maxlen=1000)
+        self.work_ms = collections.deque(maxlen=1000)
+        self.counts = {'batches': 0, 'records': 0, 'failures': 0}
+
+    async def put(self, batch):
+        await self.queue.put((time.time(), batch))
+
+    async def run_worker(self):
+        loop = asyncio.get_event_loop()
+
+        while True:
+            enqueued_at, batch = await self.queue.get()
+            started_at = time.time()
+            self.wait_ms.append(int((started_at - enqueued_at) * 1000))
+
+            try:
+                output = await loop.run_in_executor(self.executor, self.work, batch)
+                self.counts['batches'] += 1
+                self.counts['records'] += len(batch)
+
+                if output and self.next_stage:
+                    await self.next_stage.put(output)
+            except Exception:
+                self.counts['failures'] += 1
+                logger.error(f'Stage {self.name} failed on a batch of {len(batch)}: {traceback.format_exc()}')
+            finally:
+                self.work_ms.append(int((time.time() - started_at) * 1000))
+                self.queue.task_done()
+
+    def stats(self):
+        return {
+            **self.counts,
+            'queue_depth': self.queue.qsize() if self.queue else 0,
+            'queue_size': self.queue_size,
+            'wait_p50_ms': percentile(self.wait_ms, 0.5),
+            'work_p50_ms': percentile(self.work_ms, 0.5),
+            'work_max_ms': max(self.work_ms) if self.work_ms else None,
+        }
+
+
+class AsyncPipeline:
+    """Feeds the batches of a blocking source iterator through a chain of stages, in one process.
+
+    The source is read on a daemon thread, which stops reading while the first queue is full, so backpressure reaches
+    the input. Ends when the source does and every queue has drained.
+    """
+
+    def __init__(self, source, stages, stats_interval_s=60):
+        self.source = source
+        self.stages = stages
+        self.stats_interval_s = stats_interval_s
+        self.source_batches = 0
+
+        for stage, next_stage in zip(stages, stages[1:] + [None]):
+            stage.next_stage = next_stage
+
+    async def read_source(self):
+        loop = asyncio.get_event_loop()
+        done = loop.create_future()
+
+        def finish(set_outcome, *args):
+            if not done.done():
+                set_outcome(*args)
+
+        def read():
+            try:
+                for batch in self.source:
+                    self.source_batches += 1
+
+                    if batch:
+                        asyncio.run_coroutine_threadsafe(self.stages[0].put(batch), loop).result()
+
+                outcome = (done.set_result, None)
+            except Exception as e:
+                outcome = (done.set_exception, e)
+
+            try:
+                loop.call_soon_threadsafe(finish, *outcome)
+            except RuntimeError:
+                pass  # The loop is closed already: the pipeline was interrupted.
+
+        # Not an executor thread: it's mostly blocked reading the input, and mustn't hold up the exit on Ctrl-C or SIGTERM.
+        threading.Thread(target=read, name='pipeline-source', daemon=True).start()
+        await done
+
+    async def log_stats(self):
+        while True:
+            await asyncio.sleep(self.stats_interval_s)
+            logger.info(f'Pipeline stats: {self.stats()}')
+
+    def stats(self):
+        return {'source_batches': self.source_batches, **{stage.name: stage.stats() for stage in self.stages}}
+
+    async def run_async(self):
+        for stage in self.stages:
+            stage.queue = asyncio.Queue(maxsize=stage.queue_size)
+
+        workers = [
+            asyncio.ensure_future(stage.run_worker()) for stage in self.stages for _ in range(stage.concurrency)
+        ]
+        workers.append(asyncio.ensure_future(self.log_stats()))
+
+        try:
+            await self.read_source()
+
+            # In order: a stage's queue can only grow again while the stages before it are still busy.
+            for stage in self.stages:
+                await stage.queue.join()
+        finally:
+            for worker in workers:
+                worker.cancel()
+
+            await asyncio.gather(*workers, return_exceptions=True)
+            logger.info(f'Pipeline stats: {self.stats()}')
+
+    def run(self):
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+
+        try:
+            loop.run_until_complete(self.run_async())
+        finally:
+            loop.close()
@@ -0,0 +1,95 @@
+import os
+import pickle
+from sqlalchemy import BigInteger, Column, MetaData, Numeric, String, Table, Text
+from sqlalchemy.ext.automap import automap_base
+
+import traceback
+import logging
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+# Bump whenever inference/SQL changes the tables below, so that stale metadata caches are discarded.
+SCHEMA_VERSION = '20180918.1'
+
+TABLE_NAMES = ['analysis_posts_sentiment', 'analysis_global_sentiment']
+
+
+def declared_metadata() -> MetaData:
+    """Tables used by the ingestor, as created by inference/SQL."""
+    metadata = MetaData()
+
+    Table(
+        'analysis_posts_sentiment', metadata,
+        Column('post_type', String(30), primary_key=True),
+        Column('post_id', BigInteger, primary_key=True, autoincrement=False),
+        Column('body', Text, nullable=True),
+        Column('impact', Numeric(10, 2), nullable=True),
+        Column('link', Text, nullable=False),
+        Column('user_name', String(64), nullable=False),
+        Column('created_at_epoch_ms', BigInteger, nullable=False),
+        Column('sentiment_ml_model', Numeric(5, 2), nullable=True),
+        Column('sentiment_vader_normalized', Numeric(5, 2), nullable=True),
+        Column('sentiment_mixed', Numeric(5, 2), nullable=True),
+        Column('client_received_epoch_ms', BigInteger, nullable=False),
+    )
+
+    Table(
+        'analysis_global_sentiment', metadata,
+        Column('sentiment_type', String(30), primary_key=True),
+        Column('sentiment_seconds_back', BigInteger, primary_key=True, autoincrement=False),
+        Column('created_at_epoch_ms', BigInteger, primary_key=True, autoincrement=False),
+        Column('sentiment_absolute', Numeric(10, 3), nullable=True),
+        Column('sentiment_normalized', Numeric(5, 3), nullable=True),
+    )
+
+    return metadata
+
+
+def cached_metadata(engine, schema_cache_file) -> MetaData:
+    """Reflected metadata of TABLE_NAMES, pickled into schema_cache_file and reused while SCHEMA_VERSION matches."""
+    if os.path.exists(schema_cache_file):
+        try:
+            with open(schema_cache_file, 'rb') as f:
+                schema_version, metadata = pickle.load(f)
+
+            if schema_version == SCHEMA_VERSION:
+                return metadata
+
+            logger.info(f'Schema cache {schema_cache_file} has version {schema_version}, expected {SCHEMA_VERSION}. Reflecting again.')
+        except Exception:
+            logger.warning(f'Could not load schema cache {schema_cache_file}: {traceback.format_exc()}')
+
+    metadata = MetaData()
+    metadata.reflect(engine, only=TABLE_NAMES)
+
+    tmp_file = f'{schema_cache_file}.tmp'
+
+    with open(tmp_file, 'wb') as f:
+        pickle.dump((SCHEMA_VERSION, metadata), f)
+
+    os.replace(tmp_file, schema_cache_file)
+
+    return metadata
+
+
+def prepare_base(engine, schema_mode='reflect', schema_cache_file=None):
+    """Automap base for the db.
+
+    Args:
+        engine: SQLAlchemy engine
+        schema_mode (str): reflect: reflect the whole schema (slow over the SSH tunnel).
+            declared: use the tables declared in this module, without touching the db.
+            cached: reflect TABLE_NAMES once and reuse the pickled metadata in schema_cache_file.
+        schema_cache_file (str): path of the metadata cache, for schema_mode=cached
+    """
+    if schema_mode == 'reflect':
+        base = automap_base()
+        base.prepare(engine, reflect=True)
+        return base
+
+    metadata = declared_metadata() if schema_mode == 'declared' else cached_metadata(engine, schema_cache_file)
+    base = automap_base(metadata=metadata)
+    base.prepare()
+
+    return base
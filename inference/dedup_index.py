@@ -0,0 +1,194 @@
+import hashlib
+import math
+import os
+import pickle
+import time
+from typing import Hashable, Optional
+
+import traceback
+import logging
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_VERSION = 1
+
+
+def bloom_parameters(capacity: int, fp_rate: float):
+    """Bits and hash functions for a Bloom filter holding capacity items at fp_rate."""
+    n_bits = int(math.ceil(-capacity * math.log(fp_rate) / (math.log(2) ** 2)))
+    n_bits = max(64, (n_bits + 7) // 8 * 8)
+    n_hashes = max(1, int(round(n_bits / capacity * math.log(2))))
+    return n_bits, n_hashes
+
+
+class BloomPartition:
+    def __init__(self, n_bits: int, n_hashes: int, started_at: float):
+        self.n_bits = n_bits
+        self.n_hashes = n_hashes
+        self.started_at = started_at
+        self.count = 0
+        self.bits = bytearray(n_bits // 8)
+
+    def positions(self, digest: bytes):
+        # Kirsch-Mitzenmacher double hashing over the two halves of a 128 bit digest.
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return [(h1 + i * h2) % self.n_bits for i in range(self.n_hashes)]
+
+    def contains(self, digest: bytes) -> bool:
+        bits = self.bits
+        return all(bits[p >> 3] & (1 << (p & 7)) for p in self.positions(digest))
+
+    def add(self, digest: bytes):
+        bits = self.bits
+
+        for p in self.positions(digest):
+            bits[p >> 3] |= 1 << (p & 7)
+
+        self.count += 1
+
+    def fp_rate(self) -> float:
+        return (1 - math.exp(-self.n_hashes * self.count / self.n_bits)) ** self.n_hashes
+
+
+class DedupIndex:
+    """Fixed-memory set of already seen post keys, a drop-in for the unbounded processed_posts set.
+
+    It is a time partitioned Bloom filter: keys are added to the newest of n_partitions filters, and a new partition
+    replaces the oldest one once the newest is partition_seconds old or holds capacity keys. Lookups check every
+    partition, so a key is remembered for between (n_partitions - 1) and n_partitions partition lifetimes. There are no
+    false negatives within that horizon, and false positives (a new post taken as seen) happen at about fp_rate per
+    partition. The index can be snapshotted to disk so that restarts are warm.
+    """
+
+    def __init__(
+        self, capacity: int=1000000, fp_rate: float=1e-6, n_partitions: int=4, partition_seconds: int=6 * 3600,
+        snapshot_file_path: Optional[str]=None, snapshot_interval_seconds: int=300
+    ):
+        if capacity <= 0 or not 0 < fp_rate < 1 or n_partitions <= 0:
+            raise ValueError(f'Invalid DedupIndex parameters: capacity={capacity}, fp_rate={fp_rate}, n_partitions={n_partitions}')
+
+        self.capacity = capacity
+        self.target_fp_rate = fp_rate
+        self.n_partitions = n_partitions
+        self.partition_seconds = partition_seconds
+        self.n_bits, self.n_hashes = bloom_parameters(capacity, fp_rate)
+        self.partitions = [BloomPartition(self.n_bits, self.n_hashes, time.time())]
+        self.snapshot_file_path = snapshot_file_path
+        self.snapshot_interval_seconds = snapshot_interval_seconds
+        self.last_snapshot_at = time.time()
+        self.lookups = 0
+        self.hits = 0
+        self.rotations = 0
+
+        if snapshot_file_path and os.path.exists(snapshot_file_path):
+            self.load_snapshot(snapshot_file_path)
+
+    @staticmethod
+    def digest(key: Hashable) -> bytes:
+        return hashlib.blake2b(repr(key).encode('utf-8'), digest_size=16).digest()
+
+    def rotate_if_needed(self, now: Optional[float]=None):
+        now = time.time() if now is None else now
+        newest = self.partitions[-1]
+
+        if newest.count >= self.capacity or now - newest.started_at >= self.partition_seconds:
+            self.partitions.append(BloomPartition(self.n_bits, self.n_hashes, now))
+            self.rotations += 1
+
+            if len(self.partitions) > self.n_partitions:
+                self.partitions.pop(0)
+
+        # After a long stop (warm restart), partitions older than the whole horizon are dropped.
+        horizon = self.n_partitions * self.partition_seconds
+
+        while len(self.partitions) > 1 and now - self.partitions[0].started_at >= horizon:
+            self.partitions.pop(0)
+
+    def __contains__(self, key: Hashable) -> bool:
+        digest = self.digest(key)
+        self.lookups += 1
+
+        if any(partition.contains(digest) for partition in reversed(self.partitions)):
+            self.hits += 1
+            return True
+
+        return False
+
+    def add(self, key: Hashable, now: Optional[float]=None):
+        self.rotate_if_needed(now)
+        self.partitions[-1].add(self.digest(key))
+
+    def fp_rate(self) -> float:
+        """Estimated probability that a never seen key is reported as seen, given the current fill."""
+        p_miss_all = 1.0
+
+        for partition in self.partitions:
+            p_miss_all *= 1 - partition.fp_rate()
+
+        return 1 - p_miss_all
+
+    def memory_bytes(self) -> int:
+        """Bytes of filter state once all partitions exist. This is the fixed budget, whatever the uptime."""
+        return self.n_partitions * self.n_bits // 8
+
+    def stats(self) -> dict:
+        return {
+            'keys': sum(partition.count for partition in self.partitions),
+            'partitions': len(self.partitions),
+            'rotations': self.rotations,
+            'lookups': self.lookups,
+            'hits': self.hits,
+            'estimated_fp_rate': self.fp_rate(),
+            'memory_budget_mb': round(self.memory_bytes() / 1024 / 1024, 2),
+        }
+
+    def save_snapshot(self, snapshot_file_path: Optional[str]=None):
+        snapshot_file_path = snapshot_file_path or self.snapshot_file_path
+        state = {
+            'version': SNAPSHOT_VERSION,
+            'n_bits': self.n_bits,
+            'n_hashes': self.n_hashes,
+            'partitions': [(p.started_at, p.count, bytes(p.bits)) for p in self.partitions],
+        }
+        # Written next to the target and renamed, so that a crash never leaves a truncated snapshot behind.
+        tmp_file_path = f'{snapshot_file_path}.tmp'
+
+        with open(tmp_file_path, 'wb') as f:
+            pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+        os.replace(tmp_file_path, snapshot_file_path)
+        self.last_snapshot_at = time.time()
+        logger.info(f'Saved dedup index snapshot to {snapshot_file_path}: {self.stats()}')
+
+    def load_snapshot(self, snapshot_file_path: str):
+        try:
+            with open(snapshot_file_path, 'rb') as f:
+                state = pickle.load(f)
+
+            if (state.get('version'), state.get('n_bits'), state.get('n_hashes')) != (SNAPSHOT_VERSION, self.n_bits, self.n_hashes):
+                logger.warning(f'Ignoring dedup index snapshot {snapshot_file_path}: it was built with other parameters')
+                return
+
+            partitions = []
+
+            for started_at, count, bits in state['partitions'][-self.n_partitions:]:
+                partition = BloomPartition(self.n_bits, self.n_hashes, started_at)
+                partition.count = count
+                partition.bits = bytearray(bits)
+                partitions.append(partition)
+
+            if partitions:
+                self.partitions = partitions
+                self.rotate_if_needed()
+
+            logger.info(f'Loaded dedup index snapshot from {snapshot_file_path}: {self.stats()}')
+        except Exception:
+            logger.warning(f'Ignoring unreadable dedup index snapshot {snapshot_file_path}: {traceback.format_exc()}')
+
+    def maybe_snapshot(self, now: Optional[float]=None):
+        now = time.time() if now is None else now
+
+        if self.snapshot_file_path and now - self.last_snapshot_at >= self.snapshot_interval_seconds:
+            self.save_snapshot()
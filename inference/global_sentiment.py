@@ -0,0 +1,493 @@
+from datetime import datetime
+import gc
+import threading
+import time
+from inference import db_utils
+from inference.sentiment_window import RollingSentimentAggregator
+from lru import LRU
+from typing import Callable, Dict, List, Tuple
+
+import traceback
+import logging
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+
+RELEVANT_POST_SOURCES = [
+    # post_type, table, id column, interactions column, likes column
+    ('stocktwit', 'data_stocktwits_posts_rt', 'message_id', 'conversation_replies', 'likes_total'),
+    ('twitter-user', 'data_twitter_users_rt', 'tweet_id', 'retweet_count', 'favorite_count'),
+    ('twitter-topic', 'data_twitter_topics_rt', 'tweet_id', 'retweet_count', 'favorite_count'),
+]
+
+
+def get_relevant_posts(
+    use_ssh, db_host, db_user, db_password, db_port, database_name, ssh_username, ssh_password,
+    since_ts_ms_by_type: Dict[str, int]=None, watermark_column='client_received_ts_ms'
+):
+    """Get the interactions of the posts of the last 12 hours.
+
+    If since_ts_ms_by_type is given, only the posts with interactions changed (or received) after the watermark of
+    their post type are returned. Every row comes with the max watermark column value it was built from (NULL if
+    watermark_column is None).
+    """
+    relevant_posts_by_source_sql = []
+
+    for post_type, table, id_column, interactions_column, likes_column in RELEVANT_POST_SOURCES:
+        source_sql = f'''
+    SELECT '{post_type}' as post_type, {id_column} as message_id, {interactions_column} as interaction_total, {likes_column} as likes_total,
+    {watermark_column or 'NULL'} as watermark FROM {table}
+    WHERE {id_column} IN (SELECT post_id FROM analysis_posts_sentiment 
+    WHERE created_at_epoch_ms >=(SELECT UNIX_TIMESTAMP(NOW())*1000-(12*3600*1000)) AND post_type = '{post_type}')'''
+
+        if since_ts_ms_by_type is not None:
+            since_ts_ms = int(since_ts_ms_by_type[post_type])
+            source_sql += f'''
+    AND ({watermark_column} > {since_ts_ms} OR {id_column} IN (SELECT post_id FROM analysis_posts_sentiment
+    WHERE client_received_epoch_ms > {since_ts_ms} AND post_type = '{post_type}'))'''
+
+        relevant_posts_by_source_sql.append(source_sql)
+
+    union_sql = '\n\n    UNION\n'.join(relevant_posts_by_source_sql)
+    relevant_posts_sql = f'''
+
+    SELECT post_type, message_id, MAX(interaction_total) as interaction_total, MAX(likes_total) as likes_total,
+    MAX(watermark) as watermark FROM
+    ({union_sql}
+    ) impact 
+    GROUP BY post_type, message_id;
+
+  '''
+
+    df_relevant_posts = db_utils.query(use_ssh, relevant_posts_sql, db_host, db_user, db_password, db_port, database_name, ssh_username, ssh_password)
+
+    gc.collect()
+
+    return df_relevant_posts
+
+
+def update_watermarks(watermarks: Dict[str, int], relevant_posts: List[Dict[str, object]], default_ts_ms, overlap_ms) -> Dict[str, int]:
+    """Advance the per post type high-water marks, and remove the watermark column from relevant_posts.
+
+    The watermarks are kept overlap_ms behind the max value seen, so that rows committed late are picked up by the next
+    incremental query (the processed_posts LRU filters out the repetitions).
+    """
+    new_watermarks = {post_type: watermarks.get(post_type, default_ts_ms) for post_type, *_ in RELEVANT_POST_SOURCES}
+
+    for relevant_post in relevant_posts:
+        watermark = relevant_post.pop('watermark', None)
+
+        if watermark is not None and watermark == watermark:  # NaN check
+            post_type = relevant_post['post_type']
+            new_watermarks[post_type] = max(new_watermarks[post_type], int(watermark) - overlap_ms)
+
+    return new_watermarks
+
+
+def update_impact_in_db(
+    posts_to_update: List[Tuple[int, float, str]], use_ssh, db_host, db_user, db_password, db_port, database_name, ssh_username, ssh_password,
+    chunk_size=1000, write_mode='join'
+):
+    if len(posts_to_update) == 0:
+        return
+
+    rows = [(post_type, int(post_id), float(impact)) for (post_id, impact, post_type) in posts_to_update]
+
+    if write_mode == 'join':
+        # Bulk load the new impacts into a staging table (one multi-row INSERT per chunk) and apply them in one UPDATE.
+        operations = [
+            ('DROP TEMPORARY TABLE IF EXISTS tmp_posts_impact', None),
+            (
+                # Same charset and collation as analysis_posts_sentiment, so that the join can use its primary key.
+                'CREATE TEMPORARY TABLE tmp_posts_impact (post_type VARCHAR(30) CHARACTER SET utf8mb4 COLLATE utf8mb4_unicode_ci NOT NULL, '
+                'post_id BIGINT(22) NOT NULL, '
+                'impact DECIMAL(10,2), PRIMARY KEY (`post_type`, `post_id`)) ENGINE=MEMORY',
+                None
+            ),
+        ]
+        operations.extend(
+            ('INSERT INTO tmp_posts_impact (post_type, post_id, impact) VALUES (%s, %s, %s)', chunk)
+            for chunk in db_utils.chunks(rows, chunk_size)
+        )
+        operations.extend([
+            (
+                'UPDATE analysis_posts_sentiment a JOIN tmp_posts_impact t ON a.post_type = t.post_type AND a.post_id = t.post_id '
+                'SET a.impact = t.impact',
+                None
+            ),
+            ('DROP TEMPORARY TABLE IF EXISTS tmp_posts_impact', None),
+        ])
+    else:
+        operations = [
+            (
+                'UPDATE analysis_posts_sentiment SET impact=%s WHERE post_type=%s AND post_id=%s',
+                [(impact, post_type, post_id) for (post_type, post_id, impact) in chunk]
+            )
+            for chunk in db_utils.chunks(rows, chunk_size)
+        ]
+
+    logger.info(f'Running updates: {len(rows)} rows in {len(operations)} statements ({write_mode})')
+    db_utils.execute_many(use_ssh, operations, db_host, db_user, db_password, db_port, database_name, ssh_username, ssh_password)
+    logger.info(f'Completed updates: {len(rows)}')
+
+
+def insert_current_global_sentiment_in_db(
+    use_ssh, db_host, db_user, db_password, db_port, database_name, ssh_username, ssh_password,
+    aggregator: RollingSentimentAggregator=None
+):
+    """Insert the current global sentiment rows.
+
+    If an aggregator is given, the stocktwits/twitter rows (one per window) come from it, instead of rescanning
+    analysis_posts_sentiment.
+    """
+    sql_for_insert_stocktwits = """
+        INSERT INTO analysis_global_sentiment(sentiment_type, sentiment_seconds_back, created_at_epoch_ms, sentiment_absolute)
+        (SELECT 'stocktwits', 12*3600, UNIX_TIMESTAMP(NOW())*1000, AVG(impact*(sentiment_mixed-0.5))
+        FROM analysis_posts_sentiment 
+        WHERE created_at_epoch_ms >=(SELECT UNIX_TIMESTAMP(NOW())*1000-(12*3600*1000)) AND post_type IN ('stocktwit'));       
+    """
+
+    sql_for_insert_twitter = """
+        INSERT INTO analysis_global_sentiment(sentiment_type, sentiment_seconds_back, created_at_epoch_ms, sentiment_absolute)
+        (SELECT 'twitter', 12*3600, UNIX_TIMESTAMP(NOW())*1000, AVG(impact*(sentiment_mixed-0.5))
+        FROM analysis_posts_sentiment
+        WHERE created_at_epoch_ms >=(SELECT UNIX_TIMESTAMP(NOW())*1000-(12*3600*1000)) AND post_type IN ('twitter-topic', 'twitter-user'));
+    """
+
+    sql_for_insert_social_teslamonitor = """
+        INSERT INTO analysis_global_sentiment(sentiment_type, sentiment_seconds_back, created_at_epoch_ms, sentiment_absolute)
+        (
+            SELECT 'social_teslamonitor', sentiment_seconds_back, UNIX_TIMESTAMP(NOW())*1000, 
+            50*AVG(0.5+sentiment_absolute)
+            FROM analysis_global_sentiment
+            WHERE created_at_epoch_ms >=(SELECT UNIX_TIMESTAMP(NOW())*1000-(sentiment_seconds_back*1000))
+            AND sentiment_type IN ('twitter', 'stocktwits')
+            GROUP BY sentiment_seconds_back
+        );
+    """
+
+    # Stocktweets ranges between 0 and 100.
+    # Stockfluence ranges between 0 and 200.
+
+    sql_for_insert_social_external_ensemble = """
+        INSERT INTO analysis_global_sentiment(sentiment_type, sentiment_seconds_back, created_at_epoch_ms, sentiment_absolute)
+        (
+            SELECT 'social_external_ensemble', 12*3600, UNIX_TIMESTAMP(NOW())*1000, 
+            AVG(sentiment_absolute)
+            FROM 
+            (
+            
+                SELECT client_received_ts_ms, sentiment_percent as sentiment_absolute
+                FROM data_stocktwits_sentiment_rt
+                WHERE client_received_ts_ms >=(SELECT UNIX_TIMESTAMP(NOW())*1000-(12*3600*1000))
+                
+                UNION
+                
+                SELECT client_received_ts_ms, 0.5*sentiment_score as sentiment_absolute
+                FROM data_stockfluence_rt_sentiment
+                WHERE client_received_ts_ms >=(SELECT UNIX_TIMESTAMP(NOW())*1000-(12*3600*1000))                
+            
+            ) AS sentiment_ensemble
+            
+        );
+    """
+
+    sql_for_insert_news_external_ensemble = """
+        INSERT INTO analysis_global_sentiment(sentiment_type, sentiment_seconds_back, created_at_epoch_ms, sentiment_absolute)
+        (
+            SELECT 'news_external_ensemble', 12*3600, UNIX_TIMESTAMP(NOW())*1000, 
+            AVG(sentiment_absolute)
+            FROM 
+            (
+
+                SELECT client_received_ts_ms, news_sentiment_score as sentiment_absolute
+                FROM data_benzinga_sentiment_rt
+                WHERE client_received_ts_ms >=(SELECT UNIX_TIMESTAMP(NOW())*1000-(12*3600*1000))
+
+                UNION
+
+                SELECT client_received_ts_ms, current_buzz as sentiment_absolute
+                FROM data_tipranks_news_sentiment_rt
+                WHERE client_received_ts_ms >=(SELECT UNIX_TIMESTAMP(NOW())*1000-(12*3600*1000))                
+
+            ) AS sentiment_ensemble
+
+        );
+    """
+
+    sql_for_insert_global_external_ensemble = """
+        INSERT INTO analysis_global_sentiment(sentiment_type, sentiment_seconds_back, created_at_epoch_ms, sentiment_absolute)
+        (
+            SELECT 'global_external_ensemble', 12*3600, UNIX_TIMESTAMP(NOW())*1000, 
+            AVG(sentiment_absolute)
+            FROM analysis_global_sentiment
+            WHERE created_at_epoch_ms >= (SELECT UNIX_TIMESTAMP(NOW())*1000-(12*3600*1000))
+            AND sentiment_type in ('news_external_ensemble', 'social_external_ensemble')
+        );
+    """
+
+    sql_for_insert = [
+        sql_for_insert_stocktwits, sql_for_insert_twitter, sql_for_insert_social_teslamonitor,
+        sql_for_insert_social_external_ensemble, sql_for_insert_news_external_ensemble,
+        sql_for_insert_global_external_ensemble
+    ]
+
+    if aggregator is None:
+        logger.info(f'Running inserts: {sql_for_insert}')
+
+        db_utils.update(
+            use_ssh, sql_for_insert,
+            db_host, db_user, db_password, db_port, database_name, ssh_username, ssh_password
+        )
+    else:
+        now_ms = get_utc_now()
+        aggregated_rows = [
+            (sentiment_type, seconds_back, now_ms, average)
+            for sentiment_type, seconds_back, average in aggregator.averages(now_ms)
+        ]
+        logger.info(f'Running inserts: {aggregated_rows} + {sql_for_insert[2:]}')
+
+        db_utils.execute_many(
+            use_ssh,
+            [(
+                'INSERT INTO analysis_global_sentiment(sentiment_type, sentiment_seconds_back, created_at_epoch_ms, sentiment_absolute) '
+                'VALUES (%s, %s, %s, %s)',
+                aggregated_rows
+            )] + [(q, None) for q in sql_for_insert[2:]],
+            db_host, db_user, db_password, db_port, database_name, ssh_username, ssh_password
+        )
+
+    logger.info(f'Completed inserts: {sql_for_insert}')
+
+
+def refresh_aggregator_from_db(
+    aggregator: RollingSentimentAggregator, since_received_epoch_ms,
+    use_ssh, db_host, db_user, db_password, db_port, database_name, ssh_username, ssh_password
+):
+    """Upsert into the aggregator the posts of its largest window received after since_received_epoch_ms.
+
+    Returns the max client_received_epoch_ms seen (or since_received_epoch_ms if there were no rows).
+    """
+    posts_sql = f'''
+        SELECT post_type, post_id, created_at_epoch_ms, impact, sentiment_mixed, client_received_epoch_ms
+        FROM analysis_posts_sentiment
+        WHERE created_at_epoch_ms >= (SELECT UNIX_TIMESTAMP(NOW())*1000-({aggregator.window_seconds[-1]}*1000))
+        AND client_received_epoch_ms > {int(since_received_epoch_ms)}
+    '''
+
+    df_posts = db_utils.query(use_ssh, posts_sql, db_host, db_user, db_password, db_port, database_name, ssh_username, ssh_password)
+    now_ms = get_utc_now()
+    max_received_epoch_ms = since_received_epoch_ms
+
+    for post in df_posts.to_dict('records'):
+        aggregator.upsert(
+            post['post_type'], post['post_id'], post['created_at_epoch_ms'],
+            none_if_nan(post['impact']), none_if_nan(post['sentiment_mixed']), now_ms
+        )
+        max_received_epoch_ms = max(max_received_epoch_ms, int(post['client_received_epoch_ms']))
+
+    logger.info(f'Refreshed sentiment aggregator with {len(df_posts)} posts: {aggregator.stats()}')
+
+    return max_received_epoch_ms
+
+
+def verify_aggregator_against_db(
+    aggregator: RollingSentimentAggregator,
+    use_ssh, db_host, db_user, db_password, db_port, database_name, ssh_username, ssh_password
+):
+    """Log the difference between the aggregator averages and the ones computed by MySQL."""
+    now_ms = get_utc_now()
+    sql_by_window = [
+        f'''
+        SELECT 'stocktwits' as sentiment_type, {w} as seconds_back, AVG(impact*(sentiment_mixed-0.5)) as average
+        FROM analysis_posts_sentiment
+        WHERE created_at_epoch_ms >= {now_ms - w * 1000} AND post_type IN ('stocktwit')
+        UNION
+        SELECT 'twitter' as sentiment_type, {w} as seconds_back, AVG(impact*(sentiment_mixed-0.5)) as average
+        FROM analysis_posts_sentiment
+        WHERE created_at_epoch_ms >= {now_ms - w * 1000} AND post_type IN ('twitter-topic', 'twitter-user')
+        '''
+        for w in aggregator.window_seconds
+    ]
+    df_averages = db_utils.query(
+        use_ssh, ' UNION '.join(sql_by_window), db_host, db_user, db_password, db_port, database_name, ssh_username, ssh_password
+    )
+    sql_averages = {(row['sentiment_type'], int(row['seconds_back'])): none_if_nan(row['average']) for row in df_averages.to_dict('records')}
+
+    for sentiment_type, seconds_back, average in aggregator.averages(now_ms):
+        sql_average = sql_averages.get((sentiment_type, seconds_back))
+        delta = None if average is None or sql_average is None else abs(average - float(sql_average))
+        logger.info(f'Aggregator check {sentiment_type}/{seconds_back}: aggregator={average} sql={sql_average} delta={delta}')
+
+
+def none_if_nan(value):
+    return None if value is None or value != value else value
+
+
+def compute_impact(post):
+    msg_type = post['post_type']
+
+    if msg_type in ['twitter-topic', 'twitter-user']:
+        return 1 + post.get('likes_total', 0) + post.get('interaction_total', 0) * 3
+    else:
+        return 1 + post.get('likes_total', 0) + post.get('interaction_total', 0)
+
+
+def get_utc_now():
+    delta_ts = datetime.utcnow() - datetime(1970, 1, 1)
+    utc_now = int((delta_ts.days * 24 * 60 * 60 + delta_ts.seconds) * 1000 + delta_ts.microseconds / 1000.0)
+    return utc_now
+
+
+class ImpactRecalculator:
+    """Recalculates the impact of the relevant posts and inserts the current global sentiment, one cycle at a time.
+
+    Keeps the state shared between cycles: the last version of every relevant post, the per post type watermarks
+    (incremental mode) and the rolling sentiment aggregator (if enabled).
+    """
+
+    def __init__(
+        self, db_args: Tuple, incremental_impact=False, watermark_column='client_received_ts_ms', watermark_overlap_ms=5000,
+        full_resync_ms=600000, rolling_aggregator=False, sentiment_windows=(12 * 3600,), verify_global_sentiment=False,
+        impact_chunk_size=1000, impact_write_mode='join', processed_posts_size=50000, aggregator_rebuild_ms=600000
+    ):
+        # (use_ssh, db_host, db_user, db_password, db_port, database_name, ssh_username, ssh_password)
+        self.db_args = db_args
+        self.incremental_impact = incremental_impact
+        self.watermark_column = watermark_column
+        self.watermark_overlap_ms = watermark_overlap_ms
+        self.full_resync_ms = full_resync_ms
+        self.rolling_aggregator = rolling_aggregator
+        self.aggregator_rebuild_ms = aggregator_rebuild_ms
+        self.sentiment_windows = sentiment_windows
+        self.verify_global_sentiment = verify_global_sentiment
+        self.impact_chunk_size = impact_chunk_size
+        self.impact_write_mode = impact_write_mode
+        self.processed_posts = LRU(processed_posts_size)
+        self.watermarks = {}
+        self.last_full_resync_epoch_ms = None
+        self.aggregator = None
+        self.aggregator_watermark_ms = 0
+        self.last_aggregator_rebuild_epoch_ms = None
+
+    def run_cycle(self):
+        query_started_epoch_ms = get_utc_now()
+        full_resync = (
+            not self.incremental_impact or self.last_full_resync_epoch_ms is None or
+            query_started_epoch_ms - self.last_full_resync_epoch_ms > self.full_resync_ms
+        )
+        df_relevant_posts = get_relevant_posts(
+            *self.db_args, None if full_resync else self.watermarks, self.watermark_column if self.incremental_impact else None
+        )
+        relevant_posts = df_relevant_posts.to_dict('records')
+
+        if full_resync:
+            self.last_full_resync_epoch_ms = query_started_epoch_ms
+            self.watermarks = {}
+
+        self.watermarks = update_watermarks(
+            self.watermarks, relevant_posts, query_started_epoch_ms - self.watermark_overlap_ms, self.watermark_overlap_ms
+        )
+        logger.info(f'Relevant posts: {len(relevant_posts)}. Full resync: {full_resync}. Watermarks: {self.watermarks}')
+        posts_to_update = []
+
+        for relevant_post in relevant_posts:
+            # message_id, conversation_replies, likes_total
+            current_key = (relevant_post['post_type'], relevant_post['message_id'])
+            current_post_prev_version = self.processed_posts.get(current_key, None)
+
+            if relevant_post != current_post_prev_version:
+                self.processed_posts[current_key] = relevant_post
+                posts_to_update.append((relevant_post['message_id'], compute_impact(relevant_post), relevant_post['post_type']))
+
+        logger.info(f'Posts to update: {len(posts_to_update)}')
+        update_impact_in_db(posts_to_update, *self.db_args, self.impact_chunk_size, self.impact_write_mode)
+
+        if self.rolling_aggregator:
+            # The running sums are rebuilt from scratch every aggregator_rebuild_ms, so that float errors don't accumulate.
+            if self.last_aggregator_rebuild_epoch_ms is None or get_utc_now() - self.last_aggregator_rebuild_epoch_ms > self.aggregator_rebuild_ms:
+                self.aggregator = RollingSentimentAggregator(self.sentiment_windows)
+                self.aggregator_watermark_ms = 0
+                self.last_aggregator_rebuild_epoch_ms = get_utc_now()
+
+            self.aggregator_watermark_ms = refresh_aggregator_from_db(
+                self.aggregator, self.aggregator_watermark_ms - self.watermark_overlap_ms, *self.db_args
+            )
+
+            for post_id, impact, post_type in posts_to_update:
+                self.aggregator.update_impact(post_type, post_id, impact)
+
+            if self.verify_global_sentiment:
+                verify_aggregator_against_db(self.aggregator, *self.db_args)
+
+        insert_current_global_sentiment_in_db(*self.db_args, self.aggregator)
+
+
+class RecomputeScheduler:
+    """Runs recompute() on its own cadence, coalescing requests.
+
+    Any number of request() calls made while waiting (or while a cycle runs) trigger a single cycle. Cycles are at
+    least min_interval_ms apart, and one runs at least every max_interval_ms even without requests.
+    """
+
+    def __init__(self, recompute: Callable[[], None], min_interval_ms=5000, max_interval_ms=30000):
+        self.recompute = recompute
+        self.min_interval_ms = min_interval_ms
+        self.max_interval_ms = max_interval_ms
+        self.requested = threading.Event()
+        self.stopped = threading.Event()
+        self.thread = None
+        self.stats = {'requests': 0, 'cycles': 0, 'failures': 0, 'last_latency_ms': None, 'max_latency_ms': 0, 'total_latency_ms': 0}
+
+    def request(self):
+        self.stats['requests'] += 1
+        self.requested.set()
+
+    def run(self):
+        last_cycle_started = None
+
+        while not self.stopped.is_set():
+            self.requested.wait(self.max_interval_ms / 1000)
+
+            if self.stopped.is_set():
+                break
+
+            if last_cycle_started is not None:
+                wait_ms = self.min_interval_ms - (time.time() - last_cycle_started) * 1000
+
+                if wait_ms > 0 and self.stopped.wait(wait_ms / 1000):
+                    break
+
+            # Cleared before running, so that requests arriving during the cycle trigger exactly one more.
+            self.requested.clear()
+            last_cycle_started = time.time()
+
+            try:
+                self.recompute()
+            except Exception:
+                self.stats['failures'] += 1
+                logger.error(f'Recompute cycle failed: {traceback.format_exc()}')
+
+            latency_ms = int((time.time() - last_cycle_started) * 1000)
+            self.stats['cycles'] += 1
+            self.stats['last_latency_ms'] = latency_ms
+            self.stats['max_latency_ms'] = max(self.stats['max_latency_ms'], latency_ms)
+            self.stats['total_latency_ms'] += latency_ms
+            logger.info(
+                f"Recompute cycle took {latency_ms} ms. Avg: {self.stats['total_latency_ms'] // self.stats['cycles']} ms. "
+                f"Stats: {self.stats}"
+            )
+            gc.collect()
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name='recompute-scheduler', daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+        self.requested.set()
+
+        if self.thread is not None:
+            self.thread.join()
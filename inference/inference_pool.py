@@ -0,0 +1,124 @@
+import multiprocessing
+import queue
+import threading
+import traceback
+import logging
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+# Set in the parent right before forking, so the workers inherit the predict function and everything it closes over
+# (the models above all) instead of getting them pickled.
+_predict = None
+_context = {}
+
+
+def _init_worker(threads_per_worker, initializer):
+    global _context
+
+    # One intra-op thread per worker: N workers x the default (all the cores) threads would only fight each other.
+    import torch
+    torch.set_num_threads(threads_per_worker)
+
+    if initializer:
+        _context = initializer() or {}
+
+
+def _run(batch):
+    return _predict(batch, _context)
+
+
+def share_models(models):
+    """Move the weights of the models to shared memory, so they stay shared with the workers even once the pages holding
+    them would be copied on write."""
+    for model in set(model.classification_model for model in models.values()):
+        model.share_memory()
+
+
+class InferencePool:
+    """Forked worker processes running predict(batch, context) on batches of records.
+
+    context is what initializer returns in each worker (e.g. per process caches or connections that can't cross a fork).
+    Up to max_pending batches are in flight at a time; reading more input waits for the results to be taken. With
+    ordered=True, result batches come out in input order, otherwise as soon as they're done.
+    """
+
+    def __init__(self, predict, n_workers, ordered=True, max_pending=None, threads_per_worker=1, initializer=None):
+        global _predict
+
+        _predict = predict
+        self.n_workers = n_workers
+        self.ordered = ordered
+        self.max_pending = max_pending or 2 * n_workers
+        self.pool = multiprocessing.get_context('fork').Pool(n_workers, _init_worker, (threads_per_worker, initializer))
+        self.stats = {'batches': 0, 'failures': 0, 'max_held_for_order': 0}
+
+    def map_batches(self, batches):
+        results = queue.Queue()
+        slots = threading.Semaphore(self.max_pending)
+
+        def submit(index, batch):
+            self.pool.apply_async(
+                _run, (batch,), callback=lambda output: results.put((index, output)),
+                error_callback=lambda error: results.put((index, error))
+            )
+
+        def feed():
+            n_batches = 0
+
+            try:
+                for batch in batches:
+                    slots.acquire()
+                    submit(n_batches, batch)
+                    n_batches += 1
+            except Exception:
+                logger.error(f'Exception when reading the input batches: {traceback.format_exc()}')
+            finally:
+                results.put((None, n_batches))
+
+        # The input is read on its own thread, so that finished batches go out while it waits for more.
+        threading.Thread(target=feed, name='inference-pool-feeder', daemon=True).start()
+        n_batches = None
+        next_index = 0
+        held = {}
+
+        while n_batches is None or next_index < n_batches:
+            index, output = results.get()
+
+            if index is None:
+                n_batches = output
+                continue
+
+            if isinstance(output, Exception):
+                self.stats['failures'] += 1
+                logger.error(f'Inference worker failed on batch {index}: {output!r}')
+                output = None
+
+            held[index] = output
+            self.stats['max_held_for_order'] = max(self.stats['max_held_for_order'], len(held))
+            ready = list(held) if not self.ordered else []
+
+            while self.ordered and next_index + len(ready) in held:
+                ready.append(next_index + len(ready))
+
+            for ready_index in ready:
+                output = held.pop(ready_index)
+                next_index += 1
+                self.stats['batches'] += 1
+                slots.release()
+
+                if output is not None:
+                    yield output
+
+    def predict(self, batch):
+        """Runs one batch on a worker and waits for its output. Can be called from several threads at a time."""
+        return self.pool.apply(_run, (batch,))
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+    def terminate(self):
+        """Stops the workers right away, dropping the batches in flight."""
+        self.pool.terminate()
+        self.pool.join()
@@ -0,0 +1,117 @@
+import json
+import os
+
+import logging
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+
+def _stdlib_dumps(obj):
+    # ASCII only: the output goes through handles opened with the locale encoding, and tweets carry lone surrogates.
+    return json.dumps(obj, separators=(',', ':'))
+
+
+def _with_stdlib_fallback(fast_loads):
+    def _loads(data):
+        try:
+            return fast_loads(data)
+        except ValueError:
+            # e.g. lone \udXXX escapes, which orjson rejects and the stdlib accepts. Invalid JSON still raises.
+            return json.loads(data)
+
+    return _loads
+
+
+def _load_backend(name):
+    if name == 'orjson':
+        import orjson
+        # orjson can't escape non ASCII, so it only decodes.
+        return _with_stdlib_fallback(orjson.loads), _stdlib_dumps
+    elif name == 'ujson':
+        import ujson
+        return _with_stdlib_fallback(ujson.loads), lambda obj: ujson.dumps(obj, ensure_ascii=True, escape_forward_slashes=False)
+    else:
+        return json.loads, _stdlib_dumps
+
+
+def _first_available(names, pick):
+    for name in names:
+        try:
+            return name, pick(_load_backend(name))
+        except ImportError:
+            logger.debug(f'JSON backend {name} not available')
+
+
+def set_backend(name=None):
+    """Select the JSON backend: orjson, ujson or json. By default, the fastest one installed for each direction: orjson,
+    then ujson, to decode, and ujson to encode (orjson can't write ASCII only JSON).
+
+    The AUTOMLPREDICTOR_JSON_BACKEND environment variable can force one for both. Every backend writes ASCII only JSON.
+    """
+    global BACKEND, loads, dumps
+
+    if name:
+        try:
+            loads, dumps = _load_backend(name)
+            BACKEND = name
+            return BACKEND
+        except ImportError:
+            logger.warning(f'JSON backend {name} not available, falling back to the fastest one installed')
+
+    loads_backend, loads = _first_available(['orjson', 'ujson', 'json'], lambda functions: functions[0])
+    dumps_backend, dumps = _first_available(['ujson', 'json'], lambda functions: functions[1])
+    BACKEND = loads_backend if loads_backend == dumps_backend else f'{loads_backend}+{dumps_backend}'
+    return BACKEND
+
+
+BACKEND = None
+loads = json.loads
+dumps = _stdlib_dumps
+set_backend(os.getenv('AUTOMLPREDICTOR_JSON_BACKEND'))
+
+
+def split_lines(data):
+    """Records packed in a Kinesis record. The producer can aggregate several newline separated lines into one."""
+    return [line for line in data.splitlines() if line.strip()]
+
+
+class RecordSplitter:
+    """Splits a stream into raw JSON records.
+
+    framing='json' uses splitstream, which scans the bytes for complete JSON values and works with any layout.
+    framing='ndjson' expects one record per line, which is what every stage of the pipeline writes, and is much cheaper.
+
+    Iterating yields the records available up to the end of the input. It can be iterated again to continue after
+    more data is appended (e.g. when following a file). In ndjson mode a trailing partial line is kept until completed.
+    """
+
+    def __init__(self, handle, framing='json'):
+        self.handle = handle
+        self.framing = framing
+        self.pending = None
+
+    def __iter__(self):
+        if self.framing == 'ndjson':
+            return self._split_lines()
+
+        from splitstream import splitfile
+        return splitfile(self.handle, format='json')
+
+    def _split_lines(self):
+        while True:
+            line = self.handle.readline()
+
+            if not line:
+                return
+
+            if self.pending is not None:
+                line = self.pending + line
+                self.pending = None
+
+            if line[-1:] not in ('\n', b'\n'):
+                self.pending = line
+                return
+
+            if line.strip():
+                yield line
@@ -1,6 +1,9 @@
 from datetime import datetime
-from splitstream import splitfile
-import json
+from inference import json_codec
+import os
+import queue
+import stat
+import threading
 import time
 import traceback
 import logging
@@ -23,11 +26,13 @@ def print_event(data, source, msg_type, data_source=None, schema='automlpredicto
 
 
 # TODO: Implement timeout?
-def read_json_input(batch_size, input_handle, sleep_ms):
+def read_json_input(batch_size, input_handle, sleep_ms, framing='json'):
+    splitter = json_codec.RecordSplitter(input_handle, framing)
+
     def read_line():
-        for jsonline in splitfile(input_handle, format="json"):
+        for jsonline in splitter:
             try:
-                yield json.loads(jsonline)
+                yield json_codec.loads(jsonline)
             except Exception:
                 logger.error(f'JSON parsing failed for record {jsonline}: {traceback.format_exc()}')
 
@@ -54,3 +59,93 @@ def read_json_input(batch_size, input_handle, sleep_ms):
         # If nothing new in the file, we sleep
         logger.info(f'read_json_input loop: Going to sleep for {sleep_ms} milliseconds.')
         time.sleep(sleep_ms / 1000)
+
+
+def read_json_input_timed(batch_size, input_handle, max_wait_ms, poll_ms=100, framing='json', queue_batches=4):
+    """Yield a batch as soon as it has batch_size records, or max_wait_ms after its first record, whichever comes first.
+
+    A reader thread blocks on the input, so there's no sleeping while input is pending. If the input is a regular file,
+    it's followed like tail -f, polling every poll_ms once the end is reached. Otherwise the generator ends with the
+    input. The reader is at most queue_batches batches ahead of the consumer: past that it waits, so a large backlog
+    or a stalled downstream stage doesn't pile up in memory.
+    """
+    records = queue.Queue(maxsize=queue_batches * batch_size)
+    end_of_input = object()
+
+    try:
+        fileno = input_handle.fileno()
+        follow = stat.S_ISREG(os.fstat(fileno).st_mode)
+        # Reads must return whatever is available on a pipe, instead of waiting for a full buffer. Buffered readline
+        # already does, and splitstream needs an unbuffered handle for it.
+        raw_handle = open(fileno, 'rb', buffering=-1 if framing == 'ndjson' else 0, closefd=False)
+    except (AttributeError, OSError, ValueError):
+        follow = False
+        raw_handle = input_handle
+
+    splitter = json_codec.RecordSplitter(raw_handle, framing)
+
+    def read_records():
+        try:
+            while True:
+                for jsonline in splitter:
+                    try:
+                        records.put(json_codec.loads(jsonline))
+                    except Exception:
+                        logger.error(f'JSON parsing failed for record {jsonline}: {traceback.format_exc()}')
+
+                if not follow:
+                    break
+
+                time.sleep(poll_ms / 1000)
+        except:
+            logger.error(f'Exception when processing processing lines: {traceback.format_exc()}')
+        finally:
+            records.put(end_of_input)
+
+    threading.Thread(target=read_records, name='json-input-reader', daemon=True).start()
+
+    while True:
+        record = records.get()
+
+        if record is end_of_input:
+            return
+
+        msgs = [record]
+        deadline = time.monotonic() + max_wait_ms / 1000
+
+        while len(msgs) < batch_size:
+            remaining = deadline - time.monotonic()
+
+            try:
+                # Once the deadline has passed, we still take whatever is already pending.
+                record = records.get(timeout=remaining) if remaining > 0 else records.get_nowait()
+            except queue.Empty:
+                break
+
+            if record is end_of_input:
+                yield msgs
+                return
+
+            msgs.append(record)
+
+        yield msgs
+
+
+def read_batches(batch_size, input_handle, sleep_ms, max_wait_ms=None, framing='json'):
+    """read_json_input_timed if max_wait_ms is set, the poll-and-sleep read_json_input otherwise."""
+    if max_wait_ms is None:
+        return read_json_input(batch_size, input_handle, sleep_ms, framing)
+
+    return read_json_input_timed(batch_size, input_handle, max_wait_ms, framing=framing)
+
+
+def end_to_end_latency_ms(msgs):
+    """(p50, max) millisecs since clientReceivedTsMs, for the messages that have it."""
+    delta_ts = datetime.utcnow() - datetime(1970, 1, 1)
+    now_ms = int((delta_ts.days * 24 * 60 * 60 + delta_ts.seconds) * 1000 + delta_ts.microseconds / 1000.0)
+    latencies = sorted(now_ms - msg['clientReceivedTsMs'] for msg in msgs if 'clientReceivedTsMs' in msg)
+
+    if len(latencies) == 0:
+        return None, None
+
+    return latencies[len(latencies) // 2], latencies[-1]
@@ -0,0 +1,109 @@
+import hashlib
+import sqlite3
+import threading
+from lru import LRU
+
+import logging
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+
+# Bumped when the scores for a given text change, so the on-disk entries written before are no longer looked up.
+# 2: batches are no longer padded, which made the stored scores depend on the rest of the batch.
+# 3: keyed on the raw text. Collapsing whitespace merged texts the tokenizer tells apart (newlines and tabs are tokens).
+KEY_VERSION = 3
+# Seconds a connection waits for another one (e.g. another inference worker) to release the db before giving up. Short:
+# giving up only costs a cache miss, waiting holds up the whole batch.
+BUSY_TIMEOUT_S = 1
+
+
+def prediction_key(trained_classifier_file_path, itos_file_path, text):
+    key = '\0'.join([str(KEY_VERSION), str(trained_classifier_file_path), str(itos_file_path), str(text)])
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+
+class PredictionCache:
+    """Content addressed cache of (bear, bull, vader) scores.
+
+    It has a bounded in-memory LRU tier and, if db_path is given, an SQLite tier that survives restarts. The db is in
+    WAL mode, so the caches of several processes can share it. Failing to read or write it only costs a miss.
+    Entries are keyed by (model file, itos file, text hash).
+    """
+
+    def __init__(self, max_entries=10000, db_path=None):
+        self.memory = LRU(max_entries)
+        self.db = None
+        self.lock = threading.Lock()
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+        if db_path:
+            self.db = sqlite3.connect(db_path, timeout=BUSY_TIMEOUT_S, check_same_thread=False)
+            # Readers don't block the writer and the other way round; writers still take turns, up to the timeout.
+            self.db.execute('PRAGMA journal_mode=WAL')
+            self.db.execute(
+                'CREATE TABLE IF NOT EXISTS predictions (key TEXT PRIMARY KEY, bear REAL, bull REAL, vader REAL)'
+            )
+            self.db.commit()
+
+    def get(self, trained_classifier_file_path, itos_file_path, text):
+        key = prediction_key(trained_classifier_file_path, itos_file_path, text)
+
+        with self.lock:
+            values = self.memory.get(key, None)
+
+            if values is not None:
+                self.memory_hits += 1
+                return values
+
+            if self.db is not None:
+                try:
+                    row = self.db.execute('SELECT bear, bull, vader FROM predictions WHERE key = ?', (key,)).fetchone()
+                except sqlite3.OperationalError as e:
+                    logger.warning(f'Prediction cache lookup failed: {e}')
+                    row = None
+
+                if row is not None:
+                    self.disk_hits += 1
+                    self.memory[key] = row
+                    return row
+
+            self.misses += 1
+            return None
+
+    def put_many(self, trained_classifier_file_path, itos_file_path, predictions):
+        """Store predictions, an iterable of (text, (bear, bull, vader)) pairs."""
+        rows = [
+            (prediction_key(trained_classifier_file_path, itos_file_path, text), *map(float, values))
+            for text, values in predictions
+        ]
+
+        with self.lock:
+            for key, bear, bull, vader in rows:
+                self.memory[key] = (bear, bull, vader)
+
+            if self.db is not None:
+                try:
+                    self.db.executemany('INSERT OR REPLACE INTO predictions (key, bear, bull, vader) VALUES (?, ?, ?, ?)', rows)
+                    self.db.commit()
+                except sqlite3.OperationalError as e:
+                    self.db.rollback()
+                    logger.warning(f'Prediction cache write of {len(rows)} entries failed: {e}')
+
+    def stats(self):
+        lookups = self.memory_hits + self.disk_hits + self.misses
+
+        return {
+            'memory_hits': self.memory_hits,
+            'disk_hits': self.disk_hits,
+            'misses': self.misses,
+            'hit_ratio': (self.memory_hits + self.disk_hits) / lookups if lookups else 0.0,
+            'memory_entries': len(self.memory),
+        }
+
+    def close(self):
+        if self.db is not None:
+            self.db.close()
+            self.db = None
@@ -1,8 +1,10 @@
 import numpy as np
 import matplotlib
 import datetime
+import multiprocessing
 matplotlib.use('TkAgg')
 from fastai.text import *
+import os
 import sys
 sys.excepthook = sys.__excepthook__  # See https://groups.io/g/insync/topic/13778827?p=,,,20,0,0,0::recentpostdate%2Fsticky,,,20,2,0,13778827
 import json
@@ -14,15 +16,78 @@ import logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+_worker_tokenizer = None
+
+
+def _init_worker_tokenizer(lang):
+    global _worker_tokenizer
+    _worker_tokenizer = Tokenizer(lang)
+
+
+def _tokenize_in_worker(texts):
+    return [_worker_tokenizer.proc_text(text) for text in texts]
+
+
+class TokenizerService:
+    """Long-lived tokenizer, created once per process.
+
+    With n_workers > 0 it also keeps a pool of worker processes, each one with its own spacy tokenizer, which
+    tokenize whole batches of texts in parallel. Batches smaller than min_parallel_texts are tokenized in process,
+    as shipping them to the workers costs more than tokenizing them.
+    """
+
+    def __init__(self, n_workers=0, lang='en', min_parallel_texts=8):
+        self.tokenizer = Tokenizer(lang)
+        self.n_workers = n_workers
+        self.min_parallel_texts = min_parallel_texts
+        self.pool = multiprocessing.Pool(n_workers, _init_worker_tokenizer, (lang,)) if n_workers > 0 else None
+
+    def tokenize(self, texts):
+        if self.pool is None or len(texts) < self.min_parallel_texts:
+            return [self.tokenizer.proc_text(text) for text in texts]
+
+        partitions = [texts[i::self.n_workers] for i in range(self.n_workers)]
+        tokenized_partitions = self.pool.map(_tokenize_in_worker, partitions)
+
+        # Undo the round-robin partitioning, so that the output order matches texts.
+        tokens = [None] * len(texts)
+
+        for offset, tokenized_partition in enumerate(tokenized_partitions):
+            tokens[offset::self.n_workers] = tokenized_partition
+
+        return tokens
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+
+_default_tokenizer_service = None
+
+
+def get_tokenizer_service(n_workers=0):
+    """Return the process wide TokenizerService, creating it on first use."""
+    global _default_tokenizer_service
+
+    if _default_tokenizer_service is None:
+        _default_tokenizer_service = TokenizerService(n_workers)
+
+    return _default_tokenizer_service
+
+
 def load_vader_analyzer():
     return SentimentIntensityAnalyzer()
 
-def load_model(itos_filename, classifier_filename):
+def load_model(itos_filename, classifier_filename, saved_model_dir=None):
     """Load the classifier and int to string mapping
   
     Args:
         itos_filename (str): The filename of the int to string mapping file (usually called itos.pkl)
         classifier_filename (str): The filename of the trained classifier
+        saved_model_dir (str): Where to keep the whole classifier module, so that later loads skip rebuilding the
+            graph and loading the state dict into it
   
     Returns:
         string to int mapping, trained classifer model
@@ -33,6 +98,18 @@ def load_model(itos_filename, classifier_filename):
     # turn it into a string to int mapping (which is what we need)
     stoi = collections.defaultdict(lambda: 0, {str(v): int(k) for k, v in enumerate(itos)})
 
+    saved_model_path = None
+
+    if saved_model_dir:
+        saved_model_path = os.path.join(saved_model_dir, f'{os.path.basename(classifier_filename)}.{saved_model_versions()}.pt')
+
+        if os.path.exists(saved_model_path) and os.path.getmtime(saved_model_path) >= os.path.getmtime(classifier_filename):
+            logger.info(f'Loading the classifier from {saved_model_path}')
+            model = torch.load(saved_model_path)
+            model.reset()
+            model.eval()
+            return stoi, model
+
     # these parameters aren't used, but this is the easiest way to get a model
     bptt, em_sz, nh, nl = 70, 400, 1150, 3
     dps = np.array([0.4, 0.5, 0.05, 0.3, 0.4]) * 0.5
@@ -50,9 +127,29 @@ def load_model(itos_filename, classifier_filename):
     model.reset()
     model.eval()
 
+    if saved_model_path:
+        try:
+            os.makedirs(saved_model_dir, exist_ok=True)
+            torch.save(model, saved_model_path)
+            logger.info(f'Saved the classifier to {saved_model_path}')
+        except Exception:
+            logger.warning(f'Could not save the classifier to {saved_model_path}: {traceback.format_exc()}')
+
     return stoi, model
 
 
+def saved_model_versions():
+    """torch.save(model) pickles the module classes by reference, so a saved module is only loaded back by the same
+    torch and fastai versions."""
+    try:
+        import pkg_resources
+        fastai_version = pkg_resources.get_distribution('fastai').version
+    except Exception:
+        fastai_version = 'unknown'
+
+    return f'torch-{torch.__version__}.fastai-{fastai_version}'
+
+
 def softmax(x):
     '''
     Numpy Softmax, via comments on https://gist.github.com/stober/1946926
@@ -76,47 +173,71 @@ def softmax(x):
     return exp_x / np.sum(exp_x, axis=1).reshape((-1, 1))
 
 
-# Warning: If there are not enough cores and try parallel, we may get the "ValueError: max_workers must be greater than 0" exception
-def predict_text_sentiment(stoi, model, text, parallel=False):
+def predict_text_sentiment(stoi, model, text, tokenizer_service=None):
     """Do the actual prediction on the text using the
         model and mapping files passed
     """
+    return predict_texts_sentiment(stoi, model, [text], tokenizer_service)[0]
+
+
+def predict_texts_sentiment(stoi, model, texts, tokenizer_service=None, max_batch_size=32):
+    """Do the prediction for several texts at once, running one forward pass per chunk of max_batch_size texts
+
+    Args:
+        stoi: string to int mapping
+        model: trained classifier model
+        texts (list): texts to classify
+        tokenizer_service (TokenizerService): tokenizer to use. If None, the process wide one is used
+        max_batch_size (int): maximum number of texts per forward pass
+
+    Returns:
+        numpy array with one row of softmax scores per text, in the same order as texts
+    """
+    if len(texts) == 0:
+        return np.zeros((0, 2))
 
     # prefix text with tokens:
     #   xbos: beginning of sentence
     #   xfld 1: we are using a single field here
-    input_str = 'xbos xfld 1 ' + text
-
-    # predictions are done on arrays of input.
-    # We only have a single input, so turn it into a 1x1 array
-    texts = [input_str]
+    input_strs = ['xbos xfld 1 ' + text for text in texts]
 
     # tokenize using the fastai wrapper around spacy
-    if parallel:
-        tok = Tokenizer().proc_all_mp(partition_by_cores(texts))
-    else:
-        tok = Tokenizer().proc_all(texts, lang='en')
+    tok = (tokenizer_service or get_tokenizer_service()).tokenize(input_strs)
 
     # turn into integers for each word
-    encoded = [stoi[p] for p in tok[0]]
+    encoded = [[stoi[p] for p in tokens] for tokens in tok]
+
+    # Only texts with the same number of tokens share a forward pass. Padding would go through the LSTM and the
+    # avg/max pooling, and make a text's scores depend on its batch mates, so each text gets exactly the scores of a
+    # forward pass on its own (what the per record path and the prediction cache expect).
+    order = sorted(range(len(encoded)), key=lambda i: len(encoded[i]))
+    chunks = []
 
-    # we want a [x,1] array where x is the number
-    #  of words inputted (including the prefix tokens)
-    ary = np.reshape(np.array(encoded), (-1, 1))
+    for i in order:
+        if chunks and len(encoded[chunks[-1][0]]) == len(encoded[i]) and len(chunks[-1]) < max_batch_size:
+            chunks[-1].append(i)
+        else:
+            chunks.append([i])
 
-    # turn this array into a tensor
-    tensor = torch.from_numpy(ary)
+    scores = [None] * len(encoded)
 
-    # wrap in a torch Variable
-    variable = Variable(tensor)
+    for chunk in chunks:
+        # we want a [x,bs] array where x is the number of words of the texts in the chunk (including the prefix tokens)
+        ary = np.ascontiguousarray(np.array([encoded[i] for i in chunk], dtype=np.int64).T)
 
-    # do the predictions
-    predictions = model(variable)
+        # turn this array into a tensor and wrap in a torch Variable
+        variable = Variable(torch.from_numpy(ary))
 
-    # convert back to numpy
-    numpy_preds = predictions[0].data.numpy()
+        # do the predictions
+        predictions = model(variable)
 
-    return softmax(numpy_preds[0])[0]
+        # convert back to numpy
+        chunk_scores = softmax(predictions[0].data.numpy())
+
+        for column, i in enumerate(chunk):
+            scores[i] = chunk_scores[column]
+
+    return np.array(scores)
 
 def predict_text_sentiment_vader_normalized(vader_analyzer, text):
     # [-1.0, 1.0]
@@ -131,15 +252,7 @@ def calculate_bull_vader_sentiment(model_scores, vader_score):
     return model_scores[1]*0.8 + vader_score*0.2
 
 
-def predict_record(
-        record, stoi, model, vader_analyzer,
-        itos_file_path, trained_classifier_file_path, input_data_file_path
-):
-    text = record['data']['text']
-
-    # Softmax: model_scores[1] (bull) + model_scores[0] (bear) = 1.0
-    scores = predict_text_sentiment(stoi, model, text, num_cpus() > 1)
-    vader_score = predict_text_sentiment_vader_normalized(vader_analyzer, text)
+def annotate_record(record, scores, vader_score, itos_file_path, trained_classifier_file_path, input_data_file_path):
     delta_ts = datetime.datetime.utcnow() - datetime.datetime(1970, 1, 1)
     prediction_processed_ts_ms = int((delta_ts.days * 24 * 60 * 60 + delta_ts.seconds) * 1000 + delta_ts.microseconds / 1000.0)
 
@@ -159,3 +272,52 @@ def predict_record(
     record['msgType'] = record['msgType'].replace('request', 'response')
 
     return record
+
+
+def predict_record(
+        record, stoi, model, vader_analyzer,
+        itos_file_path, trained_classifier_file_path, input_data_file_path, tokenizer_service=None, prediction_cache=None
+):
+    return predict_records(
+        [record], stoi, model, vader_analyzer, itos_file_path, trained_classifier_file_path, input_data_file_path,
+        1, tokenizer_service, prediction_cache
+    )[0]
+
+
+def predict_records(
+        records, stoi, model, vader_analyzer,
+        itos_file_path, trained_classifier_file_path, input_data_file_path, max_batch_size=32, tokenizer_service=None,
+        prediction_cache=None
+):
+    """Batched version of predict_record. All the records must be associated to the same model.
+
+    If a PredictionCache is given, only the texts missing from it go through the classifier and VADER.
+    """
+    texts = [record['data']['text'] for record in records]
+
+    if prediction_cache:
+        cached = [prediction_cache.get(trained_classifier_file_path, itos_file_path, text) for text in texts]
+    else:
+        cached = [None] * len(texts)
+
+    # Repeated texts within the batch are only predicted once.
+    missing_texts = list(dict.fromkeys(text for text, values in zip(texts, cached) if values is None))
+    predicted = {}
+
+    if len(missing_texts) > 0:
+        # Softmax: model_scores[1] (bull) + model_scores[0] (bear) = 1.0
+        scores = predict_texts_sentiment(stoi, model, missing_texts, tokenizer_service, max_batch_size)
+
+        for text, text_scores in zip(missing_texts, scores):
+            predicted[text] = (text_scores[0], text_scores[1], predict_text_sentiment_vader_normalized(vader_analyzer, text))
+
+        if prediction_cache:
+            prediction_cache.put_many(trained_classifier_file_path, itos_file_path, predicted.items())
+
+    for record, text, values in zip(records, texts, cached):
+        bear, bull, vader_score = values or predicted[text]
+        annotate_record(
+            record, (bear, bull), vader_score, itos_file_path, trained_classifier_file_path, input_data_file_path
+        )
+
+    return records
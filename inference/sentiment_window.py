@@ -0,0 +1,125 @@
+import heapq
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import logging
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+SENTIMENT_TYPE_BY_POST_TYPE = {
+    'stocktwit': 'stocktwits',
+    'twitter-topic': 'twitter',
+    'twitter-user': 'twitter',
+}
+
+
+def contribution(impact, sentiment_mixed) -> Optional[float]:
+    # Same as impact*(sentiment_mixed-0.5) in SQL, where NULLs are ignored by AVG.
+    if impact is None or sentiment_mixed is None:
+        return None
+
+    return float(impact) * (float(sentiment_mixed) - 0.5)
+
+
+class RollingSentimentAggregator:
+    """In-process equivalent of AVG(impact*(sentiment_mixed-0.5)) per sentiment type over several sliding windows.
+
+    Keeps a running sum and count per (sentiment type, window). Posts are added with upsert, their impact changed with
+    update_impact, and they're expired from each window once created_at_epoch_ms falls behind it.
+    """
+
+    def __init__(self, window_seconds: Iterable[int]=(12 * 3600,)):
+        self.window_seconds = sorted(set(int(w) for w in window_seconds))
+        self.posts = {}  # (post_type, post_id) -> (created_at_epoch_ms, impact, sentiment_mixed)
+        self.members = {w: set() for w in self.window_seconds}
+        self.expiry_heaps = {w: [] for w in self.window_seconds}
+        sentiment_types = set(SENTIMENT_TYPE_BY_POST_TYPE.values())
+        self.sums = {(t, w): 0.0 for t in sentiment_types for w in self.window_seconds}
+        self.counts = {(t, w): 0 for t in sentiment_types for w in self.window_seconds}
+
+    def _add(self, key, window, sign):
+        created_at_epoch_ms, impact, sentiment_mixed = self.posts[key]
+        value = contribution(impact, sentiment_mixed)
+
+        if value is not None:
+            stats_key = (SENTIMENT_TYPE_BY_POST_TYPE[key[0]], window)
+            self.sums[stats_key] += sign * value
+            self.counts[stats_key] += sign
+
+    def _remove_from_windows(self, key):
+        for w in self.window_seconds:
+            if key in self.members[w]:
+                self._add(key, w, -1)
+                self.members[w].discard(key)
+
+    def upsert(self, post_type, post_id, created_at_epoch_ms, impact, sentiment_mixed, now_ms):
+        if post_type not in SENTIMENT_TYPE_BY_POST_TYPE:
+            return
+
+        key = (post_type, int(post_id))
+
+        if key in self.posts:
+            self._remove_from_windows(key)
+
+        self.posts[key] = (int(created_at_epoch_ms), impact, sentiment_mixed)
+
+        for w in self.window_seconds:
+            if created_at_epoch_ms >= now_ms - w * 1000:
+                self.members[w].add(key)
+                self._add(key, w, 1)
+                heapq.heappush(self.expiry_heaps[w], (int(created_at_epoch_ms), key))
+
+        if not any(key in self.members[w] for w in self.window_seconds):
+            del self.posts[key]
+
+    def update_impact(self, post_type, post_id, impact):
+        """Apply the impact delta of a post to every window it still belongs to. Unknown posts are ignored."""
+        key = (post_type, int(post_id))
+
+        if key not in self.posts:
+            return
+
+        windows = [w for w in self.window_seconds if key in self.members[w]]
+
+        for w in windows:
+            self._add(key, w, -1)
+
+        created_at_epoch_ms, _, sentiment_mixed = self.posts[key]
+        self.posts[key] = (created_at_epoch_ms, impact, sentiment_mixed)
+
+        for w in windows:
+            self._add(key, w, 1)
+
+    def expire(self, now_ms):
+        largest_window = self.window_seconds[-1]
+
+        for w in self.window_seconds:
+            cutoff_ms = now_ms - w * 1000
+            heap = self.expiry_heaps[w]
+
+            while heap and heap[0][0] < cutoff_ms:
+                created_at_epoch_ms, key = heapq.heappop(heap)
+
+                # Entries may be stale, if the post was upserted again since.
+                if key in self.members[w] and self.posts[key][0] == created_at_epoch_ms:
+                    self._add(key, w, -1)
+                    self.members[w].discard(key)
+
+                    # The largest window holds every post still relevant.
+                    if w == largest_window:
+                        del self.posts[key]
+
+    def averages(self, now_ms) -> List[Tuple[str, int, Optional[float]]]:
+        """Return (sentiment_type, sentiment_seconds_back, average) rows. The average is None for empty windows."""
+        self.expire(now_ms)
+
+        return [
+            (sentiment_type, w, self.sums[(sentiment_type, w)] / count if count > 0 else None)
+            for (sentiment_type, w), count in sorted(self.counts.items())
+        ]
+
+    def stats(self) -> Dict[str, object]:
+        return {
+            'posts': len(self.posts),
+            'counts': {f'{t}/{w}': c for (t, w), c in sorted(self.counts.items())},
+        }
@@ -0,0 +1,123 @@
+import bisect
+import re
+from collections import Counter
+from typing import Iterable, List, Optional, Sequence
+
+import logging
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+DEFAULT_TOPICS = ['elon musk', 'tesla', 'tsla', 'tslaq', 'elonmusk', 'model 3']
+RETWEET_PREFIX = 'rt '
+_SEPARATOR = '\x00'
+
+
+def trie_pattern(topics: Iterable[str]) -> str:
+    """Regex for the alternation of topics, with common prefixes factored out so re doesn't retry each topic in turn."""
+    trie = {}
+
+    for topic in topics:
+        node = trie
+
+        for char in topic:
+            node = node.setdefault(char, {})
+
+        node[''] = {}
+
+    def node_pattern(node):
+        terminal = '' in node
+        branches = [re.escape(char) + node_pattern(child) for char, child in sorted(node.items()) if char]
+
+        if not branches:
+            return ''
+
+        pattern = branches[0] if len(branches) == 1 else '(?:' + '|'.join(branches) + ')'
+
+        if terminal:
+            # Greedy optional, so the longest topic at a position wins.
+            pattern = (pattern if len(branches) > 1 else '(?:' + pattern + ')') + '?'
+
+        return pattern
+
+    return node_pattern(trie)
+
+
+def load_topics(topics: Optional[str]=None, topics_file_path: Optional[str]=None) -> List[str]:
+    """Comma separated topics plus one topic per line from topics_file_path (# comments allowed). Defaults to DEFAULT_TOPICS."""
+    loaded = []
+
+    if topics:
+        loaded.extend(topics.split(','))
+
+    if topics_file_path:
+        with open(topics_file_path, 'r', encoding='utf-8') as f:
+            loaded.extend(line for line in f if not line.lstrip().startswith('#'))
+
+    loaded = [topic.strip().lower() for topic in loaded if topic.strip()]
+    return loaded if loaded else list(DEFAULT_TOPICS)
+
+
+class TopicMatcher:
+    """Substring match of a batch of texts against many topics at once.
+
+    The topics are compiled into one regex (a prefix trie, see trie_pattern), and the lowercased texts of a batch are joined
+    with NUL separators so that a single scan covers the whole batch. Hits are counted per topic and per post, so a post
+    mentioning $TSLA twice counts once. As the alternation is leftmost-longest per position, a topic that is a prefix of
+    a longer one at the same position (tsla in tslaq) is credited to the longer one only.
+    """
+
+    def __init__(self, topics: Iterable[str]=DEFAULT_TOPICS):
+        self.topics = sorted(set(topic.lower() for topic in topics if topic))
+
+        if not self.topics:
+            raise ValueError('TopicMatcher needs at least one topic')
+
+        self.pattern = re.compile(trie_pattern(self.topics))
+        self.hits = Counter()
+        self.texts_seen = 0
+        self.texts_matched = 0
+        self.retweets_skipped = 0
+
+    def match(self, texts: Sequence[str], skip_retweets: bool=True) -> List[bool]:
+        """For every text, whether it mentions any topic (and, with skip_retweets, isn't a retweet)."""
+        lowered = [str(text).lower().replace(_SEPARATOR, ' ') for text in texts]
+        matched = [False] * len(lowered)
+
+        if not lowered:
+            return matched
+
+        starts = []
+        offset = 0
+
+        for text in lowered:
+            starts.append(offset)
+            offset += len(text) + 1
+
+        hits_in_batch = set()
+
+        for m in self.pattern.finditer(_SEPARATOR.join(lowered)):
+            index = bisect.bisect_right(starts, m.start()) - 1
+            matched[index] = True
+            hits_in_batch.add((index, m.group(0)))
+
+        self.hits.update(topic for _, topic in hits_in_batch)
+        self.texts_seen += len(lowered)
+
+        if skip_retweets:
+            for i, text in enumerate(lowered):
+                if matched[i] and text.startswith(RETWEET_PREFIX):
+                    matched[i] = False
+                    self.retweets_skipped += 1
+
+        self.texts_matched += sum(matched)
+        return matched
+
+    def stats(self, top_n: int=10) -> dict:
+        return {
+            'topics': len(self.topics),
+            'texts_seen': self.texts_seen,
+            'texts_matched': self.texts_matched,
+            'retweets_skipped': self.retweets_skipped,
+            'top_hits': self.hits.most_common(top_n),
+        }
@@ -0,0 +1,241 @@
+from inference import json_codec
+import os
+import socket
+import struct
+import time
+import traceback
+import logging
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+# Each frame is a 4 byte big endian payload length, then one compact JSON record.
+FRAME_HEADER = struct.Struct('>I')
+MAX_FRAME_BYTES = 16 * 1024 * 1024
+
+# What predict_cli and db_ingestor_cli read from a record. The rest of a tweet (entities, full user object, ...) is dropped.
+RECORD_FIELDS = ['msgType', 'clientReceivedTsMs', 'predictions']
+DATA_FIELDS = ['id', 'text', 'created_at']
+USER_FIELDS = ['username', 'screen_name']
+
+
+def prune_record(record):
+    data = record.get('data') or {}
+    pruned_data = {field: data[field] for field in DATA_FIELDS if field in data}
+    user = data.get('user') or {}
+    pruned_user = {field: user[field] for field in USER_FIELDS if field in user}
+
+    if pruned_user:
+        pruned_data['user'] = pruned_user
+
+    pruned = {field: record[field] for field in RECORD_FIELDS if field in record}
+    pruned['data'] = pruned_data
+    return pruned
+
+
+def encode_frames(records, prune=True):
+    frames = []
+
+    for record in records:
+        payload = json_codec.dumps(prune_record(record) if prune else record).encode('utf-8')
+        frames.append(FRAME_HEADER.pack(len(payload)))
+        frames.append(payload)
+
+    return b''.join(frames)
+
+
+def decode_frames(buffer):
+    """(records, bytes consumed) for the complete frames at the start of buffer."""
+    records = []
+    position = 0
+
+    while len(buffer) - position >= FRAME_HEADER.size:
+        (length,) = FRAME_HEADER.unpack_from(buffer, position)
+
+        if length > MAX_FRAME_BYTES:
+            raise ValueError(f'Frame of {length} bytes, the stream is out of sync')
+
+        end = position + FRAME_HEADER.size + length
+
+        if end > len(buffer):
+            break
+
+        payload = bytes(buffer[position + FRAME_HEADER.size:end])
+        position = end
+
+        try:
+            records.append(json_codec.loads(payload))
+        except Exception:
+            logger.error(f'JSON parsing failed for frame {payload}: {traceback.format_exc()}')
+
+    return records, position
+
+
+class RecordSender:
+    """Upstream end of a Unix socket between two pipeline stages, in place of printing JSON lines to stdout.
+
+    send() blocks while the socket buffer is full, i.e. while the downstream stage is behind, so a slow stage throttles
+    the one before it the way a full pipe does. Connecting is retried until the downstream stage is listening, and after a
+    broken connection the records are sent again on the new one.
+    """
+
+    def __init__(self, socket_path, prune=True, retry_ms=500, send_buffer_bytes=None):
+        self.socket_path = socket_path
+        self.prune = prune
+        self.retry_ms = retry_ms
+        self.send_buffer_bytes = send_buffer_bytes
+        self.sock = None
+        self.stats = {'records': 0, 'bytes': 0, 'send_ms': 0, 'reconnects': 0}
+
+    def connect(self):
+        waited_ms = 0
+
+        while True:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+
+            if self.send_buffer_bytes:
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, self.send_buffer_bytes)
+
+            try:
+                sock.connect(self.socket_path)
+                self.sock = sock
+                logger.info(f'Connected to {self.socket_path}')
+                return self
+            except (FileNotFoundError, ConnectionRefusedError):
+                sock.close()
+
+                if waited_ms % 10000 < self.retry_ms:
+                    logger.info(f'Waiting for a listener on {self.socket_path}')
+
+                time.sleep(self.retry_ms / 1000)
+                waited_ms += self.retry_ms
+
+    def send(self, records):
+        if not records:
+            return
+
+        data = encode_frames(records, self.prune)
+
+        while True:
+            if self.sock is None:
+                self.connect()
+
+            started_at = time.time()
+
+            try:
+                self.sock.sendall(data)
+                break
+            except OSError:
+                logger.error(f'Send to {self.socket_path} failed, reconnecting: {traceback.format_exc()}')
+                self.sock.close()
+                self.sock = None
+                self.stats['reconnects'] += 1
+            finally:
+                self.stats['send_ms'] += int((time.time() - started_at) * 1000)
+
+        self.stats['records'] += len(records)
+        self.stats['bytes'] += len(data)
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+
+class RecordReceiver:
+    """Downstream end of a Unix socket between two pipeline stages. It listens on socket_path and accepts one upstream
+    stage at a time, taking the next one when it disconnects (e.g. after a restart).
+
+    Nothing is read ahead of batches(): unread records wait in the socket buffers and hold the sender back.
+    """
+
+    def __init__(self, socket_path, recv_bytes=256 * 1024):
+        self.socket_path = socket_path
+        self.recv_bytes = recv_bytes
+        self.conn = None
+        self.buffer = bytearray()
+        self.stats = {'records': 0, 'bytes': 0, 'connections': 0}
+
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+
+        self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.server.bind(socket_path)
+        self.server.listen(1)
+        logger.info(f'Listening on {socket_path}')
+
+    def _accept(self):
+        self.conn, _ = self.server.accept()
+        self.stats['connections'] += 1
+        logger.info(f'Upstream stage connected to {self.socket_path}')
+
+    def _receive(self, timeout_s):
+        """Records decoded from one recv, None if nothing arrived within timeout_s or the upstream stage disconnected."""
+        if self.conn is None:
+            self._accept()
+
+        self.conn.settimeout(timeout_s)
+
+        try:
+            data = self.conn.recv(self.recv_bytes)
+        except (socket.timeout, BlockingIOError):
+            return None
+
+        if not data:
+            if self.buffer:
+                logger.error(f'Upstream stage disconnected in the middle of a frame, dropping {len(self.buffer)} bytes')
+
+            self.buffer.clear()
+            self.conn.close()
+            self.conn = None
+            return None
+
+        self.buffer += data
+
+        try:
+            records, consumed = decode_frames(self.buffer)
+        except ValueError:
+            # Nothing more on this connection can be trusted. The sender reconnects and carries on.
+            logger.error(f'Dropping the connection on {self.socket_path}: {traceback.format_exc()}')
+            self.buffer.clear()
+            self.conn.close()
+            self.conn = None
+            return None
+
+        del self.buffer[:consumed]
+        self.stats['records'] += len(records)
+        self.stats['bytes'] += len(data)
+        return records
+
+    def batches(self, batch_size, max_wait_ms=None):
+        """Same contract as message_utils.read_batches: a batch goes out when it has batch_size records, or max_wait_ms
+        after its first record. Without max_wait_ms, whatever has arrived goes out right away.
+        """
+        pending = []
+
+        while True:
+            while not pending:
+                pending = self._receive(None) or []
+
+            deadline = time.monotonic() + (max_wait_ms or 0) / 1000
+
+            while len(pending) < batch_size and self.conn is not None:
+                remaining = deadline - time.monotonic()
+                records = self._receive(max(remaining, 0))
+
+                if records is None:
+                    break
+
+                pending.extend(records)
+
+            yield pending[:batch_size]
+            pending = pending[batch_size:]
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+
+        self.server.close()
+
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
@@ -0,0 +1,226 @@
+import matplotlib
+matplotlib.use('TkAgg')
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import functools
+from inference import db_schema
+from inference import db_utils
+from inference import message_utils
+from inference import sentiment_inference
+from inference import topic_filter
+from inference.async_pipeline import AsyncPipeline, Stage
+from inference.dedup_index import DedupIndex
+from inference.global_sentiment import ImpactRecalculator, RecomputeScheduler
+from inference.inference_pool import InferencePool, share_models
+from inference.prediction_cache import PredictionCache
+import filter_posts_for_predict_cli
+import predict_cli
+import os
+import sys
+import time
+sys.excepthook = sys.__excepthook__  # See https://groups.io/g/insync/topic/13778827?p=,,,20,0,0,0::recentpostdate%2Fsticky,,,20,2,0,13778827
+
+import logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+
+def filtered_batches(input_data_file_path, batch_size, sleep_ms, processed_posts, max_wait_ms, framing, topic_matcher):
+    for batch in filter_posts_for_predict_cli.filter_input(
+        input_data_file_path, batch_size, sleep_ms, processed_posts, max_wait_ms, framing, topic_matcher
+    ):
+        yield batch
+        processed_posts.maybe_snapshot()
+
+
+def lookup_batch(batch, db_args, lookup_chunk_size):
+    filter_posts_for_predict_cli.drop_processed_posts(batch, *db_args, lookup_chunk_size)
+    return [filter_posts_for_predict_cli.transform_record_for_prediction(record) for record in batch.values()]
+
+
+def predict_batch(msgs, models, vader_analyzer, inference_batch_size, tokenizer_service, prediction_cache):
+    return predict_cli.predict_msgs(models, msgs, vader_analyzer, None, inference_batch_size, tokenizer_service, prediction_cache)
+
+
+def ingest_batch(msgs, base, engine, write_mode, scheduler=None):
+    db_utils.ingest_msgs(base, engine, msgs, write_mode)
+    p50_latency_ms, max_latency_ms = message_utils.end_to_end_latency_ms(msgs)
+    logger.info(f'End to end latency since clientReceivedTsMs: p50={p50_latency_ms} ms, max={max_latency_ms} ms')
+
+    if scheduler:
+        scheduler.request()
+
+
+if __name__ == '__main__':
+    ssh_username = os.getenv('AUTOMLPREDICTOR_DB_SSH_USER')
+    ssh_password = os.getenv('AUTOMLPREDICTOR_DB_SSH_PASSWORD')
+    db_host = os.getenv('AUTOMLPREDICTOR_DB_SERVER_IP', '127.0.0.1')
+    db_user = os.getenv('AUTOMLPREDICTOR_DB_SQL_USER', 'root')
+    db_password = os.getenv('AUTOMLPREDICTOR_DB_SQL_PASSWORD')
+    db_port = 3306
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-sif', '--stocktwits_itos_file_path', help='Stocktwits itos.pkl', type=str, required=True)
+    parser.add_argument('-stcf', '--stocktwits_trained_classifier_file_path', help='Stocktwits classifier .h5', type=str, required=True)
+    parser.add_argument('-tif', '--twitter_itos_file_path', help='Twitter itos.pkl', type=str, required=True)
+    parser.add_argument('-ttcf', '--twitter_trained_classifier_file_path', help='Twitter classifier .h5', type=str, required=True)
+
+    parser.add_argument('-db', '--database_name', help='Database where to store the data', type=str, default='automlpredictor_db_dashboard')
+    parser.add_argument(
+        '-idf', '--input_data_file_path', help='Path for the data file. If not specified, we\'ll read the data from stdin',
+        type=str, required=False
+    )
+    parser.add_argument('-bs', '--batch_size', help='Number of records per read.', type=int, default=50)
+    parser.add_argument('-s', '--sleep_ms', help='Sleep in millisecs', type=int, default=1000)
+    parser.add_argument(
+        '-mw', '--max_wait_ms', help='Emit a partial batch this many millisecs after its first record, instead of polling and sleeping',
+        type=int, required=False
+    )
+    parser.add_argument(
+        '-fm', '--framing', help='Input framing. json: any JSON layout (splitstream). ndjson: one record per line, faster.',
+        type=str, default='json', choices=['json', 'ndjson']
+    )
+
+    parser.add_argument(
+        '-t', '--topics', help=f'Comma separated topics to keep tweets for. Defaults to {",".join(topic_filter.DEFAULT_TOPICS)}',
+        type=str, required=False
+    )
+    parser.add_argument('-tf', '--topics_file_path', help='File with one topic per line, added to --topics', type=str, required=False)
+    parser.add_argument('-dc', '--dedup_capacity', help='Post keys per dedup index partition', type=int, default=1000000)
+    parser.add_argument('-dfp', '--dedup_fp_rate', help='Target false positive rate per dedup index partition', type=float, default=1e-6)
+    parser.add_argument('-dp', '--dedup_partitions', help='Dedup index partitions', type=int, default=4)
+    parser.add_argument('-dps', '--dedup_partition_seconds', help='Seconds before a new dedup index partition is started', type=int, default=6 * 3600)
+    parser.add_argument('-dsf', '--dedup_snapshot_file_path', help='Dedup index snapshot. No persistence if not specified', type=str, required=False)
+    parser.add_argument('-dsi', '--dedup_snapshot_interval_seconds', help='Seconds between dedup index snapshots', type=int, default=300)
+    parser.add_argument('-lcs', '--lookup_chunk_size', help='Post ids per already processed lookup query', type=int, default=500)
+
+    parser.add_argument('-smd', '--saved_model_dir', help='See predict_cli', type=str, required=False)
+    parser.add_argument('-ibs', '--inference_batch_size', help='Max number of records per forward pass.', type=int, default=32)
+    parser.add_argument(
+        '-tw', '--tokenizer_workers', help='Size of the persistent tokenizer process pool. 0 tokenizes in process.', type=int, default=0
+    )
+    parser.add_argument(
+        '-pcs', '--prediction_cache_size', help='Entries in the in-memory prediction cache. 0 disables the cache.', type=int, default=10000
+    )
+    parser.add_argument('-pcf', '--prediction_cache_file', help='SQLite file for the on-disk prediction cache tier', type=str, required=False)
+
+    parser.add_argument('-wm', '--write_mode', help='See db_ingestor_cli', type=str, default='merge', choices=['merge', 'bulk'])
+    parser.add_argument('-sm', '--schema_mode', help='See db_ingestor_cli', type=str, default='reflect', choices=['reflect', 'declared', 'cached'])
+    parser.add_argument('-scf', '--schema_cache_file', help='Metadata cache for schema_mode=cached', type=str, default='automlpredictor_db_schema.pkl')
+
+    parser.add_argument('-lc', '--lookup_concurrency', help='Batches checked against the db at the same time', type=int, default=2)
+    parser.add_argument(
+        '-pc', '--predict_concurrency',
+        help='Batches predicted at the same time. Above 1, each runs in its own inference worker process (see predict_cli --workers)',
+        type=int, default=1
+    )
+    parser.add_argument('-ic', '--ingest_concurrency', help='Batches written to the db at the same time', type=int, default=2)
+    parser.add_argument('-qs', '--queue_size', help='Max batches waiting in front of each stage', type=int, default=10)
+    parser.add_argument('-si', '--stats_interval_s', help='Seconds between pipeline stats log lines', type=int, default=60)
+
+    parser.add_argument(
+        '-gs', '--global_sentiment', help='Also run the global sentiment recompute cycles (global_sentiment_update_cli) in process',
+        action='store_true', required=False
+    )
+    parser.add_argument('-mi', '--min_interval_ms', help='Min millisecs between recompute cycles', type=int, default=5000)
+    parser.add_argument('-ir', '--impact_recalculation_ms', help='Max millisecs between recompute cycles', type=int, default=30000)
+    parser.add_argument('-inc', '--incremental_impact', help='See global_sentiment_update_cli', action='store_true', required=False)
+    parser.add_argument('-ra', '--rolling_aggregator', help='See global_sentiment_update_cli', action='store_true', required=False)
+    parser.add_argument('-ssh', '--ssh', help='Use ssh', action='store_true', required=False)
+
+    args = parser.parse_args()
+    database_name = str(args.database_name)
+    db_args = (args.ssh, db_host, db_user, db_password, db_port, database_name, ssh_username, ssh_password)
+
+    topic_matcher = topic_filter.TopicMatcher(topic_filter.load_topics(args.topics, args.topics_file_path))
+    processed_posts = DedupIndex(
+        int(args.dedup_capacity), float(args.dedup_fp_rate), int(args.dedup_partitions), int(args.dedup_partition_seconds),
+        args.dedup_snapshot_file_path, int(args.dedup_snapshot_interval_seconds)
+    )
+    logger.info(f'Dedup index ready: {processed_posts.stats()}')
+
+    lookup_concurrency = int(args.lookup_concurrency)
+    predict_concurrency = int(args.predict_concurrency)
+    ingest_concurrency = int(args.ingest_concurrency)
+    queue_size = int(args.queue_size)
+    tokenizer_workers = int(args.tokenizer_workers)
+
+    if predict_concurrency > 1 and tokenizer_workers > 0:
+        logger.warning(f'Ignoring --tokenizer_workers {tokenizer_workers}: with --predict_concurrency > 1, each inference worker tokenizes its own batches.')
+        tokenizer_workers = 0
+
+    # Spawn the tokenizer workers before loading the models, so that they don't inherit them.
+    tokenizer_service = sentiment_inference.get_tokenizer_service(tokenizer_workers)
+    models = predict_cli.load_models(
+        args.stocktwits_itos_file_path, args.stocktwits_trained_classifier_file_path,
+        args.twitter_itos_file_path, args.twitter_trained_classifier_file_path, args.saved_model_dir
+    )
+    prediction_cache_size = int(args.prediction_cache_size)
+    inference_pool = None
+
+    if predict_concurrency > 1:
+        # Processes, not threads: the models keep per batch state (hidden, bs) and the tokenizer holds the GIL. Forked
+        # before the db connections, the ssh tunnel and the threads are set up.
+        share_models(models)
+        inference_pool = InferencePool(
+            functools.partial(predict_cli.predict_msgs_in_worker, models, None, int(args.inference_batch_size)), predict_concurrency,
+            initializer=functools.partial(predict_cli.init_predict_worker, prediction_cache_size, args.prediction_cache_file)
+        )
+        logger.info(f'Started {predict_concurrency} inference workers')
+    else:
+        vader_analyzer = sentiment_inference.load_vader_analyzer()
+        prediction_cache = PredictionCache(prediction_cache_size, args.prediction_cache_file) if prediction_cache_size > 0 else None
+
+    engine, ssh_server = db_utils.reconnect_db(
+        args.ssh, db_host, database_name, db_user, db_password, db_port, ssh_username, ssh_password, 'utf8mb4'
+    )
+    Base = db_schema.prepare_base(engine, str(args.schema_mode), str(args.schema_cache_file))
+    scheduler = None
+
+    if args.global_sentiment:
+        recalculator = ImpactRecalculator(db_args, args.incremental_impact, rolling_aggregator=args.rolling_aggregator)
+        # Its own thread, so a slow cycle (e.g. a full resync of the 12 hours window) never holds up ingestion.
+        scheduler = RecomputeScheduler(recalculator.run_cycle, int(args.min_interval_ms), int(args.impact_recalculation_ms)).start()
+
+    # DB work only waits on the network, so a thread per concurrent batch. Predict threads either run the single in process
+    # predict, or wait on an inference worker each.
+    db_executor = ThreadPoolExecutor(lookup_concurrency + ingest_concurrency, thread_name_prefix='db')
+    predict_executor = ThreadPoolExecutor(predict_concurrency, thread_name_prefix='predict')
+
+    if inference_pool:
+        predict_work = inference_pool.predict
+    else:
+        predict_work = functools.partial(
+            predict_batch, models=models, vader_analyzer=vader_analyzer, inference_batch_size=int(args.inference_batch_size),
+            tokenizer_service=tokenizer_service, prediction_cache=prediction_cache
+        )
+
+    stages = [
+        Stage('lookup', lambda batch: lookup_batch(batch, db_args, int(args.lookup_chunk_size)), db_executor, lookup_concurrency, queue_size),
+        Stage('predict', predict_work, predict_executor, predict_concurrency, queue_size),
+        Stage('ingest', lambda msgs: ingest_batch(msgs, Base, engine, str(args.write_mode), scheduler), db_executor, ingest_concurrency, queue_size),
+    ]
+    source = filtered_batches(
+        args.input_data_file_path, int(args.batch_size), int(args.sleep_ms), processed_posts, args.max_wait_ms, str(args.framing),
+        topic_matcher
+    )
+    started_at = time.time()
+
+    try:
+        AsyncPipeline(source, stages, int(args.stats_interval_s)).run()
+    finally:
+        logger.info(f'Pipeline ran for {int(time.time() - started_at)} s')
+
+        if scheduler:
+            scheduler.stop()
+
+        for executor in [predict_executor, db_executor]:
+            executor.shutdown(wait=False)
+
+        if inference_pool:
+            inference_pool.terminate()
+
+        if args.dedup_snapshot_file_path:
+            processed_posts.save_snapshot()
+
+        db_utils.close_pools()
@@ -2,9 +2,13 @@ import matplotlib
 matplotlib.use('TkAgg')
 from inference import sentiment_inference
 from inference import message_utils
+from inference.prediction_cache import PredictionCache
+from inference.inference_pool import InferencePool, share_models
 import argparse
-import json
+from inference import json_codec
+from inference import transport
 from collections import namedtuple
+import functools
 import sys
 import os
 sys.excepthook = sys.__excepthook__  # See https://groups.io/g/insync/topic/13778827?p=,,,20,0,0,0::recentpostdate%2Fsticky,,,20,2,0,13778827
@@ -20,7 +24,7 @@ Model = namedtuple('Model', ['stoi', 'classification_model', 'itos_file_path', '
 # TODO: Generalise at strike 3.
 def load_models(
     _stocktwits_itos_file_path, _stocktwits_trained_classifier_file_path,
-    _twitter_itos_file_path, _twitter_trained_classifier_file_path
+    _twitter_itos_file_path, _twitter_trained_classifier_file_path, saved_model_dir=None
 ):
 
     for path in [
@@ -31,8 +35,12 @@ def load_models(
             logger.error(f'Could not find {path}')
             exit(-1)
 
-    stocktwits_stoi, stocktwits_model = sentiment_inference.load_model(_stocktwits_itos_file_path, _stocktwits_trained_classifier_file_path)
-    twitter_stoi, twitter_model = sentiment_inference.load_model(_twitter_itos_file_path, _twitter_trained_classifier_file_path)
+    stocktwits_stoi, stocktwits_model = sentiment_inference.load_model(
+        _stocktwits_itos_file_path, _stocktwits_trained_classifier_file_path, saved_model_dir
+    )
+    twitter_stoi, twitter_model = sentiment_inference.load_model(
+        _twitter_itos_file_path, _twitter_trained_classifier_file_path, saved_model_dir
+    )
 
     return {
         'stocktwit-sentiment-request': Model(stocktwits_stoi, stocktwits_model, _stocktwits_itos_file_path, _stocktwits_trained_classifier_file_path),
@@ -41,30 +49,101 @@ def load_models(
     }
 
 
-def predict_input(models, input_data_file_path, batch_size, sleep_ms):
-
+def predict_input(
+    models, input_data_file_path, batch_size, sleep_ms, inference_batch_size=32, per_record=False, prediction_cache=None,
+    max_wait_ms=None, framing='json', record_receiver=None, inference_pool=None
+):
+    """Yields the predicted records one input batch at a time, so that they can be written out in one go."""
     vader_analyzer = sentiment_inference.load_vader_analyzer()
+    tokenizer_service = sentiment_inference.get_tokenizer_service()
 
-    if input_data_file_path:
-        input_handle = open(input_data_file_path, 'r')
+    if record_receiver:
+        batches = record_receiver.batches(batch_size, max_wait_ms)
     else:
-        input_handle = sys.stdin
+        if input_data_file_path:
+            input_handle = open(input_data_file_path, 'r')
+        else:
+            input_handle = sys.stdin
+
+        batches = message_utils.read_batches(batch_size, input_handle, sleep_ms, max_wait_ms, framing)
+
+    if inference_pool:
+        for records in inference_pool.map_batches(batches):
+            logger.info(f'Predicted batch of {len(records)} messages. Inference pool stats: {inference_pool.stats}')
+            yield records
 
-    for input_msgs in message_utils.read_json_input(batch_size, input_handle, sleep_ms):
+        return
+
+    for input_msgs in batches:
         logger.info(f'Received batch of {len(input_msgs)} messages')
-        for record in input_msgs:
-            msg_type = record['msgType']
-            stoi = models[msg_type].stoi
-            model = models[msg_type].classification_model
-            itos_file_path = models[msg_type].itos_file_path
-            trained_classifier_file_path = models[msg_type].trained_classifier_file_path
-            logger.info(f'Predicting sentiment for {msg_type}')
-
-            yield(sentiment_inference.predict_record(
-                record, stoi, model, vader_analyzer, itos_file_path,
-                trained_classifier_file_path, input_data_file_path)
+
+        if per_record:
+            yield [
+                predict_msg(models, record, vader_analyzer, input_data_file_path, tokenizer_service, prediction_cache)
+                for record in input_msgs
+            ]
+        else:
+            yield predict_msgs(
+                models, input_msgs, vader_analyzer, input_data_file_path, inference_batch_size, tokenizer_service,
+                prediction_cache
             )
 
+        if prediction_cache:
+            logger.info(f'Prediction cache stats: {prediction_cache.stats()}')
+
+        if record_receiver:
+            logger.info(f'Transport stats: {record_receiver.stats}')
+
+
+def predict_msg(models, record, vader_analyzer, input_data_file_path, tokenizer_service=None, prediction_cache=None):
+    msg_type = record['msgType']
+    stoi = models[msg_type].stoi
+    model = models[msg_type].classification_model
+    itos_file_path = models[msg_type].itos_file_path
+    trained_classifier_file_path = models[msg_type].trained_classifier_file_path
+    logger.info(f'Predicting sentiment for {msg_type}')
+
+    return sentiment_inference.predict_record(
+        record, stoi, model, vader_analyzer, itos_file_path,
+        trained_classifier_file_path, input_data_file_path, tokenizer_service, prediction_cache
+    )
+
+
+def predict_msgs(
+    models, input_msgs, vader_analyzer, input_data_file_path, inference_batch_size, tokenizer_service=None,
+    prediction_cache=None
+):
+    # Message types sharing the same classifier (e.g. twitter-user and twitter-topic) go in the same forward pass.
+    groups = {}
+
+    for record in input_msgs:
+        model = models[record['msgType']]
+        groups.setdefault(model.trained_classifier_file_path, (model, []))[1].append(record)
+
+    for model, records in groups.values():
+        logger.info(f'Predicting sentiment for {len(records)} records with {model.trained_classifier_file_path}')
+        sentiment_inference.predict_records(
+            records, model.stoi, model.classification_model, vader_analyzer, model.itos_file_path,
+            model.trained_classifier_file_path, input_data_file_path, inference_batch_size, tokenizer_service,
+            prediction_cache
+        )
+
+    # Records are annotated in place, so we can keep the input order.
+    return input_msgs
+
+
+def init_predict_worker(prediction_cache_size, prediction_cache_file):
+    # Per worker: the SQLite connection of the cache can't be shared across processes.
+    prediction_cache = PredictionCache(prediction_cache_size, prediction_cache_file) if prediction_cache_size > 0 else None
+    return {'vader_analyzer': sentiment_inference.load_vader_analyzer(), 'prediction_cache': prediction_cache}
+
+
+def predict_msgs_in_worker(models, input_data_file_path, inference_batch_size, input_msgs, context):
+    return predict_msgs(
+        models, input_msgs, context['vader_analyzer'], input_data_file_path, inference_batch_size,
+        sentiment_inference.get_tokenizer_service(), context['prediction_cache']
+    )
+
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
@@ -81,6 +160,46 @@ if __name__ == '__main__':
     parser.add_argument('-idf', '--input_data_file_path', help='Path for the data file. If not specified, we\'ll read the data from stdin', type=str,
                         required=False)
     parser.add_argument('-s', '--sleep_ms', help='Sleep in millisecs', type=int, default=10)
+    parser.add_argument(
+        '-mw', '--max_wait_ms', help='Emit a partial batch this many millisecs after its first record, instead of polling and sleeping',
+        type=int, required=False
+    )
+    parser.add_argument(
+        '-fm', '--framing', help='Input framing. json: any JSON layout (splitstream). ndjson: one record per line, faster.',
+        type=str, default='json', choices=['json', 'ndjson']
+    )
+    parser.add_argument('-ibs', '--inference_batch_size', help='Max number of records per forward pass.', type=int, default=32)
+    parser.add_argument(
+        '-tw', '--tokenizer_workers', help='Size of the persistent tokenizer process pool. 0 tokenizes in process.', type=int, default=0
+    )
+    parser.add_argument(
+        '-pcs', '--prediction_cache_size', help='Entries in the in-memory prediction cache. 0 disables the cache.', type=int, default=10000
+    )
+    parser.add_argument(
+        '-pcf', '--prediction_cache_file', help='SQLite file for the on-disk prediction cache tier. If not specified, only the in-memory tier is used.',
+        type=str, required=False
+    )
+    parser.add_argument(
+        '-is', '--input_socket', help='Listen on this Unix socket for the filter stage, instead of reading stdin or --input_data_file_path',
+        type=str, required=False
+    )
+    parser.add_argument(
+        '-os', '--output_socket', help='Send the predictions to the db ingestor on this Unix socket, instead of printing them to stdout',
+        type=str, required=False
+    )
+    parser.add_argument(
+        '-smd', '--saved_model_dir', help='Directory where the loaded classifiers are saved whole, and loaded from on later runs (faster startup)',
+        type=str, required=False
+    )
+    parser.add_argument(
+        '-w', '--workers', help='Inference worker processes, each running whole batches. 0 predicts in process.', type=int, default=0
+    )
+    parser.add_argument('-wt', '--worker_threads', help='Torch intra-op threads per inference worker', type=int, default=1)
+    parser.add_argument(
+        '-uo', '--unordered', help='With --workers, emit each batch as soon as it is predicted instead of in input order',
+        action='store_true', required=False
+    )
+    parser.add_argument('-pr', '--per_record', help='Run one forward pass per record (legacy path)', action='store_true', required=False)
 
     args = parser.parse_args()
     stocktwits_itos_file_path = args.stocktwits_itos_file_path
@@ -90,14 +209,60 @@ if __name__ == '__main__':
     input_data_file_path = args.input_data_file_path
     batch_size = int(args.batch_size)
     sleep_ms = int(args.sleep_ms)
+    max_wait_ms = args.max_wait_ms
+    framing = str(args.framing)
+    inference_batch_size = int(args.inference_batch_size)
+    per_record = args.per_record
+    tokenizer_workers = int(args.tokenizer_workers)
+    prediction_cache_size = int(args.prediction_cache_size)
+    prediction_cache_file = args.prediction_cache_file
+    workers = int(args.workers)
+    # With workers, each one has its own cache (see init_predict_worker).
+    prediction_cache = PredictionCache(prediction_cache_size, prediction_cache_file) if prediction_cache_size > 0 and workers == 0 else None
+    record_receiver = transport.RecordReceiver(args.input_socket) if args.input_socket else None
+    record_sender = transport.RecordSender(args.output_socket) if args.output_socket else None
+
+    if workers > 0 and tokenizer_workers > 0:
+        logger.warning(f'Ignoring --tokenizer_workers {tokenizer_workers}: with --workers, each inference worker tokenizes its own batches.')
+        tokenizer_workers = 0
+
+    if workers > 0 and per_record:
+        logger.warning('Ignoring --per_record: with --workers, each inference worker predicts whole batches.')
+        per_record = False
+
+    # Spawn the tokenizer workers before loading the models, so that they don't inherit them.
+    sentiment_inference.get_tokenizer_service(tokenizer_workers)
 
 
     models = load_models(
         stocktwits_itos_file_path, stocktwits_trained_classifier_file_path,
-        twitter_itos_file_path, twitter_trained_classifier_file_path
+        twitter_itos_file_path, twitter_trained_classifier_file_path, args.saved_model_dir
     )
 
-    for record in predict_input(models, input_data_file_path, batch_size, sleep_ms):
-        logger.info(f"Predicted sentiment for {record['msgType']}")
-        json_record = json.dumps(record)
-        print(json_record)
+    inference_pool = None
+
+    if workers > 0:
+        # Forked after loading, so the workers get the models without loading or unpickling them again.
+        share_models(models)
+        inference_pool = InferencePool(
+            functools.partial(predict_msgs_in_worker, models, input_data_file_path, inference_batch_size), workers, not args.unordered,
+            threads_per_worker=int(args.worker_threads),
+            initializer=functools.partial(init_predict_worker, prediction_cache_size, prediction_cache_file)
+        )
+        logger.info(f'Started {workers} inference workers')
+
+    for records in predict_input(
+        models, input_data_file_path, batch_size, sleep_ms, inference_batch_size, per_record, prediction_cache, max_wait_ms, framing,
+        record_receiver, inference_pool
+    ):
+        logger.info(f'Predicted sentiment for {len(records)} records')
+
+        # One frame, or one flush, per batch.
+        if record_sender:
+            record_sender.send(records)
+            logger.info(f'Transport stats: {record_sender.stats}')
+        else:
+            for record in records:
+                print(json_codec.dumps(record))
+
+            sys.stdout.flush()
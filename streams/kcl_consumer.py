@@ -15,15 +15,133 @@
 
 # from __future__ import print_function
 import argparse
-import json
+import glob
 import os
 import sys
 sys.excepthook = sys.__excepthook__ # See https://groups.io/g/insync/topic/13778827?p=,,,20,0,0,0::recentpostdate%2Fsticky,,,20,2,0,13778827
 import time
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))  # The KCL runs us from streams/
+from inference import json_codec
 from amazon_kclpy import kcl
 from amazon_kclpy.v2 import processor
 
 
+class OutputWriter(object):
+    """
+    Appends deliveries to the output file, which stays open, in os.writes of whole lines of up to _MAX_WRITE_BYTES
+    (more only for a single bigger line). The KCL runs a process per shard, all appending to the same file, and
+    O_APPEND keeps each of those writes in one piece. Should one still come back short (e.g. the disk filling up), the
+    rest of it is written separately and may land after lines of other shards, splitting a line.
+
+    With segment_bytes or segment_seconds, each shard writes its own segment files instead
+    (<output_file>.<shard id>.<n>), rotated once they reach either bound. Every closed segment is fsynced and listed,
+    with the largest sequence number it holds, in <output_file>.<shard id>.index.
+
+    Tracks the largest (sequence number, sub sequence number) written and the largest one known to be on disk, which
+    is what may be checkpointed.
+    """
+    _MAX_WRITE_BYTES = 1 << 20
+
+    def __init__(self, output_file, shard_id=None, segment_bytes=0, segment_seconds=0):
+        self._output_file = output_file
+        self._shard_id = shard_id
+        self._segment_bytes = segment_bytes
+        self._segment_seconds = segment_seconds
+        self._segmented = bool(segment_bytes or segment_seconds)
+        self._index_file = '{f}.{s}.index'.format(f=output_file, s=shard_id)
+        self._fd = None
+        self._path = None
+        self._segment_number = self._next_segment_number() if self._segmented else 0
+        self._segment_size = 0
+        self._segment_started = None
+        self._written_seq = None
+        self._durable_seq = None
+        self._open()
+
+    def _next_segment_number(self):
+        numbers = [
+            int(path.rsplit('.', 1)[1]) for path in glob.glob('{f}.{s}.*'.format(f=self._output_file, s=self._shard_id))
+            if path.rsplit('.', 1)[1].isdigit()
+        ]
+        return max(numbers) + 1 if numbers else 0
+
+    def _open(self):
+        if self._segmented:
+            self._path = '{f}.{s}.{n:06d}'.format(f=self._output_file, s=self._shard_id, n=self._segment_number)
+        else:
+            self._path = self._output_file
+
+        self._fd = os.open(self._path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        self._segment_size = 0
+        self._segment_started = time.time()
+
+    def write(self, lines, largest_seq):
+        """
+        Appends lines (bytes, no trailing newline), and notes largest_seq as written.
+        """
+        chunk = []
+        chunk_size = 0
+
+        for line in lines:
+            if chunk and chunk_size + len(line) + 1 > self._MAX_WRITE_BYTES:
+                self._write_chunk(chunk)
+                chunk = []
+                chunk_size = 0
+
+            chunk.append(line)
+            chunk_size += len(line) + 1
+
+        if chunk:
+            self._write_chunk(chunk)
+
+        if largest_seq != (None, None):
+            self._written_seq = largest_seq
+
+        if self._segmented and self._segment_size and (
+            (self._segment_bytes and self._segment_size >= self._segment_bytes) or
+            (self._segment_seconds and time.time() - self._segment_started >= self._segment_seconds)
+        ):
+            self._rotate()
+
+    def _write_chunk(self, chunk):
+        payload = memoryview(b'\n'.join(chunk) + b'\n')
+        self._segment_size += len(payload)
+        written = os.write(self._fd, payload)
+
+        while written < len(payload):
+            sys.stderr.write('Short write to {p}: {w} of {n} bytes, appending the rest\n'.format(
+                p=self._path, w=written, n=len(payload)
+            ))
+            payload = payload[written:]
+            written = os.write(self._fd, payload)
+
+    def _rotate(self):
+        self.sync()
+        os.close(self._fd)
+
+        with open(self._index_file, 'a') as index:
+            index.write('{p}\t{s}\n'.format(p=self._path, s=self._durable_seq[0] if self._durable_seq else ''))
+            index.flush()
+            os.fsync(index.fileno())
+
+        self._segment_number += 1
+        self._open()
+
+    def sync(self):
+        """
+        Makes everything written so far durable and returns the largest sequence it covers, or None.
+        """
+        os.fsync(self._fd)
+        self._durable_seq = self._written_seq
+        return self._durable_seq
+
+    def close(self):
+        if self._fd is not None:
+            self.sync()
+            os.close(self._fd)
+            self._fd = None
+
+
 class RecordProcessor(processor.RecordProcessorBase):
     """
     A RecordProcessor processes data from a shard in a stream. Its methods will be called with this pattern:
@@ -33,8 +151,12 @@ class RecordProcessor(processor.RecordProcessorBase):
     * shutdown will be called if this MultiLangDaemon instance loses the lease to this shard, or the shard ends due
         a scaling change.
     """
-    def __init__(self, output_file):
+    def __init__(self, output_file, writer_mode='reopen', segment_bytes=0, segment_seconds=0):
         self._output_file = output_file
+        self._writer_mode = writer_mode
+        self._segment_bytes = segment_bytes
+        self._segment_seconds = segment_seconds
+        self._writer = None
         self._SLEEP_MILLISECONDS = 1000
         self._CHECKPOINT_RETRIES = 5
         self._CHECKPOINT_FREQ_SECONDS = 60
@@ -52,6 +174,11 @@ class RecordProcessor(processor.RecordProcessorBase):
         self._largest_seq = (None, None)
         self._last_checkpoint_time = time.time()
 
+        if self._writer_mode == 'buffered':
+            self._writer = OutputWriter(
+                self._output_file, initialize_input.shard_id, self._segment_bytes, self._segment_seconds
+            )
+
     def checkpoint(self, checkpointer, sequence_number=None, sub_sequence_number=None):
         """
         Checkpoints with retries on retryable exceptions.
@@ -103,19 +230,23 @@ class RecordProcessor(processor.RecordProcessorBase):
         # Insert your processing logic here
         ####################################
         # sys.stderr.write(data)
-        file_handler.write(json.dumps(json.loads(data)) + '\n')
+        # A record may hold several newline separated JSON lines if the producer aggregates them.
+        for line in json_codec.split_lines(data):
+            file_handler.write(json_codec.dumps(json_codec.loads(line)) + '\n')
         return
 
-    def should_update_sequence(self, sequence_number, sub_sequence_number):
+    def should_update_sequence(self, sequence_number, sub_sequence_number, largest_seq=None):
         """
         Determines whether a new larger sequence number is available
 
         :param int sequence_number: the sequence number from the current record
         :param int sub_sequence_number: the sub sequence number from the current record
+        :param tuple or None largest_seq: what to compare with, instead of the largest sequence processed so far
         :return boolean: true if the largest sequence should be updated, false otherwise
         """
-        return self._largest_seq == (None, None) or sequence_number > self._largest_seq[0] or \
-            (sequence_number == self._largest_seq[0] and sub_sequence_number > self._largest_seq[1])
+        largest_seq = self._largest_seq if largest_seq is None else largest_seq
+        return largest_seq == (None, None) or sequence_number > largest_seq[0] or \
+            (sequence_number == largest_seq[0] and sub_sequence_number > largest_seq[1])
 
     def process_records(self, process_records_input):
         """
@@ -125,6 +256,10 @@ class RecordProcessor(processor.RecordProcessorBase):
         :param amazon_kclpy.messages.ProcessRecordsInput process_records_input: the records, and metadata about the
             records.
         """
+        if self._writer is not None:
+            self.process_records_buffered(process_records_input)
+            return
+
         try:
             with open(self._output_file, 'a') as file_handler:
 
@@ -147,6 +282,56 @@ class RecordProcessor(processor.RecordProcessorBase):
         except Exception as e:
             sys.stderr.write("Encountered an exception while processing records. Exception was {e}\n".format(e=e))
 
+    def process_records_buffered(self, process_records_input):
+        """
+        process_records for writer_mode='buffered': valid JSON lines are written as received, without re-encoding them,
+        in as few writes as possible. Checkpoints only cover what the writer has synced to disk.
+
+        A delivery that can't be written ends the process: checkpointing any later one would skip it. The KCL then
+        hands the shard to a new process, from the last checkpoint.
+
+        :param amazon_kclpy.messages.ProcessRecordsInput process_records_input: the records, and metadata about the
+            records.
+        """
+        lines = []
+        largest_seq = self._largest_seq
+
+        try:
+            for record in process_records_input.records:
+                # A record may hold several newline separated JSON lines if the producer aggregates them.
+                for line in json_codec.split_lines(record.binary_data):
+                    try:
+                        json_codec.loads(line)
+                        lines.append(line if isinstance(line, bytes) else line.encode('utf-8'))
+                    except Exception as e:
+                        sys.stderr.write('Skipping invalid JSON line {l}: {e}\n'.format(l=line[:200], e=e))
+
+                seq = int(record.sequence_number)
+                sub_seq = record.sub_sequence_number
+                if self.should_update_sequence(seq, sub_seq, largest_seq):
+                    largest_seq = (seq, sub_seq)
+
+            self._writer.write(lines, largest_seq)
+        except Exception as e:
+            # Raising wouldn't do: KCLProcess logs the exceptions of process_records and carries on with the next delivery.
+            sys.stderr.write("Failed to write a delivery, exiting to resume from the last checkpoint. Exception was {e}\n".format(e=e))
+            sys.stderr.flush()
+            os._exit(1)
+
+        self._largest_seq = largest_seq
+
+        try:
+            if time.time() - self._last_checkpoint_time > self._CHECKPOINT_FREQ_SECONDS:
+                durable_seq = self._writer.sync()
+
+                if durable_seq is not None:
+                    self.checkpoint(process_records_input.checkpointer, str(durable_seq[0]), durable_seq[1])
+
+                self._last_checkpoint_time = time.time()
+
+        except Exception as e:
+            sys.stderr.write("Encountered an exception while processing records. Exception was {e}\n".format(e=e))
+
     def shutdown(self, shutdown_input):
         """
         Called by a KCLProcess instance to indicate that this record processor should shutdown. After this is called,
@@ -171,6 +356,10 @@ class RecordProcessor(processor.RecordProcessorBase):
         :param amazon_kclpy.messages.ShutdownInput shutdown_input: Information related to the shutdown request
         """
         try:
+            if self._writer is not None:
+                self._writer.close()
+                self._writer = None
+
             if shutdown_input.reason == 'TERMINATE':
                 # Checkpointing with no parameter will checkpoint at the
                 # largest sequence number reached by this processor on this
@@ -185,9 +374,24 @@ class RecordProcessor(processor.RecordProcessorBase):
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument('-o', '--output_file_variable_name', help='Name of the variable with the output file path', type=str, required=True)
+    parser.add_argument(
+        '-wm', '--writer_mode', help='reopen: open the output file and re-encode every record per delivery. '
+                                     'buffered: keep it open, write valid JSON as is, one write per delivery (of up to 1 MiB)',
+        type=str, default='reopen', choices=['reopen', 'buffered']
+    )
+    parser.add_argument(
+        '-sb', '--segment_bytes', help='buffered only: rotate into per shard segment files of about this size. 0: a single file',
+        type=int, default=0
+    )
+    parser.add_argument(
+        '-ss', '--segment_seconds', help='buffered only: rotate into per shard segment files this often. 0: a single file',
+        type=int, default=0
+    )
     args = parser.parse_args()
     output_file_variable_name = str(args.output_file_variable_name)
     output_file = os.getenv(output_file_variable_name)
 
-    kcl_process = kcl.KCLProcess(RecordProcessor(output_file))
+    kcl_process = kcl.KCLProcess(
+        RecordProcessor(output_file, str(args.writer_mode), int(args.segment_bytes), int(args.segment_seconds))
+    )
     kcl_process.run()
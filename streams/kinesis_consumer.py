@@ -1,10 +1,15 @@
 import argparse
-from botocore.exceptions import ClientError
+from botocore.exceptions import BotoCoreError, ClientError
 import boto3
-import json
-from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+import os
+import random
+import sys
+import threading
 import time
-import _thread
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from inference import json_codec
+from streams.shard_checkpoints import ShardCheckpoints
 
 import traceback
 import logging
@@ -18,78 +23,322 @@ MAX_RETRIES = 5
 
 # arn:aws:kinesis:eu-west-1:631645402277:stream/automlpredictor-tesla-test
 
-def process_shard(shard, sleep_ms, shard_iterator_type, args):
-	shard_id = shard['ShardId']
-	logger.info(f'Reading from shard: {shard_id}')
+
+def backoff_seconds(retries, base_ms=250, cap_ms=30000):
+	# Full jitter: shards throttled together don't retry in lockstep, and the wait is capped.
+	return random.uniform(0, min(cap_ms, base_ms * 2 ** retries)) / 1000
+
+
+class OutputWriter:
+	"""Line writer shared by the shard readers. Each call writes its lines in one go, so records never interleave."""
+
+	def __init__(self, output_handle=sys.stdout):
+		self.output_handle = output_handle
+		self.lock = threading.Lock()
+		self.records = 0
+
+	def write(self, lines):
+		if not lines:
+			return
+
+		with self.lock:
+			self.output_handle.write('\n'.join(lines) + '\n')
+			self.output_handle.flush()
+			self.records += len(lines)
+
+
+def wait_before_retry(shard_id, retries, reason):
+	if retries >= MAX_RETRIES:
+		logger.error(f'Shard {shard_id} still failing after {retries} retries ({reason}). Keeping on at the capped backoff.')
+
+	wait_seconds = backoff_seconds(retries)
+	logger.warning(f'Slowing shard {shard_id} down for {wait_seconds:.2f} s ({reason}). Retries={retries}.')
+	time.sleep(wait_seconds)
+
+
+def get_shard_iterator(
+		kinesis_client, stream_name, shard_id, shard_iterator_type, since_ts_epoch_ms=None, starting_sequence_number=None
+):
+	# Valid Values: AT_SEQUENCE_NUMBER | AFTER_SEQUENCE_NUMBER | TRIM_HORIZON | LATEST | AT_TIMESTAMP
+	if shard_iterator_type == 'AT_TIMESTAMP':
+		shard_iterator = kinesis_client.get_shard_iterator(
+			StreamName=stream_name,
+			ShardId=shard_id,
+			ShardIteratorType=shard_iterator_type,
+			Timestamp=float(since_ts_epoch_ms) / 1000
+		)
+
+	elif shard_iterator_type in ['AT_SEQUENCE_NUMBER', 'AFTER_SEQUENCE_NUMBER']:
+		shard_iterator = kinesis_client.get_shard_iterator(
+			StreamName=stream_name,
+			ShardId=shard_id,
+			ShardIteratorType=shard_iterator_type,
+			StartingSequenceNumber=str(starting_sequence_number),
+		)
+	else:
+		shard_iterator = kinesis_client.get_shard_iterator(
+			StreamName=stream_name,
+			ShardId=shard_id,
+			ShardIteratorType=shard_iterator_type,
+		)
+
+	return shard_iterator['ShardIterator']
+
+
+def decode_records(records):
+	lines = []
+
+	for record in records:
+		# A record may hold several newline separated JSON lines if the producer aggregates them.
+		for data_record in json_codec.split_lines(record['Data']):
+			try:
+				lines.append(json_codec.dumps(json_codec.loads(data_record)))
+
+			except Exception as e:
+				logger.error(f'JSON parsing failed for record {data_record}: {traceback.format_exc()}')
+
+	return lines
+
+
+def process_shard(
+		kinesis_client, stream_name, shard_id, writer, batch_size, sleep_ms, shard_iterator_type, since_ts_epoch_ms=None,
+		starting_sequence_number=None, stop_event=None, checkpoints=None, positions=None
+):
+	"""Read a shard until it's closed (after a reshard) or stop_event is set. Returns True if the shard was closed.
+
+	positions maps shard ids to the sequence number of the last record written, and is kept up to date. A shard found
+	in it (a restarted reader), or else with a checkpoint, is resumed AFTER_SEQUENCE_NUMBER of it, whatever
+	shard_iterator_type says.
+	"""
+	last_sequence_number = positions.get(shard_id) if positions is not None else None
+
+	if last_sequence_number is None and checkpoints:
+		last_sequence_number = checkpoints.get(shard_id)
+
+	if last_sequence_number is not None:
+		logger.info(f'Reading from shard: {shard_id}, resuming after {last_sequence_number}')
+	else:
+		logger.info(f'Reading from shard: {shard_id}')
+
+	shard_iterator = None
+	retries = 0
+
+	while stop_event is None or not stop_event.is_set():
+		try:
+			if shard_iterator is None:
+				if last_sequence_number is not None:
+					# Expired iterator or transient failure: carry on right after the last record we wrote.
+					shard_iterator = get_shard_iterator(
+						kinesis_client, stream_name, shard_id, 'AFTER_SEQUENCE_NUMBER', starting_sequence_number=last_sequence_number
+					)
+				else:
+					shard_iterator = get_shard_iterator(
+						kinesis_client, stream_name, shard_id, shard_iterator_type, since_ts_epoch_ms, starting_sequence_number
+					)
+
+			record_response = kinesis_client.get_records(ShardIterator=shard_iterator, Limit=batch_size)
+			retries = 0
+			records = record_response['Records']
+			writer.write(decode_records(records))
+
+			if records:
+				last_sequence_number = records[-1]['SequenceNumber']
+
+				if positions is not None:
+					positions[shard_id] = last_sequence_number
+
+				# Only once written, so that a checkpoint never gets ahead of the output.
+				if checkpoints:
+					checkpoints.update(shard_id, last_sequence_number, len(records))
+
+			shard_iterator = record_response.get('NextShardIterator')
+
+			if shard_iterator is None:
+				logger.info(f'Shard {shard_id} is closed and fully read')
+
+				if checkpoints:
+					checkpoints.update(shard_id, last_sequence_number, 0, closed=True)
+
+				return True
+
+			if not records or record_response.get('MillisBehindLatest', 0) == 0:
+				time.sleep(sleep_ms / 1000)
+
+		except ClientError as err:
+			error_code = err.response['Error']['Code']
+
+			if error_code == 'ExpiredIteratorException':
+				logger.info(f'Expired iterator for shard {shard_id}. Getting a new one.')
+				shard_iterator = None
+				continue
+
+			elif error_code not in RETRY_EXCEPTIONS:
+				raise
+
+			wait_before_retry(shard_id, retries, error_code)
+			retries += 1
+
+		except (BotoCoreError, OSError) as err:
+			# Connection errors, resets and timeouts. Nothing to retry if it's the output that's gone, though.
+			if isinstance(err, BrokenPipeError):
+				raise
+
+			wait_before_retry(shard_id, retries, repr(err))
+			retries += 1
+
+	return False
+
+
+def list_shards(kinesis_client, stream_name):
+	shards = []
+	response = kinesis_client.describe_stream(StreamName=stream_name)
 
 	while True:
+		shards.extend(response['StreamDescription']['Shards'])
+
+		if not response['StreamDescription'].get('HasMoreShards') or not shards:
+			return shards
+
+		response = kinesis_client.describe_stream(StreamName=stream_name, ExclusiveStartShardId=shards[-1]['ShardId'])
+
+
+class KinesisConsumer:
+	"""Reads every shard of a stream concurrently, one thread pool worker per shard, into a shared OutputWriter.
+
+	Shards listed at startup are read from shard_iterator_type, unless they're children of a shard we've read (open at
+	startup, or checkpointed). The shard list is refreshed every shard_refresh_ms, and those children, as well as the
+	shards created by a later reshard, are read from TRIM_HORIZON. A child shard is only started once its parents are
+	fully read (or have been trimmed from the stream), so records are neither skipped nor reordered across a reshard.
+	Readers that fail are restarted after a jittered backoff, right after the last record they wrote.
+	"""
+
+	def __init__(
+			self, kinesis_client, stream_name, writer, batch_size=50, sleep_ms=250, shard_iterator_type='LATEST',
+			since_ts_epoch_ms=None, starting_sequence_number=None, max_workers=64, shard_refresh_ms=60000, checkpoints=None
+	):
+		self.kinesis_client = kinesis_client
+		self.stream_name = stream_name
+		self.writer = writer
+		self.batch_size = batch_size
+		self.sleep_ms = sleep_ms
+		self.shard_iterator_type = shard_iterator_type
+		self.since_ts_epoch_ms = since_ts_epoch_ms
+		self.starting_sequence_number = starting_sequence_number
+		self.shard_refresh_ms = shard_refresh_ms
+		self.checkpoints = checkpoints
+		self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='shard')
+		self.stop_event = threading.Event()
+		self.initial_shard_ids = None
+		self.untracked_shard_ids = set()
+		self.running = {}  # shard_id -> future
+		# Shards checkpointed as fully read are never read again, so their children can start straight away.
+		self.closed = checkpoints.closed_shards() if checkpoints else set()
+		self.failures = {}  # shard_id -> (consecutive failures, not before ts)
+		self.positions = {}  # shard_id -> sequence number of the last record written
+
+	def ready_shards(self, shards):
+		shard_ids = set(shard['ShardId'] for shard in shards)
+		ready = []
 
-		if shard_iterator_type == 'AT_TIMESTAMP':
-			since_ts_epoch_ms = float(args.since_ts_epoch_ms)
-			shard_iterator = kinesis_client.get_shard_iterator(
-				StreamName=stream_name,
-				ShardId=shard_id,
-				ShardIteratorType=shard_iterator_type,
-				Timestamp=since_ts_epoch_ms
-			)
-
-		elif shard_iterator_type in ['AT_SEQUENCE_NUMBER', 'AFTER_SEQUENCE_NUMBER']:
-			starting_sequence_number = str(args.starting_sequence_number)
-			shard_iterator = kinesis_client.get_shard_iterator(
-				StreamName=stream_name,
-				ShardId=shard_id,
-				ShardIteratorType=shard_iterator_type,
-				StartingSequenceNumber=starting_sequence_number,
-			)
+		for shard in shards:
+			shard_id = shard['ShardId']
+
+			if shard_id in self.running or shard_id in self.closed:
+				continue
+
+			if time.time() < self.failures.get(shard_id, (0, 0))[1]:
+				continue
+
+			parents = [shard.get('ParentShardId'), shard.get('AdjacentParentShardId')]
+
+			# A parent no longer listed has aged out of the stream, so there's nothing left to wait for.
+			if all(parent is None or parent in self.closed or parent not in shard_ids for parent in parents):
+				ready.append(shard)
+
+		return ready
+
+	def start_shard(self, shard):
+		shard_id = shard['ShardId']
+
+		parents = [parent for parent in [shard.get('ParentShardId'), shard.get('AdjacentParentShardId')] if parent]
+
+		# A child of a shard we've been reading must be read from its start, or whatever it got meanwhile is skipped.
+		if shard_id in self.initial_shard_ids and all(parent in self.untracked_shard_ids for parent in parents):
+			shard_iterator_type = self.shard_iterator_type
 		else:
-			shard_iterator = kinesis_client.get_shard_iterator(
-				StreamName=stream_name,
-				ShardId=shard_id,
-				ShardIteratorType=shard_iterator_type,
-			)
+			shard_iterator_type = 'TRIM_HORIZON'
+
+		self.running[shard_id] = self.executor.submit(
+			process_shard, self.kinesis_client, self.stream_name, shard_id, self.writer, self.batch_size, self.sleep_ms,
+			shard_iterator_type, self.since_ts_epoch_ms, self.starting_sequence_number, self.stop_event, self.checkpoints,
+			self.positions
+		)
 
-		# ShardIteratorType='LATEST')
-		# Valid Values: AT_SEQUENCE_NUMBER | AFTER_SEQUENCE_NUMBER | TRIM_HORIZON | LATEST | AT_TIMESTAMP
+	def reap(self):
+		for shard_id, future in list(self.running.items()):
+			if not future.done():
+				continue
 
-		shard_iterator = shard_iterator['ShardIterator']
-		record_response = kinesis_client.get_records(ShardIterator=shard_iterator, Limit=batch_size)
-		retries = 0
+			del self.running[shard_id]
 
-		while 'NextShardIterator' in record_response:
 			try:
-				record_response = kinesis_client.get_records(ShardIterator=record_response['NextShardIterator'], Limit=batch_size)
+				if future.result():
+					self.closed.add(shard_id)
+					self.failures.pop(shard_id, None)
+			except Exception:
+				failures = self.failures.get(shard_id, (0, 0))[0] + 1
+				self.failures[shard_id] = (failures, time.time() + backoff_seconds(failures, 1000, 60000))
+				logger.error(f'Reader for shard {shard_id} failed ({failures} in a row): {traceback.format_exc()}')
 
-				for record in record_response['Records']:
-					try:
-						data_record = record['Data']
+	def run(self):
+		last_refresh = 0
+		shards = []
 
-						if data_record and data_record != '\n':
-							print(json.dumps(json.loads(data_record)))
+		try:
+			while not self.stop_event.is_set():
+				self.reap()
 
-					except Exception as e:
-						logger.error(f'JSON parsing failed for record {data_record}: {traceback.format_exc()}')
+				if time.time() - last_refresh >= self.shard_refresh_ms / 1000 or not self.running:
+					shards = list_shards(self.kinesis_client, self.stream_name)
+					last_refresh = time.time()
 
-			except ClientError as err:
+					if self.initial_shard_ids is None:
+						self.initial_shard_ids = set(shard['ShardId'] for shard in shards)
+						# Shards already closed at startup that we've no checkpoint for: we never read them.
+						self.untracked_shard_ids = set(
+							shard['ShardId'] for shard in shards
+							if 'EndingSequenceNumber' in shard['SequenceNumberRange'] and
+							not (self.checkpoints and self.checkpoints.get(shard['ShardId']) is not None)
+						)
 
-				if err.response['Error']['Code'] == 'ExpiredIteratorException':
-					logger.info(f'Expired iterator. Moving on.')
-					break
+				for shard in self.ready_shards(shards):
+					self.start_shard(shard)
 
-				elif err.response['Error']['Code'] not in RETRY_EXCEPTIONS:
-					raise
+				if self.checkpoints:
+					self.checkpoints.maybe_flush()
 
-				if retries == MAX_RETRIES:
-					logger.error(f'Max retries reached({MAX_RETRIES}), moving on.')
+				if not self.running and shards and all(shard['ShardId'] in self.closed for shard in shards):
+					logger.info(f'All shards of {self.stream_name} are closed and read')
 					break
 
-				logger.warning(f'Slowing it down. Retries={retries}.')
-				time.sleep(5 ** (retries + 2))
-				retries += 1
+				self.stop_event.wait(min(1.0, self.shard_refresh_ms / 1000))
+		finally:
+			self.stop()
+
+	def stop(self):
+		self.stop_event.set()
+		self.executor.shutdown(wait=True)
+
+		if self.checkpoints:
+			self.checkpoints.flush()
+
+	def stats(self):
+		stats = {'running_shards': len(self.running), 'closed_shards': len(self.closed), 'records': self.writer.records}
 
-			# except:
-			# 	logging.error(f'An error occurred: {traceback.format_exc()}')
+		if self.checkpoints:
+			stats['checkpoints'] = dict(self.checkpoints.stats)
 
-		time.sleep(sleep_ms / 1000)
+		return stats
 
 
 if __name__ == '__main__':
@@ -104,6 +353,14 @@ if __name__ == '__main__':
 	parser.add_argument('-sqn', '--starting_sequence_number', help='StartingSequenceNumber for AT_SEQUENCE_NUMBER/AFTER_SEQUENCE_NUMBER. '
 																   'Mandatory for shard_iterator_type=[AT_SEQUENCE_NUMBER|AFTER_SEQUENCE_NUMBER]',
 						type=str, required=False)
+	parser.add_argument('-w', '--max_workers', help='Max shards read at the same time, one thread each', type=int, default=64)
+	parser.add_argument(
+		'-cf', '--checkpoint_file_path', help='SQLite file with per shard checkpoints. Shards with one resume right after it',
+		type=str, required=False
+	)
+	parser.add_argument('-cfi', '--checkpoint_flush_interval_ms', help='Max millisecs between checkpoint flushes', type=int, default=5000)
+	parser.add_argument('-cfr', '--checkpoint_flush_records', help='Flush checkpoints after this many records', type=int, default=1000)
+	parser.add_argument('-sr', '--shard_refresh_ms', help='How often to look for new shards after a reshard', type=int, default=60000)
 
 	args = parser.parse_args()
 	batch_size = int(args.batch_size)
@@ -114,10 +371,27 @@ if __name__ == '__main__':
 	shard_iterator_type = str(args.shard_iterator_type)
 
 	kinesis_client = boto3.client('kinesis', region_name=region_name)
-	response = kinesis_client.describe_stream(StreamName=stream_name)
+	checkpoints = None
+
+	if args.checkpoint_file_path:
+		checkpoints = ShardCheckpoints(
+			args.checkpoint_file_path, stream_name, int(args.checkpoint_flush_interval_ms), int(args.checkpoint_flush_records)
+		)
+
+	consumer = KinesisConsumer(
+		kinesis_client, stream_name, OutputWriter(sys.stdout), batch_size, sleep_ms, shard_iterator_type,
+		args.since_ts_epoch_ms, args.starting_sequence_number, int(args.max_workers), int(args.shard_refresh_ms), checkpoints
+	)
+
+	try:
+		consumer.run()
+	except KeyboardInterrupt:
+		logger.info('Interrupted, stopping the shard readers')
+	finally:
+		consumer.stop()
+		logger.info(f'Consumer stats: {consumer.stats()}')
 
-	# TODO: KCL
-	for shard in response['StreamDescription']['Shards']:
-		_thread.start_new_thread(process_shard(shard, sleep_ms, shard_iterator_type, args))
+		if checkpoints:
+			checkpoints.close()
 
-	kinesis_client.close()
+		kinesis_client.close()
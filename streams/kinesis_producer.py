@@ -1,11 +1,19 @@
 import argparse
 import boto3
 import json
+from collections import Counter
 from datetime import datetime
 import calendar
+import hashlib
+import itertools
+import os
+import queue
 import random
 import sys
+import threading
 import time
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from inference import json_codec
 import traceback
 import logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
@@ -13,29 +21,308 @@ logger = logging.getLogger(__name__)
 
 # arn:aws:kinesis:eu-west-1:631645402277:stream/automlpredictor-tesla-test
 
-def put_to_stream(kinesis_client, raw_records):
+# PutRecords limits: https://docs.aws.amazon.com/kinesis/latest/APIReference/API_PutRecords.html
+MAX_RECORDS_PER_PUT = 500
+MAX_BYTES_PER_PUT = 5 * 1024 * 1024
+MAX_BYTES_PER_RECORD = 1024 * 1024  # Data plus partition key
+MAX_RETRIES = 8
+
+def backoff_seconds(retries, base_ms=100, cap_ms=10000):
+  # Full jitter, so that producers throttled together don't retry in lockstep.
+  return random.uniform(0, min(cap_ms, base_ms * 2 ** retries)) / 1000
+
+def put_records_with_retries(kinesis_client, stream_name, records, stats, max_retries=MAX_RETRIES):
+  """PutRecords, re-submitting only the entries that failed (e.g. throttled) with backoff. Returns the entries dropped.
+
+  stats gets sent, retried and dropped counts. A call that fails as a whole is retried in the same way.
+  """
+  retries = 0
+
+  while records:
+    try:
+      response = kinesis_client.put_records(Records=records, StreamName=stream_name)
+      stats['puts'] += 1
+
+      if response.get('FailedRecordCount', 0):
+        failed = [record for record, result in zip(records, response['Records']) if 'ErrorCode' in result]
+      else:
+        failed = []
+
+      stats['sent'] += len(records) - len(failed)
+      records_per_shard = stats.setdefault('records_per_shard', Counter())
+      records_per_shard.update(result['ShardId'] for result in response['Records'] if 'ShardId' in result)
+      records = failed
+    except Exception:
+      logger.warning(f'PutRecords of {len(records)} records failed: {traceback.format_exc()}')
+
+    if not records:
+      break
+
+    if retries >= max_retries:
+      stats['dropped'] += len(records)
+      logger.error(f'Dropping {len(records)} records after {retries} retries')
+      return records
+
+    stats['retried'] += len(records)
+    time.sleep(backoff_seconds(retries))
+    retries += 1
+
+  return []
+
+def partition_key(raw_record):
+  # TODO: Revisit, it's good enough for the time being, because we know
+  return str(hash(raw_record[73:200]))
+
+def stable_partition_key(raw_record):
+  # Same key for the same post in every process and run, whatever the field order of the JSON.
+  try:
+    record = json_codec.loads(raw_record)
+    return f"{record['msgType']}:{record['data']['id']}"
+  except Exception:
+    return hashlib.md5(raw_record.encode('utf-8')).hexdigest()
+
+def shard_balance(records_per_shard):
+  """Records per shard, plus max/mean: 1.0 is a perfectly even spread."""
+  if not records_per_shard:
+    return {}
+
+  mean = sum(records_per_shard.values()) / len(records_per_shard)
+  return {'records_per_shard': dict(sorted(records_per_shard.items())), 'max_over_mean': round(max(records_per_shard.values()) / mean, 3)}
+
+
+class ShardMap:
+  """Hash key ranges of the open shards of a stream, refreshed every refresh_ms so that reshards are picked up."""
+
+  def __init__(self, kinesis_client, stream_name, refresh_ms=60000):
+    self.kinesis_client = kinesis_client
+    self.stream_name = stream_name
+    self.refresh_ms = refresh_ms
+    self.shards = []
+    self.refreshed_at = 0
+    self.refresh()
+
+  def refresh(self):
+    shards = []
+    response = self.kinesis_client.describe_stream(StreamName=self.stream_name)
+
+    while True:
+      shards.extend(response['StreamDescription']['Shards'])
+
+      if not response['StreamDescription'].get('HasMoreShards') or not shards:
+        break
+
+      response = self.kinesis_client.describe_stream(StreamName=self.stream_name, ExclusiveStartShardId=shards[-1]['ShardId'])
+
+    open_shards = [shard for shard in shards if 'EndingSequenceNumber' not in shard['SequenceNumberRange']]
+    self.shards = sorted(
+      ((int(shard['HashKeyRange']['StartingHashKey']), int(shard['HashKeyRange']['EndingHashKey']), shard['ShardId']) for shard in open_shards)
+    )
+    self.refreshed_at = time.time()
+    logger.info(f'Shard map of {self.stream_name}: {[shard_id for _, _, shard_id in self.shards]}')
+
+  def hash_key(self, shard_index):
+    """ExplicitHashKey in the middle of the shard_index-th open shard."""
+    if (time.time() - self.refreshed_at) * 1000 >= self.refresh_ms:
+      try:
+        self.refresh()
+      except Exception:
+        logger.warning(f'Could not refresh the shard map, keeping the old one: {traceback.format_exc()}')
+
+    starting_hash_key, ending_hash_key, _ = self.shards[shard_index % len(self.shards)]
+    return str((starting_hash_key + ending_hash_key) // 2)
+
+
+PARTITION_KEY_STRATEGIES = ['legacy', 'stable', 'round_robin', 'explicit']
+
+class Partitioner:
+  """PartitionKey (and ExplicitHashKey) for a record.
+
+  legacy: hash() of a slice of the JSON. Python randomises str hashes per process, so keys change between runs.
+  stable: msgType:data.id, so a post always lands on the same shard. Kinesis MD5s it into the hash key space.
+  round_robin: ExplicitHashKey cycling over the open shards. Even load, no per post affinity.
+  explicit: stable key, MD5 modulo the number of open shards, sent as that shard's ExplicitHashKey. Even load even
+    with uneven shard ranges, and per post affinity as long as the shard count doesn't change.
+  """
+
+  def __init__(self, strategy='legacy', shard_map=None):
+    if strategy not in PARTITION_KEY_STRATEGIES:
+      raise ValueError(f'Unknown partition key strategy {strategy}')
+
+    if strategy in ['round_robin', 'explicit'] and shard_map is None:
+      raise ValueError(f'Partition key strategy {strategy} needs a shard map')
+
+    self.strategy = strategy
+    self.shard_map = shard_map
+    self.counter = itertools.count()
+
+  def __call__(self, raw_record):
+    if self.strategy == 'legacy':
+      return {'PartitionKey': partition_key(raw_record)}
+
+    key = stable_partition_key(raw_record)
+
+    if self.strategy == 'stable':
+      return {'PartitionKey': key}
+
+    if self.strategy == 'round_robin':
+      shard_index = next(self.counter)
+    else:
+      shard_index = int(hashlib.md5(key.encode('utf-8')).hexdigest(), 16)
+
+    return {'PartitionKey': key, 'ExplicitHashKey': self.shard_map.hash_key(shard_index)}
+
+legacy_stats = {'puts': 0, 'sent': 0, 'retried': 0, 'dropped': 0}
+legacy_partitioner = Partitioner('legacy')
+
+def put_to_stream(kinesis_client, raw_records, partitioner=legacy_partitioner):
   records = []
-  put_response = None
 
   for raw_record in raw_records:
 
     if raw_record and raw_record != '\n':
-      # TODO: Revisit, it's good enough for the time being, because we know
-      pk = str(hash(raw_record[73:200]))
-      record = {'Data': raw_record, 'PartitionKey': pk}
+      record = {'Data': raw_record, **partitioner(raw_record)}
       records.append(record)
 
-  try:
-    # logger.info(f'Records for Put request: {records}')
-    put_response = kinesis_client.put_records(
-      Records=records,
-      StreamName=stream_name,
-    )
-    # logger.info(f'Put response: {put_response} for alert_records.')
-  except Exception:
-    logging.error(f'Transmission Failed when sending records: {records} :{traceback.format_exc()}')
+  # logger.info(f'Records for Put request: {records}')
+  dropped = put_records_with_retries(kinesis_client, stream_name, records, legacy_stats)
+
+  if dropped:
+    logging.error(f'Transmission Failed when sending records: {dropped}')
+
+  logger.info(f'Producer stats: {legacy_stats}')
+
+
+class BatchingProducer:
+  """Sends lines to a stream from a background thread, in PutRecords calls that are flushed on size or on linger.
+
+  A call goes out once it holds batch_size records or would break the 500 records / 5 MB PutRecords limits, or
+  linger_ms after its first line, whichever comes first. So a trickle is sent within linger_ms and a burst is sent
+  in few, full calls.
+
+  Lines wait in a queue of at most queue_size lines. While the sender is retrying failed entries the queue fills up,
+  and submit blocks, which stops us reading stdin rather than holding an unbounded backlog in memory.
+
+  With aggregate, consecutive lines are packed newline separated into one Kinesis record of up to aggregate_bytes,
+  which kcl_consumer and kinesis_consumer split back. Lines are never split across records. The aggregated record
+  takes the partition key of its first line. Partition keys come from partitioner, see Partitioner.
+  """
+
+  _STOP = object()
+
+  def __init__(
+      self, kinesis_client, stream_name, batch_size=MAX_RECORDS_PER_PUT, linger_ms=200, aggregate=False,
+      aggregate_bytes=64 * 1024, queue_size=10000, max_retries=MAX_RETRIES, partitioner=None
+  ):
+    self.kinesis_client = kinesis_client
+    self.stream_name = stream_name
+    self.batch_size = min(batch_size, MAX_RECORDS_PER_PUT)
+    self.linger_ms = linger_ms
+    self.aggregate = aggregate
+    self.aggregate_bytes = min(aggregate_bytes, MAX_BYTES_PER_RECORD)
+    self.max_retries = max_retries
+    self.partitioner = partitioner or legacy_partitioner
+    self.lines = queue.Queue(maxsize=queue_size)
+    self.sender = threading.Thread(target=self.run, name='kinesis-sender', daemon=True)
+    self.stats = {'lines': 0, 'records': 0, 'puts': 0, 'sent': 0, 'retried': 0, 'dropped': 0, 'bytes': 0, 'blocked_submits': 0}
+    self.pending = []
+    self.pending_bytes = 0
+    self.aggregated_lines = []
+    self.aggregated_bytes = 0
+
+  def start(self):
+    self.sender.start()
+    return self
+
+  def submit(self, line):
+    if line and line.strip():
+      try:
+        self.lines.put_nowait(line)
+      except queue.Full:
+        self.stats['blocked_submits'] += 1
+        self.lines.put(line)
+
+  def close(self):
+    self.lines.put(self._STOP)
+    self.sender.join()
+
+  def _add_record(self, data, key_fields):
+    size = len(data) + len(key_fields['PartitionKey'].encode('utf-8'))
+
+    if size > MAX_BYTES_PER_RECORD:
+      self.stats['dropped'] += 1
+      logger.error(f'Dropping a {size} bytes record, over the {MAX_BYTES_PER_RECORD} bytes Kinesis limit: {data[:200]}')
+      return
+
+    if len(self.pending) >= self.batch_size or self.pending_bytes + size > MAX_BYTES_PER_PUT:
+      self._send_pending()
+
+    self.pending.append({'Data': data, **key_fields})
+    self.pending_bytes += size
+
+  def _seal_aggregate(self):
+    if self.aggregated_lines:
+      lines, self.aggregated_lines, self.aggregated_bytes = self.aggregated_lines, [], 0
+      self._add_record(b'\n'.join(lines), self.partitioner(lines[0].decode('utf-8')))
+
+  def _add_line(self, line):
+    line = line.rstrip('\n')
+    data = line.encode('utf-8')
+    self.stats['lines'] += 1
+
+    if not self.aggregate:
+      self._add_record(data, self.partitioner(line))
+      return
+
+    if self.aggregated_lines and self.aggregated_bytes + 1 + len(data) > self.aggregate_bytes:
+      self._seal_aggregate()
+
+    self.aggregated_lines.append(data)
+    self.aggregated_bytes += len(data) + (1 if len(self.aggregated_lines) > 1 else 0)
+
+  def flush(self):
+    self._seal_aggregate()
+    self._send_pending()
+
+  def _send_pending(self):
+    if not self.pending:
+      return
+
+    records, self.pending, self.pending_bytes = self.pending, [], 0
+    self.stats['records'] += len(records)
+    self.stats['bytes'] += sum(len(record['Data']) for record in records)
+    put_records_with_retries(self.kinesis_client, self.stream_name, records, self.stats, self.max_retries)
+
+  def run(self):
+    deadline = None
+    last_stats_log = time.time()
+
+    while True:
+      if time.time() - last_stats_log >= 60:
+        logger.info(f'Producer stats: {self.stats}, queued lines: {self.lines.qsize()}')
+        logger.info(f'Shard balance: {shard_balance(self.stats.get("records_per_shard"))}')
+        last_stats_log = time.time()
+
+      timeout = None if deadline is None else max(0.0, deadline - time.time())
+
+      try:
+        line = self.lines.get(timeout=timeout)
+      except queue.Empty:
+        self.flush()
+        deadline = None
+        continue
+
+      if line is self._STOP:
+        self.flush()
+        return
+
+      if deadline is None:
+        deadline = time.time() + self.linger_ms / 1000
+
+      self._add_line(line)
+
+      if not self.pending and not self.aggregated_lines:
+        deadline = None
 
-  return put_response
 
 if __name__ == '__main__':
   parser = argparse.ArgumentParser()
@@ -44,6 +331,21 @@ if __name__ == '__main__':
   parser.add_argument('-s', '--sleep_ms', help='Sleep in millisecs', type=int, default=0)
   parser.add_argument('-sn', '--stream_name', help='Sleep in millisecs', type=str, required=True)
   parser.add_argument('-r', '--region_name', help='AWS region name', type=str, default='eu-west-1')
+  parser.add_argument(
+    '-lm', '--linger_ms', help='Send from a background thread, flushing batch_size records or after linger_ms, whichever is first. '
+                               'Without it, we send every batch_size lines as they come. Use with a larger --batch_size, e.g. 500',
+    type=int, required=False
+  )
+  parser.add_argument('-ag', '--aggregate', help='Pack several lines per Kinesis record. Needs --linger_ms', action='store_true')
+  parser.add_argument('-qs', '--queue_size', help='Lines held in memory before we stop reading stdin. Needs --linger_ms', type=int, default=10000)
+  parser.add_argument('-mr', '--max_retries', help='Retries of failed records before dropping them', type=int, default=MAX_RETRIES)
+  parser.add_argument('-ab', '--aggregate_bytes', help='Max bytes per aggregated Kinesis record', type=int, default=64 * 1024)
+  parser.add_argument(
+    '-pk', '--partition_key_strategy', help='legacy: hash of a slice of the JSON. stable: msgType:data.id. '
+                                            'round_robin/explicit: ExplicitHashKey over the open shards, see Partitioner',
+    type=str, default='legacy', choices=PARTITION_KEY_STRATEGIES
+  )
+  parser.add_argument('-smr', '--shard_map_refresh_ms', help='How often round_robin/explicit re-read the shards', type=int, default=60000)
 
   args = parser.parse_args()
   batch_size = int(args.batch_size)
@@ -53,6 +355,32 @@ if __name__ == '__main__':
 
   kinesis_client = boto3.client('kinesis', region_name=region_name)
   # response = kinesis_client.describe_stream(StreamName=stream_name)
+  shard_map = None
+
+  if args.partition_key_strategy in ['round_robin', 'explicit']:
+    shard_map = ShardMap(kinesis_client, stream_name, int(args.shard_map_refresh_ms))
+
+  partitioner = Partitioner(str(args.partition_key_strategy), shard_map)
+
+  if args.linger_ms is not None:
+    producer = BatchingProducer(
+      kinesis_client, stream_name, batch_size, int(args.linger_ms), args.aggregate, int(args.aggregate_bytes),
+      int(args.queue_size), int(args.max_retries), partitioner
+    ).start()
+
+    try:
+      for line in sys.stdin:
+        if args.print:
+          print(line.rstrip())
+
+        producer.submit(line)
+    finally:
+      producer.close()
+      logger.info(f'Producer stats: {producer.stats}')
+      logger.info(f'Shard balance: {shard_balance(producer.stats.get("records_per_shard"))}')
+
+    sys.exit(0)
+
   n_messages = 0
   raw_records = []
 
@@ -66,8 +394,7 @@ if __name__ == '__main__':
       n_messages += 1
 
       if n_messages == args.batch_size:
-        # TODO: Error handling/retry of failed records
-        put_response = put_to_stream(kinesis_client, raw_records)
+        put_to_stream(kinesis_client, raw_records, partitioner)
         n_messages = 0
         raw_records = []
-        time.sleep(sleep_ms/1000)
\ No newline at end of file
+        time.sleep(sleep_ms/1000)
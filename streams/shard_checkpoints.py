@@ -0,0 +1,104 @@
+import sqlite3
+import threading
+import time
+
+import logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+
+class ShardCheckpoints:
+    """Last written sequence number per shard, kept in SQLite so that kinesis_consumer can resume after a restart.
+
+    Updates are held in memory and flushed in a single transaction once flush_records updates have piled up or
+    flush_interval_ms has passed, so the readers don't pay a disk sync per GetRecords call. A crash can thus replay
+    at most one flush interval of records, it never skips any.
+    """
+
+    def __init__(self, db_path, stream_name, flush_interval_ms=5000, flush_records=1000):
+        self.stream_name = stream_name
+        self.flush_interval_ms = flush_interval_ms
+        self.flush_records = flush_records
+        self.lock = threading.Lock()
+        self.pending = {}  # shard_id -> (sequence_number, closed)
+        self.pending_records = 0
+        self.last_flush = time.time()
+        self.stats = {'updates': 0, 'flushes': 0}
+        self.db = sqlite3.connect(db_path, check_same_thread=False)
+        self.db.execute(
+            'CREATE TABLE IF NOT EXISTS shard_checkpoints (stream_name TEXT, shard_id TEXT, sequence_number TEXT, '
+            'closed INTEGER DEFAULT 0, updated_at_epoch_ms INTEGER, PRIMARY KEY (stream_name, shard_id))'
+        )
+        self.db.commit()
+
+    def _stored(self, shard_id):
+        return self.db.execute(
+            'SELECT sequence_number, closed FROM shard_checkpoints WHERE stream_name = ? AND shard_id = ?', (self.stream_name, shard_id)
+        ).fetchone()
+
+    def get(self, shard_id):
+        with self.lock:
+            if shard_id in self.pending:
+                return self.pending[shard_id][0]
+
+            row = self._stored(shard_id)
+
+        return row[0] if row else None
+
+    def closed_shards(self):
+        with self.lock:
+            rows = self.db.execute(
+                'SELECT shard_id FROM shard_checkpoints WHERE stream_name = ? AND closed = 1', (self.stream_name,)
+            ).fetchall()
+
+        return set(row[0] for row in rows)
+
+    def update(self, shard_id, sequence_number, n_records=1, closed=False):
+        with self.lock:
+            if shard_id in self.pending:
+                previous_sequence_number, previous_closed = self.pending[shard_id]
+            else:
+                previous_sequence_number, previous_closed = self._stored(shard_id) or (None, False)
+
+            self.pending[shard_id] = (sequence_number or previous_sequence_number, bool(closed or previous_closed))
+            self.pending_records += n_records
+            self.stats['updates'] += 1
+            due = (
+                closed or self.pending_records >= self.flush_records or
+                (time.time() - self.last_flush) * 1000 >= self.flush_interval_ms
+            )
+
+        if due:
+            self.flush()
+
+    def flush(self):
+        with self.lock:
+            if not self.pending:
+                return
+
+            now_ms = int(time.time() * 1000)
+            rows = [
+                (self.stream_name, shard_id, sequence_number, int(closed), now_ms)
+                for shard_id, (sequence_number, closed) in self.pending.items()
+            ]
+            self.db.executemany(
+                'INSERT OR REPLACE INTO shard_checkpoints (stream_name, shard_id, sequence_number, closed, updated_at_epoch_ms) '
+                'VALUES (?, ?, ?, ?, ?)',
+                rows
+            )
+            self.db.commit()
+            self.pending.clear()
+            self.pending_records = 0
+            self.last_flush = time.time()
+            self.stats['flushes'] += 1
+
+    def maybe_flush(self):
+        # For shards that have gone quiet: their last updates would otherwise wait for the next busy shard.
+        if self.pending and (time.time() - self.last_flush) * 1000 >= self.flush_interval_ms:
+            self.flush()
+
+    def close(self):
+        self.flush()
+
+        with self.lock:
+            self.db.close()